@@ -29,12 +29,14 @@
 # DEALINGS IN THE SOFTWARE.
 ###############################################################################
 
+import json
 import os
 import sys
 import shutil
 
 
 from osgeo import gdal      # noqa
+from osgeo import osr       # noqa
 import test_py_scripts      # noqa  # pylint: disable=E0401
 import pytest
 
@@ -103,6 +105,646 @@ def test_gdal2tiles_py_zoom_option():
     assert ds is not None, 'did not get kml'
 
 
+def test_gdal2tiles_py_overview_tiles_multiprocessing():
+    """
+    Overview tiles are generated by the pool as soon as their children are available: the result
+    must be the same as with a single process
+    """
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    out_folders = ['tmp/out_gdal2tiles_ovr_1', 'tmp/out_gdal2tiles_ovr_3']
+    for out_folder, nb_processes in zip(out_folders, (1, 3)):
+        shutil.rmtree(out_folder, ignore_errors=True)
+        test_py_scripts.run_py_script_as_external_script(
+            script_path,
+            'gdal2tiles',
+            '-q --processes=%d -z 0-3 ../gdrivers/data/small_world.tif %s' % (nb_processes, out_folder))
+
+    try:
+        for tz, tx, ty in [(0, 0, 0), (1, 0, 1), (1, 1, 0), (2, 2, 1)]:
+            tile = '%d/%d/%d.png' % (tz, tx, ty)
+            cs = []
+            for out_folder in out_folders:
+                ds = gdal.Open(os.path.join(out_folder, tile))
+                assert ds is not None, ('%s missing in %s' % (tile, out_folder))
+                cs.append([ds.GetRasterBand(i + 1).Checksum() for i in range(4)])
+                ds = None
+            assert cs[0] == cs[1], ('different checksums for %s' % tile)
+    finally:
+        for out_folder in out_folders:
+            shutil.rmtree(out_folder, ignore_errors=True)
+
+
+def test_gdal2tiles_py_overview_cache():
+    """
+    Overview tiles built from the cache of generated tiles, from the disk (--overview-cache=0) or
+    from a mix of both (tiny cache) must be identical
+    """
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    out_folders = ['tmp/out_gdal2tiles_cache_0', 'tmp/out_gdal2tiles_cache_1',
+                   'tmp/out_gdal2tiles_cache_256']
+    for out_folder in out_folders:
+        shutil.rmtree(out_folder, ignore_errors=True)
+        test_py_scripts.run_py_script(
+            script_path,
+            'gdal2tiles',
+            '-q --overview-cache=%s -z 0-3 ../gdrivers/data/small_world.tif %s' % (
+                out_folder.split('_')[-1], out_folder))
+
+    try:
+        for tz, tx, ty in [(0, 0, 0), (1, 0, 1), (1, 1, 0), (2, 2, 1)]:
+            tile = '%d/%d/%d.png' % (tz, tx, ty)
+            cs = []
+            for out_folder in out_folders:
+                ds = gdal.Open(os.path.join(out_folder, tile))
+                assert ds is not None, ('%s missing in %s' % (tile, out_folder))
+                cs.append([ds.GetRasterBand(i + 1).Checksum() for i in range(4)])
+                ds = None
+            assert cs[0] == cs[1] == cs[2], ('different checksums for %s' % tile)
+    finally:
+        for out_folder in out_folders:
+            shutil.rmtree(out_folder, ignore_errors=True)
+
+
+def test_gdal2tiles_py_resume():
+    """
+    With --resume, only the missing base tiles must be generated again
+    """
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    out_folder = 'tmp/out_gdal2tiles_resume'
+    shutil.rmtree(out_folder, ignore_errors=True)
+
+    args = '-q --processes=2 -z 0-2 ../gdrivers/data/small_world.tif %s' % out_folder
+    try:
+        test_py_scripts.run_py_script_as_external_script(script_path, 'gdal2tiles', args)
+
+        removed_tile = os.path.join(out_folder, '2', '1', '2.png')
+        kept_tile = os.path.join(out_folder, '2', '2', '1.png')
+        os.unlink(removed_tile)
+        kept_tile_mtime = 1000000000
+        os.utime(kept_tile, (kept_tile_mtime, kept_tile_mtime))
+
+        test_py_scripts.run_py_script_as_external_script(script_path, 'gdal2tiles', '-e ' + args)
+
+        assert os.path.exists(removed_tile)
+        assert os.stat(kept_tile).st_mtime == kept_tile_mtime
+    finally:
+        shutil.rmtree(out_folder, ignore_errors=True)
+
+
+def test_gdal2tiles_py_update():
+    """
+    With --update, only the base tiles whose input files changed, and their overview tiles, must
+    be generated again
+    """
+    pytest.importorskip('sqlite3')
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    out_folder = 'tmp/out_gdal2tiles_update'
+    shutil.rmtree(out_folder, ignore_errors=True)
+    west_file = 'tmp/gdal2tiles_update_west.tif'
+    east_file = 'tmp/gdal2tiles_update_east.tif'
+    vrt_file = 'tmp/gdal2tiles_update.vrt'
+    gdal.Translate(west_file, '../gdrivers/data/small_world.tif', srcWin=[0, 0, 200, 200])
+    gdal.Translate(east_file, '../gdrivers/data/small_world.tif', srcWin=[200, 0, 200, 200])
+    gdal.BuildVRT(vrt_file, [west_file, east_file])
+
+    args = '-q --update -z 0-2 %s %s' % (vrt_file, out_folder)
+    try:
+        test_py_scripts.run_py_script_as_external_script(script_path, 'gdal2tiles', args)
+        assert os.path.exists(os.path.join(out_folder, 'gdal2tiles_manifest.sqlite'))
+
+        old_mtime = 1000000000
+        tiles = []
+        for root, _, files in os.walk(out_folder):
+            tiles += [os.path.join(root, f) for f in files if f.endswith('.png')]
+        for tile in tiles:
+            os.utime(tile, (old_mtime, old_mtime))
+
+        # Nothing changed
+        test_py_scripts.run_py_script_as_external_script(script_path, 'gdal2tiles', args)
+        for tile in tiles:
+            assert os.stat(tile).st_mtime == old_mtime, tile
+
+        # Only the eastern half changed
+        os.utime(east_file, (old_mtime, old_mtime))
+        test_py_scripts.run_py_script_as_external_script(script_path, 'gdal2tiles', args)
+        assert os.stat(os.path.join(out_folder, '2', '0', '1.png')).st_mtime == old_mtime
+        assert os.stat(os.path.join(out_folder, '2', '3', '1.png')).st_mtime != old_mtime
+        assert os.stat(os.path.join(out_folder, '0', '0', '0.png')).st_mtime != old_mtime
+    finally:
+        shutil.rmtree(out_folder, ignore_errors=True)
+        for filename in (west_file, east_file, vrt_file):
+            gdal.Unlink(filename)
+
+
+def test_gdal2tiles_py_update_exclude():
+    """
+    With --update and --exclude, the tiles that became transparent, and their overview tiles that
+    became empty, must be removed from the output
+    """
+    sqlite3 = pytest.importorskip('sqlite3')
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    outputs = ['tmp/out_gdal2tiles_update_exclude', 'tmp/out_gdal2tiles_update_exclude.mbtiles']
+    west_file = 'tmp/gdal2tiles_update_exclude_west.tif'
+    east_file = 'tmp/gdal2tiles_update_exclude_east.tif'
+    vrt_file = 'tmp/gdal2tiles_update_exclude.vrt'
+
+    def get_tiles(output):
+        if output.endswith('.mbtiles'):
+            conn = sqlite3.connect(output)
+            tiles = conn.execute('SELECT zoom_level, tile_column, tile_row FROM tiles').fetchall()
+            conn.close()
+            return sorted(tuple(tile) for tile in tiles)
+        return sorted((int(tz), int(tx), int(os.path.splitext(f)[0]))
+                      for tz in os.listdir(output) if tz.isdigit()
+                      for tx in os.listdir(os.path.join(output, tz))
+                      for f in os.listdir(os.path.join(output, tz, tx)) if f.endswith('.png'))
+
+    try:
+        for output in outputs:
+            shutil.rmtree(output, ignore_errors=True)
+            gdal.Unlink(output)
+            gdal.Unlink(output + '.manifest.sqlite')
+            gdal.Translate(west_file, '../gdrivers/data/small_world.tif', srcWin=[0, 0, 200, 200],
+                           noData=0)
+            gdal.Translate(east_file, '../gdrivers/data/small_world.tif', srcWin=[200, 0, 200, 200],
+                           noData=0)
+            gdal.BuildVRT(vrt_file, [west_file, east_file])
+
+            args = '-q --update -x -z 0-3 %s %s' % (vrt_file, output)
+            test_py_scripts.run_py_script_as_external_script(script_path, 'gdal2tiles', args)
+            tiles = get_tiles(output)
+            # The base tiles east of 90 degrees, and their overview tiles of the zoom level 2
+            removed_tiles = [tile for tile in tiles
+                             if tile[0] >= 2 and tile[1] >= 3 * 2 ** tile[0] // 4]
+            assert (3, 7, 3) in removed_tiles
+            assert (2, 3, 1) in removed_tiles
+
+            # Blank the eastern half
+            ds = gdal.Open(east_file, gdal.GA_Update)
+            for i in range(ds.RasterCount):
+                ds.GetRasterBand(i + 1).Fill(0)
+            ds = None
+            old_mtime = 1000000000
+            os.utime(east_file, (old_mtime, old_mtime))
+            test_py_scripts.run_py_script_as_external_script(script_path, 'gdal2tiles', args)
+
+            new_tiles = get_tiles(output)
+            assert not set(removed_tiles) & set(new_tiles)
+            # The western half did not change
+            assert set(tile for tile in tiles if tile[1] < 2 ** tile[0] // 2) <= set(new_tiles)
+            assert (0, 0, 0) in new_tiles
+    finally:
+        for output in outputs:
+            shutil.rmtree(output, ignore_errors=True)
+            gdal.Unlink(output)
+            gdal.Unlink(output + '.manifest.sqlite')
+        for filename in (west_file, east_file, vrt_file):
+            gdal.Unlink(filename)
+
+
+def test_gdal2tiles_py_dedup():
+    """
+    With --dedup, the tiles with identical pixels must be links to the same file, with the same
+    content as without --dedup
+    """
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    # 4x4 tiles of the zoom level 10, filled with the same color
+    input_file = 'tmp/gdal2tiles_dedup.tif'
+    extent = 20037508.342789244
+    res = 2 * extent / (256 * 2 ** 10)
+    ds = gdal.GetDriverByName('GTiff').Create(input_file, 1024, 1024, 3)
+    ds.SetGeoTransform([-extent, res, 0, extent, 0, -res])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3857)
+    ds.SetProjection(srs.ExportToWkt())
+    for i in range(3):
+        ds.GetRasterBand(i + 1).Fill(64 * (i + 1))
+    ds = None
+
+    out_folders = ['tmp/out_gdal2tiles_no_dedup', 'tmp/out_gdal2tiles_dedup']
+    try:
+        for out_folder, option in zip(out_folders, ['', '--dedup']):
+            shutil.rmtree(out_folder, ignore_errors=True)
+            test_py_scripts.run_py_script_as_external_script(
+                script_path,
+                'gdal2tiles',
+                '-q %s -z 10 %s %s' % (option, input_file, out_folder))
+
+        nb_links = 0
+        for tx in range(4):
+            for ty in range(2 ** 10 - 4, 2 ** 10):
+                tile = os.path.join('10', str(tx), '%d.png' % ty)
+                cs = []
+                for out_folder in out_folders:
+                    ds = gdal.Open(os.path.join(out_folder, tile))
+                    cs.append([ds.GetRasterBand(i + 1).Checksum() for i in range(4)])
+                    ds = None
+                assert cs[0] == cs[1], tile
+                tilefilename = os.path.join(out_folders[1], tile)
+                assert not os.path.islink(tilefilename), tile
+                if os.stat(tilefilename).st_nlink > 1:
+                    nb_links += 1
+        assert nb_links >= 15
+    finally:
+        gdal.Unlink(input_file)
+        for out_folder in out_folders:
+            shutil.rmtree(out_folder, ignore_errors=True)
+
+
+@pytest.mark.parametrize('metatile', [2, 3])
+def test_gdal2tiles_py_metatile(metatile):
+    """
+    Rendering the base tiles by metatiles must produce the same tileset as rendering them
+    one by one
+    """
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+    numpy = pytest.importorskip('numpy')
+
+    out_folders = ['tmp/out_gdal2tiles_metatile_1', 'tmp/out_gdal2tiles_metatile_%d' % metatile]
+    for out_folder in out_folders:
+        shutil.rmtree(out_folder, ignore_errors=True)
+        test_py_scripts.run_py_script_as_external_script(
+            script_path,
+            'gdal2tiles',
+            '-q --processes=2 --metatile=%s -z 0-3 ../gdrivers/data/small_world.tif %s' % (
+                out_folder.split('_')[-1], out_folder))
+
+    try:
+        tilesets = []
+        for out_folder in out_folders:
+            tiles = []
+            for root, _, files in os.walk(out_folder):
+                tiles += [os.path.join(os.path.relpath(root, out_folder), f)
+                          for f in files if f.endswith('.png')]
+            tilesets.append(sorted(tiles))
+        assert len(tilesets[0]) == 1 + 4 + 16 + 64
+        assert tilesets[0] == tilesets[1]
+
+        for tile in tilesets[1]:
+            ds = gdal.Open(os.path.join(out_folders[1], tile))
+            assert ds is not None, ('%s missing in %s' % (tile, out_folders[1]))
+            assert (ds.RasterXSize, ds.RasterYSize, ds.RasterCount) == (256, 256, 4)
+
+            # The same pixels, up to the rounding of the resampling, in particular along the
+            # edges of the tiles split from a metatile
+            ref_ds = gdal.Open(os.path.join(out_folders[0], tile))
+            diff = numpy.abs(ds.ReadAsArray().astype(numpy.int16) -
+                             ref_ds.ReadAsArray().astype(numpy.int16))
+            assert diff.max() <= 1, tile
+            ds = None
+            ref_ds = None
+    finally:
+        for out_folder in out_folders:
+            shutil.rmtree(out_folder, ignore_errors=True)
+
+
+@pytest.mark.parametrize('nb_processes', [1, 2])
+def test_gdal2tiles_py_pipeline(nb_processes):
+    """
+    Generating the base tiles with several threads per stage of the pipeline must produce the
+    same tiles as running the stages one after the other, and report the throughput of the stages
+    """
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    out_folders = ['tmp/out_gdal2tiles_pipeline_0', 'tmp/out_gdal2tiles_pipeline_3']
+    outputs = []
+    for out_folder, options in zip(out_folders, ['--pipeline-threads=0',
+                                                 '--pipeline-threads=3 --pipeline-queue-size=1']):
+        shutil.rmtree(out_folder, ignore_errors=True)
+        outputs.append(test_py_scripts.run_py_script_as_external_script(
+            script_path,
+            'gdal2tiles',
+            '-v --processes=%d %s -z 0-3 ../gdrivers/data/small_world.tif %s' % (
+                nb_processes, options, out_folder)))
+
+    try:
+        for output in outputs:
+            assert 'Time per phase:' in output
+            assert '\twrite: 64 tiles' in output
+
+        for tz, nb_tiles in enumerate([1, 2, 4, 8]):
+            for tx in range(nb_tiles):
+                for ty in range(nb_tiles):
+                    tile = os.path.join(str(tz), str(tx), '%d.png' % ty)
+                    cs = []
+                    for out_folder in out_folders:
+                        ds = gdal.Open(os.path.join(out_folder, tile))
+                        assert ds is not None, ('%s missing in %s' % (tile, out_folder))
+                        cs.append([ds.GetRasterBand(i + 1).Checksum() for i in range(4)])
+                        ds = None
+                    assert cs[0] == cs[1], tile
+    finally:
+        for out_folder in out_folders:
+            shutil.rmtree(out_folder, ignore_errors=True)
+
+
+@pytest.mark.parametrize('nb_processes', [1, 2])
+def test_gdal2tiles_py_stats(nb_processes):
+    """
+    The --stats file must account for all the tiles generated, by all the processes
+    """
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    out_folder = 'tmp/out_gdal2tiles_stats'
+    stats_file = 'tmp/out_gdal2tiles_stats.json'
+    shutil.rmtree(out_folder, ignore_errors=True)
+    test_py_scripts.run_py_script_as_external_script(
+        script_path,
+        'gdal2tiles',
+        '-q --processes=%d --stats=%s -z 0-3 ../gdrivers/data/small_world.tif %s' % (
+            nb_processes, stats_file, out_folder))
+
+    try:
+        with open(stats_file) as f:
+            stats = json.load(f)
+
+        nb_bytes = 0
+        for root, _, files in os.walk(out_folder):
+            nb_bytes += sum(os.path.getsize(os.path.join(root, f))
+                            for f in files if f.endswith('.png'))
+
+        assert stats['totals']['tiles'] == 1 + 4 + 16 + 64
+        assert stats['totals']['bytes'] == nb_bytes
+        assert [stats['zooms'][str(tz)]['tiles'] for tz in range(4)] == [1, 4, 16, 64]
+        assert stats['totals']['skipped_empty'] == 0
+        for phase in ('read', 'resample', 'encode', 'write'):
+            assert stats['phases'][phase]['tiles'] == 64
+        for phase in ('overview_resample', 'overview_encode', 'overview_write'):
+            assert stats['phases'][phase]['tiles'] == 1 + 4 + 16
+        assert stats['elapsed'] > 0
+    finally:
+        shutil.rmtree(out_folder, ignore_errors=True)
+        gdal.Unlink(stats_file)
+
+
+def test_gdal2tiles_py_shared_vrt():
+    """
+    The VRT of the input must be shared with the workers in /vsimem/, created by init_worker()
+    in the workers that do not inherit it by fork(), and removed at the end
+    """
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    sys.path.insert(0, script_path)
+    try:
+        import gdal2tiles
+    finally:
+        sys.path.remove(script_path)
+
+    out_folder = 'tmp/out_gdal2tiles_shared_vrt'
+    shutil.rmtree(out_folder, ignore_errors=True)
+    try:
+        input_file, out_folder, options = gdal2tiles.process_args(
+            ['-q', '-z', '0-1', '--processes', '1', '../gdrivers/data/small_world.tif',
+             out_folder])
+        conf, _, _ = gdal2tiles.worker_tile_details(input_file, out_folder, options)
+        assert conf.src_file.startswith('/vsimem/')
+
+        # As in a worker started without fork()
+        src_vrt = gdal2tiles.read_vsimem_file(conf.src_file)
+        gdal.Unlink(conf.src_file)
+        gdal2tiles.init_worker(conf.src_file, src_vrt, gdal.GetCacheMax())
+        ds = gdal.Open(conf.src_file)
+        assert ds is not None
+        assert ds.RasterCount == conf.nb_data_bands + 1
+        ds = None
+        gdal.Unlink(conf.src_file)
+
+        gdal2tiles.single_threaded_tiling(input_file, out_folder, options)
+        assert os.path.exists(os.path.join(out_folder, '1', '1', '1.png'))
+        assert not gdal.ReadDir('/vsimem/gdal2tiles')
+    finally:
+        shutil.rmtree(out_folder, ignore_errors=True)
+
+
+def test_gdal2tiles_py_overview_tile_error():
+    """
+    The exception raised by the job of an overview tile must be returned as its result, so that
+    it is raised by the main process, which would otherwise wait for it forever in Python 2
+    """
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    sys.path.insert(0, script_path)
+    try:
+        import gdal2tiles
+    finally:
+        sys.path.remove(script_path)
+
+    def create_overview_tile(*args):
+        raise ValueError('cannot create the overview tile')
+
+    result = gdal2tiles.run_and_collect_stats_or_error(create_overview_tile, None)
+    assert isinstance(result, ValueError)
+
+    result, _ = gdal2tiles.run_and_collect_stats_or_error(lambda x: x + 1, 1)
+    assert result == 2
+
+
+@pytest.mark.require_run_on_demand
+def test_gdal2tiles_py_tile_order_benchmark():
+    """
+    Benchmark of the bytes read from the input raster (as reported by /proc/self/io) when
+    rendering the base tiles in the different --tile-order, with a GDAL block cache smaller
+    than a row of blocks of the input raster
+    """
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None or not os.path.exists('/proc/self/io'):
+        pytest.skip()
+
+    sys.path.insert(0, script_path)
+    try:
+        import gdal2tiles
+    finally:
+        sys.path.remove(script_path)
+
+    def bytes_read():
+        with open('/proc/self/io') as f:
+            return int([l for l in f if l.startswith('rchar:')][0].split()[1])
+
+    input_file = 'tmp/gdal2tiles_tile_order_benchmark.tif'
+    gdal.Translate(input_file, '../gdrivers/data/small_world.tif', width=8192, height=4096,
+                   creationOptions=['TILED=YES', 'COMPRESS=DEFLATE'])
+
+    old_cache_max = gdal.GetCacheMax()
+    gdal.SetCacheMax(2 * 1024 * 1024)
+    results = {}
+    try:
+        for tile_order in gdal2tiles.tile_order_list:
+            out_folder = 'tmp/out_gdal2tiles_order_' + tile_order
+            shutil.rmtree(out_folder, ignore_errors=True)
+            input_file, out_folder, options = gdal2tiles.process_args(
+                ['-q', '--tile-order', tile_order, '-z', '5', '--processes', '1',
+                 input_file, out_folder])
+            start = bytes_read()
+            gdal2tiles.single_threaded_tiling(input_file, out_folder, options)
+            results[tile_order] = bytes_read() - start
+            shutil.rmtree(out_folder, ignore_errors=True)
+    finally:
+        gdal.SetCacheMax(old_cache_max)
+        gdal.Unlink(input_file)
+
+    print('')
+    for tile_order in gdal2tiles.tile_order_list:
+        print('--tile-order=%s: %.1f MB read' % (tile_order, results[tile_order] / 1e6))
+    assert results['hilbert'] <= results['row']
+
+
+@pytest.mark.parametrize('output_format', ['mbtiles', 'gpkg'])
+def test_gdal2tiles_py_single_file_output(output_format):
+    try:
+        import sqlite3
+    except ImportError:
+        pytest.skip()
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    output_file = 'tmp/out_gdal2tiles_smallworld.' + output_format
+    gdal.Unlink(output_file)
+
+    test_py_scripts.run_py_script_as_external_script(
+        script_path,
+        'gdal2tiles',
+        '-q --processes=2 -z 0-2 ../gdrivers/data/small_world.tif %s' % output_file)
+
+    try:
+        ds = gdal.Open(output_file)
+        assert ds is not None, ('cannot open %s' % output_file)
+        ds = None
+
+        conn = sqlite3.connect(output_file)
+        nb_tiles = conn.execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+        assert nb_tiles == 1 + 4 + 16
+        tile_data = conn.execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level = 0').fetchone()[0]
+        conn.close()
+
+        gdal.FileFromMemBuffer('/vsimem/gdal2tiles_tile.png', bytes(tile_data))
+        ds = gdal.Open('/vsimem/gdal2tiles_tile.png')
+        expected_cs = [25314, 28114, 6148, 59026]
+        assert [ds.GetRasterBand(i + 1).Checksum() for i in range(4)] == expected_cs
+        ds = None
+        gdal.Unlink('/vsimem/gdal2tiles_tile.png')
+    finally:
+        gdal.Unlink(output_file)
+
+
+def test_gdal2tiles_py_antialias():
+    """
+    The 'antialias' resampling must produce the same tiles in a directory and in a MBTiles file
+    """
+    pytest.importorskip('numpy')
+    try:
+        import sqlite3
+    except ImportError:
+        pytest.skip()
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    out_folder = 'tmp/out_gdal2tiles_antialias'
+    output_file = 'tmp/out_gdal2tiles_antialias.mbtiles'
+    shutil.rmtree(out_folder, ignore_errors=True)
+    gdal.Unlink(output_file)
+    for output in (out_folder, output_file):
+        test_py_scripts.run_py_script_as_external_script(
+            script_path,
+            'gdal2tiles',
+            '-q -r antialias -z 0-2 ../gdrivers/data/small_world.tif %s' % output)
+
+    try:
+        conn = sqlite3.connect(output_file)
+        tiles = conn.execute(
+            'SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles').fetchall()
+        conn.close()
+        assert len(tiles) == 1 + 4 + 16
+
+        for tz, tx, ty, tile_data in tiles:
+            gdal.FileFromMemBuffer('/vsimem/gdal2tiles_tile.png', bytes(tile_data))
+            ds = gdal.Open('/vsimem/gdal2tiles_tile.png')
+            cs = [ds.GetRasterBand(i + 1).Checksum() for i in range(4)]
+            ds = None
+            gdal.Unlink('/vsimem/gdal2tiles_tile.png')
+
+            ds = gdal.Open(os.path.join(out_folder, str(tz), str(tx), '%d.png' % ty))
+            assert [ds.GetRasterBand(i + 1).Checksum() for i in range(4)] == cs
+            ds = None
+    finally:
+        shutil.rmtree(out_folder, ignore_errors=True)
+        gdal.Unlink(output_file)
+
+
+def test_gdal2tiles_py_antialias_values():
+    """
+    The 'antialias' resampling must keep a constant tile, average a checkerboard and not bleed
+    the values of the transparent pixels
+    """
+    numpy = pytest.importorskip('numpy')
+
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    sys.path.insert(0, script_path)
+    try:
+        import gdal2tiles
+    finally:
+        sys.path.remove(script_path)
+
+    array = numpy.empty((4, 1024, 1024), numpy.uint8)
+    array[0], array[1], array[2], array[3] = 10, 20, 30, 255
+    out = gdal2tiles.antialias_downsample(array, 256)
+    assert out.shape == (4, 256, 256)
+    for i, value in enumerate((10, 20, 30, 255)):
+        assert (out[i] == value).all()
+
+    checkerboard = (numpy.indices((1024, 1024)).sum(axis=0) % 2 * 255).astype(numpy.uint8)
+    array = numpy.stack([checkerboard] * 3 + [numpy.full((1024, 1024), 255, numpy.uint8)])
+    out = gdal2tiles.antialias_downsample(array, 256)
+    assert abs(out[:3].astype(float) - 127.5).max() <= 1
+    assert (out[3] == 255).all()
+
+    # White transparent pixels on the left, black opaque pixels on the right
+    array = numpy.zeros((4, 1024, 1024), numpy.uint8)
+    array[:3, :, :512] = 255
+    array[3, :, 512:] = 255
+    out = gdal2tiles.antialias_downsample(array, 256)
+    assert (out[:3] == 0).all()
+    assert (out[3, :, :120] == 0).all()
+    assert (out[3, :, 136:] == 255).all()
+
+
 def test_does_not_error_when_source_bounds_close_to_tiles_bound():
     """
     Case where the border coordinate of the input file is inside a tile T but the first pixel is
@@ -314,5 +956,93 @@ def test_exclude_transparent_tiles():
         shutil.rmtree(output_folder)
 
 
+def test_exclude_transparent_tiles_with_mask_overviews():
+    """
+    With --exclude, the overviews of the mask used when planning the base tiles must not change
+    the generated tileset
+    """
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    input_file = 'tmp/test_exclude_transparent_tiles_ovr.tif'
+    gdal.Translate(input_file, 'data/test_gdal2tiles_exclude_transparent.tif')
+    ds = gdal.Open(input_file, gdal.GA_Update)
+    ds.BuildOverviews('AVERAGE', [2, 4, 8])
+    ds = None
+
+    output_folders = ['tmp/test_exclude_transparent_tiles_no_ovr',
+                      'tmp/test_exclude_transparent_tiles_ovr']
+    try:
+        tilesets = []
+        for output_folder, tiled_file, verbosity in zip(
+                output_folders, ['data/test_gdal2tiles_exclude_transparent.tif', input_file],
+                ['-q', '-v']):
+            shutil.rmtree(output_folder, ignore_errors=True)
+            ret = test_py_scripts.run_py_script_as_external_script(
+                script_path,
+                'gdal2tiles',
+                '%s -x -z 14-16 %s %s' % (verbosity, tiled_file, output_folder))
+
+            tiles = []
+            for root, _, files in os.walk(output_folder):
+                tiles += [os.path.join(os.path.relpath(root, output_folder), f)
+                          for f in files if f.endswith('.png')]
+            tilesets.append(sorted(tiles))
+
+        assert 'Empty tiles detected from the mask overview' in ret
+
+        assert tilesets[0]
+        assert tilesets[0] == tilesets[1]
+    finally:
+        gdal.Unlink(input_file)
+        for output_folder in output_folders:
+            shutil.rmtree(output_folder, ignore_errors=True)
 
 
+def test_exclude_transparent_tiles_with_nearest_mask_overviews():
+    """
+    With --exclude, a tile with a single valid pixel missed by the NEAREST overviews of the mask
+    must still be generated, the tiles without data in the sparse input being skipped when
+    planning them
+    """
+    script_path = test_py_scripts.get_py_script('gdal2tiles')
+    if script_path is None:
+        pytest.skip()
+
+    # The whole world in EPSG:3857 at zoom level 2, transparent but for the pixel (333, 333),
+    # which the NEAREST overviews do not sample, with a block per base tile only written for
+    # the tile 2/1/2
+    input_file = 'tmp/test_exclude_transparent_tiles_nearest_ovr.tif'
+    ds = gdal.GetDriverByName('GTiff').Create(input_file, 1024, 1024, 2,
+                                              options=['SPARSE_OK=TRUE', 'TILED=YES',
+                                                       'BLOCKXSIZE=256', 'BLOCKYSIZE=256'])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3857)
+    ds.SetProjection(srs.ExportToWkt())
+    extent = 20037508.342789244
+    ds.SetGeoTransform([-extent, 2 * extent / 1024, 0, extent, 0, -2 * extent / 1024])
+    ds.GetRasterBand(2).SetColorInterpretation(gdal.GCI_AlphaBand)
+    ds.GetRasterBand(1).WriteRaster(333, 333, 1, 1, b'\xff')
+    ds.GetRasterBand(2).WriteRaster(333, 333, 1, 1, b'\xff')
+    ds.BuildOverviews('NEAREST', [2, 4, 8])
+    ds = None
+
+    output_folder = 'tmp/test_exclude_transparent_tiles_nearest_ovr'
+    shutil.rmtree(output_folder, ignore_errors=True)
+    try:
+        ret = test_py_scripts.run_py_script_as_external_script(
+            script_path,
+            'gdal2tiles',
+            '-v -x -z 0-2 %s %s' % (input_file, output_folder))
+
+        assert 'Empty tiles detected from the mask overview' in ret
+        assert 'Tile generation skipped because the tile is empty' in ret
+
+        base_tiles = sorted(os.path.join(root[len(output_folder) + 1:], f)
+                            for root, _, files in os.walk(os.path.join(output_folder, '2'))
+                            for f in files if f.endswith('.png'))
+        assert base_tiles == [os.path.join('2', '1', '2.png')]
+    finally:
+        gdal.Unlink(input_file)
+        shutil.rmtree(output_folder, ignore_errors=True)
@@ -306,6 +306,335 @@ def test_gdal_calc_py_7():
     ds3 = None
     ds4 = None
 
+###############################################################################
+# test --threads
+
+
+def test_gdal_calc_py_8():
+
+    if gdalnumeric_not_available:
+        pytest.skip('gdalnumeric is not available, skipping all tests')
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        pytest.skip()
+
+    shutil.copy('../gcore/data/stefan_full_rgba.tif', 'tmp/test_gdal_calc_py.tif')
+
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif --allBands A --calc=A --threads 4 --overwrite --outfile tmp/test_gdal_calc_py_8_1.tif')
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif --A_band 1 -B tmp/test_gdal_calc_py.tif --B_band 2 --calc=A+B --threads 3 --overwrite --outfile tmp/test_gdal_calc_py_8_2.tif')
+
+    ds1 = gdal.Open('tmp/test_gdal_calc_py_8_1.tif')
+    ds2 = gdal.Open('tmp/test_gdal_calc_py_8_2.tif')
+
+    assert ds1 is not None, 'ds1 not found'
+    assert ds2 is not None, 'ds2 not found'
+
+    # same results as the single threaded runs of test_gdal_calc_py_2 and test_gdal_calc_py_3
+    assert ds1.GetRasterBand(1).Checksum() == 12603, 'band 1 wrong checksum'
+    assert ds1.GetRasterBand(2).Checksum() == 58561, 'band 2 wrong checksum'
+    assert ds1.GetRasterBand(3).Checksum() == 36064, 'band 3 wrong checksum'
+    assert ds1.GetRasterBand(4).Checksum() == 10807, 'band 4 wrong checksum'
+    assert ds2.GetRasterBand(1).Checksum() == 12368, 'ds2 wrong checksum'
+
+    ds1 = None
+    ds2 = None
+
+###############################################################################
+# test --backend and the checks of the calculation
+
+
+def test_gdal_calc_py_9():
+
+    if gdalnumeric_not_available:
+        pytest.skip('gdalnumeric is not available, skipping all tests')
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        pytest.skip()
+
+    backup_sys_path = sys.path
+    sys.path.insert(0, script_path)
+    import gdal_calc
+
+    shutil.copy('../gcore/data/stefan_full_rgba.tif', 'tmp/test_gdal_calc_py.tif')
+
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif --A_band 1 -B tmp/test_gdal_calc_py.tif --B_band 2 --calc=A+B --backend chunked --overwrite --outfile tmp/test_gdal_calc_py_9_1.tif')
+
+    with pytest.raises(Exception, match='neither input layers nor functions'):
+        gdal_calc.Calc('A+C', A='tmp/test_gdal_calc_py.tif', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_9_2.tif')
+    with pytest.raises(Exception, match='invalid calculation'):
+        gdal_calc.Calc('A+', A='tmp/test_gdal_calc_py.tif', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_9_2.tif')
+    with pytest.raises(Exception, match='only supports element-wise calculations'):
+        gdal_calc.Calc('A-A.mean()', A='tmp/test_gdal_calc_py.tif', backend='chunked', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_9_2.tif')
+    with pytest.raises(Exception, match='only supports element-wise calculations'):
+        gdal_calc.Calc('A.mean()', A='tmp/test_gdal_calc_py.tif', backend='chunked', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_9_2.tif')
+    for calc in ('A[::-1]', 'numpy.roll(A, 1)', 'A.T', 'cumsum(A)'):
+        with pytest.raises(Exception, match='only supports element-wise calculations'):
+            gdal_calc.Calc(calc, A='tmp/test_gdal_calc_py.tif', backend='chunked', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_9_2.tif')
+
+    if gdal_calc.numexpr is not None:
+        gdal_calc.Calc('A+B', A='tmp/test_gdal_calc_py.tif', B='tmp/test_gdal_calc_py.tif', B_band=2, backend='numexpr', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_9_2.tif')
+        ds = gdal.Open('tmp/test_gdal_calc_py_9_2.tif')
+        assert ds.GetRasterBand(1).Checksum() == 12368, 'numexpr backend wrong checksum'
+        ds = None
+
+    sys.path = backup_sys_path
+
+    ds = gdal.Open('tmp/test_gdal_calc_py_9_1.tif')
+    assert ds is not None, 'ds not found'
+    assert ds.GetRasterBand(1).Checksum() == 12368, 'chunked backend wrong checksum'
+    ds = None
+
+###############################################################################
+# test --max-memory and the size of the processing windows
+
+
+def test_gdal_calc_py_10():
+
+    if gdalnumeric_not_available:
+        pytest.skip('gdalnumeric is not available, skipping all tests')
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        pytest.skip()
+
+    backup_sys_path = sys.path
+    sys.path.insert(0, script_path)
+    import gdal_calc
+
+    # full-width strips of as many blocks as fit in the budget
+    assert gdal_calc.GetWindowSize([(100, 1), (100, 1)], (100, 50000), 40, 64 * 1024 * 1024) == [100, 16777]
+    # aligned on the blocks of all the rasters
+    assert gdal_calc.GetWindowSize([(256, 256), (128, 128)], (10000, 10000), 10, 4 * 1024 * 1024) == [1536, 256]
+    # never smaller than a block of the first raster
+    assert gdal_calc.GetWindowSize([(512, 512), (384, 384)], (40000, 40000), 40, 1024 * 1024) == [512, 512]
+
+    sys.path = backup_sys_path
+
+    # one-line strips, processed in windows of several strips
+    gdal.Translate('tmp/test_gdal_calc_py.tif', '../gcore/data/stefan_full_rgba.tif', options='-co BLOCKYSIZE=1')
+
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif --allBands A --calc=A --max-memory 1 --overwrite --outfile tmp/test_gdal_calc_py_10.tif')
+
+    ds = gdal.Open('tmp/test_gdal_calc_py_10.tif')
+    assert ds is not None, 'ds not found'
+    assert ds.GetRasterBand(1).Checksum() == 12603, 'band 1 wrong checksum'
+    assert ds.GetRasterBand(2).Checksum() == 58561, 'band 2 wrong checksum'
+    assert ds.GetRasterBand(3).Checksum() == 36064, 'band 3 wrong checksum'
+    assert ds.GetRasterBand(4).Checksum() == 10807, 'band 4 wrong checksum'
+    ds = None
+
+###############################################################################
+# test nodata from a mask band
+
+
+def test_gdal_calc_py_11():
+
+    if gdalnumeric_not_available:
+        pytest.skip('gdalnumeric is not available, skipping all tests')
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        pytest.skip()
+
+    import numpy
+
+    backup_sys_path = sys.path
+    sys.path.insert(0, script_path)
+    import gdal_calc
+
+    gdal.Translate('tmp/test_gdal_calc_py_11_src.tif', '../gcore/data/byte.tif')
+    ds = gdal.Open('tmp/test_gdal_calc_py_11_src.tif', gdal.GA_Update)
+    ds.CreateMaskBand(gdal.GMF_PER_DATASET)
+    ds.GetRasterBand(1).GetMaskBand().Fill(255)
+    ds.GetRasterBand(1).GetMaskBand().WriteRaster(0, 0, 20, 10, b'\x00' * 200)
+    ds = None
+
+    gdal_calc.Calc('A', A='tmp/test_gdal_calc_py_11_src.tif', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_11.tif', NoDataValue=0)
+    gdal_calc.Calc('A', A='tmp/test_gdal_calc_py_11_src.tif', type='Float32', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_11_float32.tif')
+
+    # the results are only promoted to float64 for a nodata value float32 cannot hold
+    assert gdal_calc.GetNoDataType(0) == numpy.uint8
+    assert gdal_calc.GetNoDataType(-32767) == numpy.int16
+    assert gdal_calc.GetNoDataType(0.5) == numpy.float32
+    assert gdal_calc.GetNoDataType(0.1) == numpy.float64
+    assert gdal_calc.GetNoDataType(0.1, 'Float32') == numpy.float32
+    assert gdal_calc.GetNoDataType(gdal_calc.DefaultNDVLookup['Float32'], 'Float32') == numpy.float32
+    assert gdal_calc.GetNoDataType(gdal_calc.DefaultNDVLookup['Float64'], 'Float64') == numpy.float64
+
+    sys.path = backup_sys_path
+
+    src_ds = gdal.Open('tmp/test_gdal_calc_py_11_src.tif')
+    ds = gdal.Open('tmp/test_gdal_calc_py_11.tif')
+    assert ds.GetRasterBand(1).DataType == gdal.GDT_Byte
+    data = ds.GetRasterBand(1).ReadAsArray()
+    src_data = src_ds.GetRasterBand(1).ReadAsArray()
+    assert (data[:10] == 0).all()
+    assert (data[10:] == src_data[10:]).all()
+    ds = None
+
+    ds = gdal.Open('tmp/test_gdal_calc_py_11_float32.tif')
+    assert ds.GetRasterBand(1).DataType == gdal.GDT_Float32
+    data = ds.GetRasterBand(1).ReadAsArray()
+    assert (data[:10] == numpy.float32(gdal_calc.DefaultNDVLookup['Float32'])).all()
+    assert (data[10:] == src_data[10:]).all()
+    ds = None
+    src_ds = None
+
+###############################################################################
+# test that the inputs not used by the calculation are skipped, and that the
+# inputs not iterated by --allBands are shared by the bands
+
+
+def test_gdal_calc_py_12():
+
+    if gdalnumeric_not_available:
+        pytest.skip('gdalnumeric is not available, skipping all tests')
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        pytest.skip()
+
+    shutil.copy('../gcore/data/stefan_full_rgba.tif', 'tmp/test_gdal_calc_py.tif')
+
+    ret = test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif -B tmp/test_gdal_calc_py.tif --allBands A --calc="A if True else B" --debug --overwrite --outfile tmp/test_gdal_calc_py_12_1.tif')
+    assert 'file B is not used by the calculation' in ret
+
+    ds = gdal.Open('tmp/test_gdal_calc_py_12_1.tif')
+    assert ds.GetRasterBand(1).Checksum() == 12603, 'band 1 wrong checksum'
+    assert ds.GetRasterBand(2).Checksum() == 58561, 'band 2 wrong checksum'
+    assert ds.GetRasterBand(3).Checksum() == 36064, 'band 3 wrong checksum'
+    assert ds.GetRasterBand(4).Checksum() == 10807, 'band 4 wrong checksum'
+    ds = None
+
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif -B tmp/test_gdal_calc_py.tif --B_band 4 --allBands A --calc="A*(B>0)" --overwrite --outfile tmp/test_gdal_calc_py_12_2.tif')
+    for band in (1, 2, 3):
+        test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif --A_band %d -B tmp/test_gdal_calc_py.tif --B_band 4 --calc="A*(B>0)" --overwrite --outfile tmp/test_gdal_calc_py_12_3.tif' % band)
+        ds = gdal.Open('tmp/test_gdal_calc_py_12_2.tif')
+        ref_ds = gdal.Open('tmp/test_gdal_calc_py_12_3.tif')
+        assert ds.GetRasterBand(band).Checksum() == ref_ds.GetRasterBand(1).Checksum(), 'band %d wrong checksum' % band
+        ds = None
+        ref_ds = None
+
+    # only the nodata mask of an input with a nodata value is read when it is not used
+    src_ds = gdal.Open('../gcore/data/byte.tif')
+    src_data = src_ds.GetRasterBand(1).ReadAsArray()
+    gdal.Translate('tmp/test_gdal_calc_py_12_nodata.tif', src_ds, noData=int(src_data[0, 0]))
+    src_ds = None
+    ret = test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A ../gcore/data/byte.tif -B tmp/test_gdal_calc_py_12_nodata.tif --calc=A --NoDataValue=0 --debug --overwrite --outfile tmp/test_gdal_calc_py_12_4.tif')
+    assert 'file B is not used by the calculations, only reading its nodata mask' in ret
+
+    ds = gdal.Open('tmp/test_gdal_calc_py_12_4.tif')
+    data = ds.GetRasterBand(1).ReadAsArray()
+    assert (data[src_data == src_data[0, 0]] == 0).all()
+    assert (data[src_data != src_data[0, 0]] == src_data[src_data != src_data[0, 0]]).all()
+    ds = None
+
+###############################################################################
+# test several calculations in a single pass
+
+
+def test_gdal_calc_py_13():
+
+    if gdalnumeric_not_available:
+        pytest.skip('gdalnumeric is not available, skipping all tests')
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        pytest.skip()
+
+    backup_sys_path = sys.path
+    sys.path.insert(0, script_path)
+    import gdal_calc
+
+    shutil.copy('../gcore/data/stefan_full_rgba.tif', 'tmp/test_gdal_calc_py.tif')
+
+    # one output file per calculation
+    test_py_scripts.run_py_script(script_path, 'gdal_calc', '-A tmp/test_gdal_calc_py.tif --A_band 1 -B tmp/test_gdal_calc_py.tif --B_band 2 --calc=A+B --outfile tmp/test_gdal_calc_py_13_1.tif --calc=A*B --outfile tmp/test_gdal_calc_py_13_2.tif --overwrite')
+
+    # one band per calculation
+    gdal_calc.Calc(['A+B', 'A*B'], A='tmp/test_gdal_calc_py.tif', B='tmp/test_gdal_calc_py.tif', B_band=2, overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_13_3.tif')
+
+    with pytest.raises(Exception, match='2 calculations were given for 3 output files'):
+        gdal_calc.Calc(['A+B', 'A*B'], A='tmp/test_gdal_calc_py.tif', B='tmp/test_gdal_calc_py.tif', overwrite=True, quiet=True, outfile=['tmp/test_gdal_calc_py_13_1.tif', 'tmp/test_gdal_calc_py_13_2.tif', 'tmp/test_gdal_calc_py_13_3.tif'])
+
+    sys.path = backup_sys_path
+
+    # same results as test_gdal_calc_py_2
+    ds1 = gdal.Open('tmp/test_gdal_calc_py_13_1.tif')
+    ds2 = gdal.Open('tmp/test_gdal_calc_py_13_2.tif')
+    ds3 = gdal.Open('tmp/test_gdal_calc_py_13_3.tif')
+    assert ds1.GetRasterBand(1).Checksum() == 12368, 'ds1 wrong checksum'
+    assert ds2.GetRasterBand(1).Checksum() == 62785, 'ds2 wrong checksum'
+    assert ds3.RasterCount == 2
+    assert ds3.GetRasterBand(1).Checksum() == 12368, 'ds3 band 1 wrong checksum'
+    assert ds3.GetRasterBand(2).Checksum() == 62785, 'ds3 band 2 wrong checksum'
+    ds1 = None
+    ds2 = None
+    ds3 = None
+
+###############################################################################
+# test --extent
+
+
+def test_gdal_calc_py_14():
+
+    if gdalnumeric_not_available:
+        pytest.skip('gdalnumeric is not available, skipping all tests')
+
+    script_path = test_py_scripts.get_py_script('gdal_calc')
+    if script_path is None:
+        pytest.skip()
+
+    backup_sys_path = sys.path
+    sys.path.insert(0, script_path)
+    import gdal_calc
+
+    # two overlapping parts of byte.tif
+    gdal.Translate('tmp/test_gdal_calc_py_14_a.tif', '../gcore/data/byte.tif', options='-srcwin 0 0 15 15')
+    gdal.Translate('tmp/test_gdal_calc_py_14_b.tif', '../gcore/data/byte.tif', options='-srcwin 5 5 15 15')
+
+    with pytest.raises(Exception, match='Dimensions of file'):
+        gdal_calc.Calc('A', A='tmp/test_gdal_calc_py_14_a.tif', B='tmp/test_gdal_calc_py_14_b.tif', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_14_1.tif', NoDataValue=0)
+
+    gdal_calc.Calc(['A', 'B'], A='tmp/test_gdal_calc_py_14_a.tif', B='tmp/test_gdal_calc_py_14_b.tif', extent='intersect', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_14_1.tif', NoDataValue=0)
+    gdal_calc.Calc('uint16(A)+B', A='tmp/test_gdal_calc_py_14_a.tif', B='tmp/test_gdal_calc_py_14_b.tif', extent='union', type='UInt16', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_14_2.tif', NoDataValue=0)
+    gdal_calc.Calc('B', A='tmp/test_gdal_calc_py_14_a.tif', B='tmp/test_gdal_calc_py_14_b.tif', extent='A', overwrite=True, quiet=True, outfile='tmp/test_gdal_calc_py_14_3.tif', NoDataValue=0)
+
+    sys.path = backup_sys_path
+
+    src_ds = gdal.Open('../gcore/data/byte.tif')
+    src_data = src_ds.GetRasterBand(1).ReadAsArray()
+    src_gt = src_ds.GetGeoTransform()
+
+    ds = gdal.Open('tmp/test_gdal_calc_py_14_1.tif')
+    assert (ds.RasterXSize, ds.RasterYSize) == (10, 10)
+    assert ds.GetGeoTransform() == pytest.approx((src_gt[0] + 5 * src_gt[1], src_gt[1], 0, src_gt[3] + 5 * src_gt[5], 0, src_gt[5]))
+    assert (ds.GetRasterBand(1).ReadAsArray() == src_data[5:15, 5:15]).all()
+    assert (ds.GetRasterBand(2).ReadAsArray() == src_data[5:15, 5:15]).all()
+
+    ds = gdal.Open('tmp/test_gdal_calc_py_14_2.tif')
+    assert (ds.RasterXSize, ds.RasterYSize) == (20, 20)
+    assert ds.GetGeoTransform() == pytest.approx(src_gt)
+    data = ds.GetRasterBand(1).ReadAsArray()
+    assert (data[5:15, 5:15] == 2 * src_data[5:15, 5:15].astype(int)).all()
+    # outside of either input, even where the other one has values
+    assert (data[0:5] == 0).all()
+    assert (data[:, 0:5] == 0).all()
+    assert (data[15:20] == 0).all()
+    assert (data[:, 15:20] == 0).all()
+
+    ds = gdal.Open('tmp/test_gdal_calc_py_14_3.tif')
+    assert (ds.RasterXSize, ds.RasterYSize) == (15, 15)
+    assert ds.GetGeoTransform() == pytest.approx(src_gt)
+    data = ds.GetRasterBand(1).ReadAsArray()
+    assert (data[5:15, 5:15] == src_data[5:15, 5:15]).all()
+    assert (data[0:5] == 0).all()
+    assert (data[:, 0:5] == 0).all()
+    ds = None
+    src_ds = None
+
 def test_gdal_calc_py_cleanup():
 
     lst = ['tmp/test_gdal_calc_py.tif',
@@ -327,6 +656,28 @@ def test_gdal_calc_py_cleanup():
            'tmp/test_gdal_calc_py_7_2.tif',
            'tmp/test_gdal_calc_py_7_3.tif',
            'tmp/test_gdal_calc_py_7_4.tif',
+           'tmp/test_gdal_calc_py_8_1.tif',
+           'tmp/test_gdal_calc_py_8_2.tif',
+           'tmp/test_gdal_calc_py_9_1.tif',
+           'tmp/test_gdal_calc_py_9_2.tif',
+           'tmp/test_gdal_calc_py_10.tif',
+           'tmp/test_gdal_calc_py_11.tif',
+           'tmp/test_gdal_calc_py_11_float32.tif',
+           'tmp/test_gdal_calc_py_11_src.tif',
+           'tmp/test_gdal_calc_py_11_src.tif.msk',
+           'tmp/test_gdal_calc_py_12_1.tif',
+           'tmp/test_gdal_calc_py_12_2.tif',
+           'tmp/test_gdal_calc_py_12_3.tif',
+           'tmp/test_gdal_calc_py_12_4.tif',
+           'tmp/test_gdal_calc_py_12_nodata.tif',
+           'tmp/test_gdal_calc_py_13_1.tif',
+           'tmp/test_gdal_calc_py_13_2.tif',
+           'tmp/test_gdal_calc_py_13_3.tif',
+           'tmp/test_gdal_calc_py_14_a.tif',
+           'tmp/test_gdal_calc_py_14_b.tif',
+           'tmp/test_gdal_calc_py_14_1.tif',
+           'tmp/test_gdal_calc_py_14_2.tif',
+           'tmp/test_gdal_calc_py_14_3.tif',
            'tmp/opt1',
            'tmp/opt2',
            'tmp/opt3',
@@ -29,6 +29,7 @@
 ###############################################################################
 
 
+import json
 import os
 
 
@@ -211,6 +212,203 @@ def test_gdal_merge_5():
     assert ds.GetRasterBand(3).Checksum() == 0, 'Wrong checksum'
     assert ds.GetRasterBand(4).Checksum() == cs, 'Wrong checksum'
 
+###############################################################################
+# Test -blockwise
+
+
+def test_gdal_merge_6():
+    try:
+        from osgeo import gdalnumeric
+        gdalnumeric.BandRasterIONumPy
+    except (ImportError, AttributeError):
+        pytest.skip()
+
+    script_path = test_py_scripts.get_py_script('gdal_merge')
+    if script_path is None:
+        pytest.skip()
+
+    # Same results as test_gdal_merge_2, test_gdal_merge_4 and test_gdal_merge_5
+    test_py_scripts.run_py_script(script_path, 'gdal_merge', '-q -blockwise -o tmp/test_gdal_merge_6_1.tif tmp/in1.tif tmp/in2.tif tmp/in3.tif tmp/in4.tif')
+    ds = gdal.Open('tmp/test_gdal_merge_6_1.tif')
+    assert ds.GetRasterBand(1).Checksum() == 3508, 'Wrong checksum'
+    ds = None
+
+    test_py_scripts.run_py_script(script_path, 'gdal_merge', '-q -blockwise -init 255 -o tmp/test_gdal_merge_6_2.tif tmp/in2.tif tmp/in3.tif')
+    ds = gdal.Open('tmp/test_gdal_merge_6_2.tif')
+    assert ds.GetRasterBand(1).Checksum() == 4725, 'Wrong checksum'
+    ds = None
+
+    ds = gdal.Open('tmp/in6.tif')
+    cs = ds.GetRasterBand(4).Checksum()
+    ds = None
+
+    for inputs in ('tmp/in5.tif tmp/in6.tif', 'tmp/in6.tif tmp/in5.tif'):
+        test_py_scripts.run_py_script(script_path, 'gdal_merge', '-q -blockwise -o tmp/test_gdal_merge_6_3.tif ' + inputs)
+        ds = gdal.Open('tmp/test_gdal_merge_6_3.tif')
+        assert ds.GetRasterBand(1).Checksum() == 0, 'Wrong checksum'
+        assert ds.GetRasterBand(2).Checksum() == cs, 'Wrong checksum'
+        assert ds.GetRasterBand(3).Checksum() == 0, 'Wrong checksum'
+        assert ds.GetRasterBand(4).Checksum() == cs, 'Wrong checksum'
+        ds = None
+        os.unlink('tmp/test_gdal_merge_6_3.tif')
+
+    # -n, -separate and resampling, against the merge file by file
+    for options in ('-n 63', '-separate', '-ps 0.07 0.07', '-ps 0.13 0.13 -n 63'):
+        test_py_scripts.run_py_script(script_path, 'gdal_merge', '-q %s -o tmp/test_gdal_merge_6_4.tif tmp/in1.tif tmp/in2.tif tmp/in3.tif tmp/in4.tif' % options)
+        test_py_scripts.run_py_script(script_path, 'gdal_merge', '-q -blockwise %s -o tmp/test_gdal_merge_6_5.tif tmp/in1.tif tmp/in2.tif tmp/in3.tif tmp/in4.tif' % options)
+        ref_ds = gdal.Open('tmp/test_gdal_merge_6_4.tif')
+        ds = gdal.Open('tmp/test_gdal_merge_6_5.tif')
+        assert ds.RasterCount == ref_ds.RasterCount
+        for i in range(ds.RasterCount):
+            assert ds.GetRasterBand(i + 1).Checksum() == ref_ds.GetRasterBand(i + 1).Checksum(), options
+        ds = None
+        ref_ds = None
+        os.unlink('tmp/test_gdal_merge_6_4.tif')
+        os.unlink('tmp/test_gdal_merge_6_5.tif')
+
+###############################################################################
+# Test -threads
+
+
+def test_gdal_merge_7():
+    try:
+        from osgeo import gdalnumeric
+        gdalnumeric.BandRasterIONumPy
+    except (ImportError, AttributeError):
+        pytest.skip()
+
+    script_path = test_py_scripts.get_py_script('gdal_merge')
+    if script_path is None:
+        pytest.skip()
+
+    test_py_scripts.run_py_script(script_path, 'gdal_merge', '-q -threads 2 -co TILED=YES -co BLOCKXSIZE=16 -co BLOCKYSIZE=16 -o tmp/test_gdal_merge_7.tif tmp/in1.tif tmp/in2.tif tmp/in3.tif tmp/in4.tif')
+
+    ds = gdal.Open('tmp/test_gdal_merge_7.tif')
+    assert ds.GetRasterBand(1).Checksum() == 3508, 'Wrong checksum'
+    ds = None
+
+###############################################################################
+# Test -footprint_cache
+
+
+def test_gdal_merge_8():
+    try:
+        from osgeo import gdalnumeric
+        gdalnumeric.BandRasterIONumPy
+    except (ImportError, AttributeError):
+        pytest.skip()
+
+    script_path = test_py_scripts.get_py_script('gdal_merge')
+    if script_path is None:
+        pytest.skip()
+
+    names = ['tmp/in1.tif', 'tmp/in2.tif', 'tmp/in3.tif', 'tmp/in4.tif']
+    keys = [os.path.abspath(name) for name in names]
+    nad27 = osr.SpatialReference()
+    nad27.SetWellKnownGeogCS('NAD27')
+
+    for i in range(4):
+        if i == 1:
+            # A cached projection is used instead of opening the file, and
+            # the entries of the files not merged are dropped
+            with open('tmp/test_gdal_merge_8.json') as f:
+                cache = json.load(f)
+            cache['files'][keys[0]]['info']['projection'] = nad27.ExportToWkt()
+            cache['files'][os.path.abspath('tmp/not_merged.tif')] = cache['files'][keys[1]]
+            with open('tmp/test_gdal_merge_8.json', 'w') as f:
+                json.dump(cache, f)
+        elif i == 3:
+            # Until the file is modified
+            stat = os.stat(names[0])
+            os.utime(names[0], (stat.st_atime, stat.st_mtime + 10))
+
+        test_py_scripts.run_py_script(script_path, 'gdal_merge', '-q -threads 2 -footprint_cache tmp/test_gdal_merge_8.json -o tmp/test_gdal_merge_8.tif ' + ' '.join(names))
+
+        ds = gdal.Open('tmp/test_gdal_merge_8.tif')
+        assert ds.GetRasterBand(1).Checksum() == 3508, 'Wrong checksum'
+        if i in (1, 2):
+            assert ds.GetProjectionRef().find('NAD27') != -1
+        else:
+            assert ds.GetProjectionRef().find('WGS 84') != -1
+        ds = None
+        os.unlink('tmp/test_gdal_merge_8.tif')
+
+        with open('tmp/test_gdal_merge_8.json') as f:
+            cache = json.load(f)
+        assert sorted(cache['files']) == sorted(keys)
+
+###############################################################################
+# Test -max_memory
+
+
+def test_gdal_merge_9():
+    try:
+        from osgeo import gdalnumeric
+        gdalnumeric.BandRasterIONumPy
+    except (ImportError, AttributeError):
+        pytest.skip()
+
+    script_path = test_py_scripts.get_py_script('gdal_merge')
+    if script_path is None:
+        pytest.skip()
+
+    # Chunks of one 16x16 tile, for the copies with and without nodata,
+    # and for the windows of -blockwise
+    for options in ('', '-n 0', '-blockwise', '-blockwise -n 0'):
+        test_py_scripts.run_py_script(script_path, 'gdal_merge', '-q %s -co TILED=YES -co BLOCKXSIZE=16 -co BLOCKYSIZE=16 -max_memory 0.0001 -o tmp/test_gdal_merge_9.tif tmp/in1.tif tmp/in2.tif tmp/in3.tif tmp/in4.tif' % options)
+
+        ds = gdal.Open('tmp/test_gdal_merge_9.tif')
+        assert ds.GetRasterBand(1).Checksum() == 3508, options
+        ds = None
+        os.unlink('tmp/test_gdal_merge_9.tif')
+
+###############################################################################
+# Test -blend
+
+
+def test_gdal_merge_10():
+    try:
+        from osgeo import gdalnumeric
+        gdalnumeric.BandRasterIONumPy
+    except (ImportError, AttributeError):
+        pytest.skip()
+
+    script_path = test_py_scripts.get_py_script('gdal_merge')
+    if script_path is None:
+        pytest.skip()
+
+    drv = gdal.GetDriverByName('GTiff')
+    srs = osr.SpatialReference()
+    srs.SetWellKnownGeogCS('WGS84')
+    wkt = srs.ExportToWkt()
+
+    # Two files overlapping on 5 columns
+    ds = drv.Create('tmp/in7.tif', 10, 10, 1)
+    ds.SetProjection(wkt)
+    ds.SetGeoTransform([2, 0.1, 0, 49, 0, -0.1])
+    ds.GetRasterBand(1).Fill(10)
+    ds = None
+
+    ds = drv.Create('tmp/in8.tif', 10, 10, 1)
+    ds.SetProjection(wkt)
+    ds.SetGeoTransform([2.5, 0.1, 0, 49, 0, -0.1])
+    ds.GetRasterBand(1).Fill(30)
+    ds = None
+
+    test_py_scripts.run_py_script(script_path, 'gdal_merge', '-q -blend alpha -o tmp/test_gdal_merge_10.tif tmp/in7.tif tmp/in8.tif')
+
+    ds = gdal.Open('tmp/test_gdal_merge_10.tif')
+    assert list(ds.GetRasterBand(1).ReadAsArray()[5]) == [10] * 5 + [20] * 5 + [30] * 5
+    ds = None
+    os.unlink('tmp/test_gdal_merge_10.tif')
+
+    # Weights from the distance to the edge of the files
+    test_py_scripts.run_py_script(script_path, 'gdal_merge', '-q -blend feather -o tmp/test_gdal_merge_10.tif tmp/in7.tif tmp/in8.tif')
+
+    ds = gdal.Open('tmp/test_gdal_merge_10.tif')
+    assert list(ds.GetRasterBand(1).ReadAsArray()[5]) == [10] * 5 + [12, 16, 20, 24, 28] + [30] * 5
+    ds = None
+
 ###############################################################################
 # Cleanup
 
@@ -222,12 +420,24 @@ def test_gdal_merge_cleanup():
            'tmp/test_gdal_merge_3.tif',
            'tmp/test_gdal_merge_4.tif',
            'tmp/test_gdal_merge_5.tif',
+           'tmp/test_gdal_merge_6_1.tif',
+           'tmp/test_gdal_merge_6_2.tif',
+           'tmp/test_gdal_merge_6_3.tif',
+           'tmp/test_gdal_merge_6_4.tif',
+           'tmp/test_gdal_merge_6_5.tif',
+           'tmp/test_gdal_merge_7.tif',
+           'tmp/test_gdal_merge_8.tif',
+           'tmp/test_gdal_merge_8.json',
+           'tmp/test_gdal_merge_9.tif',
+           'tmp/test_gdal_merge_10.tif',
            'tmp/in1.tif',
            'tmp/in2.tif',
            'tmp/in3.tif',
            'tmp/in4.tif',
            'tmp/in5.tif',
-           'tmp/in6.tif']
+           'tmp/in6.tif',
+           'tmp/in7.tif',
+           'tmp/in8.tif']
     for filename in lst:
         try:
             os.remove(filename)
@@ -39,24 +39,37 @@
 
 from __future__ import print_function, division
 
+import hashlib
+import json
 import math
+from collections import OrderedDict
 from multiprocessing import Pool
 from functools import partial
+from itertools import islice
 import os
-import tempfile
 import threading
 import shutil
 import sys
+import time
 from uuid import uuid4
 from xml.etree import ElementTree
 
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
 from osgeo import gdal
 from osgeo import osr
 
 try:
-    from PIL import Image
+    import sqlite3
+except ImportError:
+    # 'mbtiles' and 'gpkg' outputs are not available
+    sqlite3 = None
+
+try:
     import numpy
-    import osgeo.gdal_array as gdalarray
     numpy_available = True
 except ImportError:
     # 'antialias' resampling is not available
@@ -67,9 +80,15 @@ __version__ = "$Id$"
 resampling_list = ('average', 'near', 'bilinear', 'cubic', 'cubicspline', 'lanczos', 'antialias')
 profile_list = ('mercator', 'geodetic', 'raster')
 webviewer_list = ('all', 'google', 'openlayers', 'leaflet', 'none')
+output_format_list = ('directory', 'mbtiles', 'gpkg')
+tile_order_list = ('hilbert', 'morton', 'row')
 
 threadLocal = threading.local()
 
+# Encoded content standing for an empty tile, that is not written. With --update, the tile left in
+# the output by a previous run is removed instead by OverviewTileScheduler.tile_done()
+EMPTY_TILE = b''
+
 # =============================================================================
 # =============================================================================
 # =============================================================================
@@ -596,7 +615,7 @@ def generate_kml(tx, ty, tz, tileext, tile_size, tileswne, options, children=Non
     return s
 
 
-def scale_query_to_tile(dsquery, dstile, tiledriver, options, tilefilename=''):
+def scale_query_to_tile(dsquery, dstile, options, tilefilename=''):
     """Scales down query dataset to the tile dataset"""
 
     querysize = dsquery.RasterXSize
@@ -616,17 +635,10 @@ def scale_query_to_tile(dsquery, dstile, tiledriver, options, tilefilename=''):
 
     elif options.resampling == 'antialias' and numpy_available:
 
-        # Scaling by PIL (Python Imaging Library) - improved Lanczos
-        array = numpy.zeros((querysize, querysize, tilebands), numpy.uint8)
-        for i in range(tilebands):
-            array[:, :, i] = gdalarray.BandReadAsArray(dsquery.GetRasterBand(i + 1),
-                                                       0, 0, querysize, querysize)
-        im = Image.fromarray(array, 'RGBA')     # Always four bands
-        im1 = im.resize((tile_size, tile_size), Image.ANTIALIAS)
-        if os.path.exists(tilefilename):
-            im0 = Image.open(tilefilename)
-            im1 = Image.composite(im1, im0, im1)
-        im1.save(tilefilename, tiledriver)
+        # Separable Lanczos filter stretched to the scale of the tile, computed by numpy
+        array = numpy.frombuffer(dsquery.ReadRaster(), numpy.uint8)
+        array = antialias_downsample(array.reshape(tilebands, querysize, querysize), tile_size)
+        dstile.WriteRaster(0, 0, tile_size, tile_size, array.tobytes())
 
     else:
 
@@ -655,6 +667,71 @@ def scale_query_to_tile(dsquery, dstile, tiledriver, options, tilefilename=''):
             exit_with_error("ReprojectImage() failed on %s, error %d" % (tilefilename, res))
 
 
+def get_antialias_weights(src_size, dst_size):
+    """
+    Matrix (dst_size, src_size) of the weights of the source pixels in each destination pixel,
+    for a Lanczos-3 filter stretched by the downsampling factor, so that it also averages all the
+    source pixels covered by a destination pixel (as the ANTIALIAS filter of PIL)
+    """
+    weights = antialias_weights.get((src_size, dst_size))
+    if weights is None:
+        scale = max(src_size / float(dst_size), 1.0)
+        centers = (numpy.arange(dst_size) + 0.5) * scale
+        x = (numpy.arange(src_size) + 0.5 - centers[:, numpy.newaxis]) / scale
+        weights = numpy.where(numpy.abs(x) < 3, numpy.sinc(x) * numpy.sinc(x / 3), 0)
+        weights /= weights.sum(axis=1)[:, numpy.newaxis]
+        weights = weights.astype(numpy.float32)
+        antialias_weights[(src_size, dst_size)] = weights
+    return weights
+
+
+# Weights of get_antialias_weights(), by (src_size, dst_size)
+antialias_weights = {}
+
+
+def antialias_downsample(array, tile_size):
+    """
+    Downsample an array of (bands, height, width) bytes, whose last band is the alpha band, to
+    (bands, tile_size, tile_size) with the filter of get_antialias_weights(), applied to the rows
+    and then to the columns. The data bands are weighted by the alpha, so that the pixels of the
+    transparent areas, whose value is meaningless, do not bleed into the opaque ones.
+    """
+    weights_y = get_antialias_weights(array.shape[1], tile_size)
+    weights_x = get_antialias_weights(array.shape[2], tile_size)
+
+    array = array.astype(numpy.float32)
+    array[:-1] *= array[-1] / 255
+    array = numpy.matmul(numpy.matmul(weights_y, array), weights_x.T)
+
+    alpha = array[-1]
+    array[:-1] = numpy.divide(array[:-1] * 255, alpha, out=numpy.zeros_like(array[:-1]),
+                              where=alpha >= 0.5)
+    return numpy.clip(numpy.rint(array), 0, 255).astype(numpy.uint8)
+
+
+def composite_existing_tile(tile_job_info, tile, dstile):
+    """
+    With 'antialias', draw the tile over the tile that already exists in the output (left by a
+    previous run on another input file), weighted by the alpha of the tile, instead of replacing
+    it. Not done with --update, which regenerates the tiles from the current inputs.
+    """
+    options = tile_job_info.options
+    if options.resampling != 'antialias' or options.update:
+        return
+    existing_data = read_tile(tile_job_info, tile)
+    data = dstile.ReadRaster()
+    if existing_data is None or len(existing_data) != len(data):
+        return
+
+    shape = (dstile.RasterCount, dstile.RasterYSize, dstile.RasterXSize)
+    array = numpy.frombuffer(data, numpy.uint8).reshape(shape).astype(numpy.float32)
+    existing_array = numpy.frombuffer(existing_data, numpy.uint8).reshape(shape)
+    weight = array[-1] / 255
+    array = array * weight + existing_array * (1 - weight)
+    dstile.WriteRaster(0, 0, dstile.RasterXSize, dstile.RasterYSize,
+                       numpy.rint(array).astype(numpy.uint8).tobytes())
+
+
 def setup_no_data_values(input_dataset, options):
     """
     Extract the NODATA values from the dataset or use the passed arguments as override if any
@@ -895,12 +972,81 @@ def nb_data_bands(dataset):
         return dataset.RasterCount - 1
     return dataset.RasterCount
 
-def create_base_tile(tile_job_info, tile_detail):
+def get_tiles_in_order(tminx, tminy, tmaxx, tmaxy, tile_order):
+    """
+    Generator of the (tx, ty) of the tiles of a range, either row by row from the top ('row'),
+    or along a Hilbert ('hilbert') or Morton ('morton') space filling curve, so that consecutive
+    tiles are close to each other. The curves are the ones of the smallest power of two square
+    containing the range, from which the quadrants outside of the range are pruned.
+    """
+    if tile_order == 'row':
+        for ty in range(tmaxy, tminy - 1, -1):
+            for tx in range(tminx, tmaxx + 1):
+                yield tx, ty
+        return
+
+    width = tmaxx - tminx + 1
+    height = tmaxy - tminy + 1
+    size = 1
+    while size < max(width, height):
+        size *= 2
+
+    def curve(x0, y0, xi, xj, yi, yj, size):
+        # Square of size x size tiles, from the corner (x0, y0) along the vectors (xi, xj) and
+        # (yi, yj)
+        minx = x0 + min(xi, 0) + min(yi, 0)
+        miny = y0 + min(xj, 0) + min(yj, 0)
+        if minx >= width or miny >= height:
+            return
+        if size == 1:
+            yield tminx + minx, tminy + miny
+            return
+
+        size //= 2
+        xi, xj, yi, yj = xi // 2, xj // 2, yi // 2, yj // 2
+        if tile_order == 'hilbert':
+            quadrants = ((x0, y0, yi, yj, xi, xj),
+                         (x0 + xi, y0 + xj, xi, xj, yi, yj),
+                         (x0 + xi + yi, y0 + xj + yj, xi, xj, yi, yj),
+                         (x0 + xi + 2 * yi, y0 + xj + 2 * yj, -yi, -yj, -xi, -xj))
+        else:
+            quadrants = ((x0, y0, xi, xj, yi, yj),
+                         (x0 + xi, y0 + xj, xi, xj, yi, yj),
+                         (x0 + yi, y0 + yj, xi, xj, yi, yj),
+                         (x0 + xi + yi, y0 + xj + yj, xi, xj, yi, yj))
+        for quadrant in quadrants:
+            for tile in curve(*(quadrant + (size,))):
+                yield tile
+
+    for tile in curve(0, 0, size, 0, 0, size, size):
+        yield tile
+
+
+def get_metatile_tiles(tile_job_info, tile_detail):
+    """
+    Return the (tz, tx, ty) of the tiles of the pyramid covered by the metatile of tile_detail,
+    from top to bottom and left to right
+    """
+    tz = tile_detail.tz
+    tminx, tminy, tmaxx, tmaxy = tile_job_info.tminmax[tz]
+    metatile_size = tile_detail.metatile_size
+    return [(tz, tx, ty)
+            for ty in range(min(tile_detail.ty, tmaxy),
+                            max(tile_detail.ty - metatile_size + 1, tminy) - 1, -1)
+            for tx in range(max(tile_detail.tx, tminx),
+                            min(tile_detail.tx + metatile_size - 1, tmaxx) + 1)]
+
+
+def read_base_tile_queries(tile_job_info, tile_detail):
+    """
+    Source read stage of the generation of the base tiles (the lowest in the pyramid) of a
+    metatile: read the pixels of the metatile from the input raster, and split them into the
+    queries of its tiles. Returns a list with, for each tile, its (tz, tx, ty) and its query
+    (querysize, data, alpha, window) as expected by resample_base_tile(), or None if the tile
+    must not be generated, or EMPTY_TILE if it is excluded because it is transparent.
+    """
 
     dataBandsCount = tile_job_info.nb_data_bands
-    output = tile_job_info.output_file_path
-    tileext = tile_job_info.tile_extension
-    tile_size = tile_job_info.tile_size
     options = tile_job_info.options
 
     tilebands = dataBandsCount + 1
@@ -913,12 +1059,8 @@ def create_base_tile(tile_job_info, tile_detail):
         threadLocal.cached_ds = ds
 
     mem_drv = gdal.GetDriverByName('MEM')
-    out_drv = gdal.GetDriverByName(tile_job_info.tile_driver)
     alphaband = ds.GetRasterBand(1).GetMaskBand()
 
-    tx = tile_detail.tx
-    ty = tile_detail.ty
-    tz = tile_detail.tz
     rx = tile_detail.rx
     ry = tile_detail.ry
     rxsize = tile_detail.rxsize
@@ -928,11 +1070,18 @@ def create_base_tile(tile_job_info, tile_detail):
     wxsize = tile_detail.wxsize
     wysize = tile_detail.wysize
     querysize = tile_detail.querysize
+    metatile_size = tile_detail.metatile_size
 
-    # Tile dataset in memory
-    tilefilename = os.path.join(
-        output, str(tz), str(tx), "%s.%s" % (ty, tileext))
-    dstile = mem_drv.Create('', tile_size, tile_size, tilebands)
+    tiles = get_metatile_tiles(tile_job_info, tile_detail)
+
+    existing_tiles = set()
+    if options.resume:
+        existing_tiles = set(tile for tile in tiles if tile_exists(tile_job_info, tile))
+        tiling_stats.count(tile_detail.tz, 'skipped_existing', len(existing_tiles))
+        if existing_tiles and options.verbose:
+            print("\tTile generation skipped because of --resume: ", sorted(existing_tiles))
+        if len(existing_tiles) == len(tiles):
+            return [(tile, None) for tile in tiles]
 
     data = alpha = None
 
@@ -946,13 +1095,84 @@ def create_base_tile(tile_job_info, tile_detail):
     if rxsize != 0 and rysize != 0 and wxsize != 0 and wysize != 0:
         alpha = alphaband.ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize)
 
-        # Detect totally transparent tile and skip its creation
+        # Detect totally transparent metatile and skip its creation
         if tile_job_info.exclude_transparent and len(alpha) == alpha.count('\x00'.encode('ascii')):
-            return
+            tiling_stats.count(tile_detail.tz, 'skipped_empty', len(tiles) - len(existing_tiles))
+            return [(tile, None if tile in existing_tiles else EMPTY_TILE) for tile in tiles]
 
         data = ds.ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize,
                              band_list=list(range(1, dataBandsCount + 1)))
 
+    if metatile_size == 1:
+        return [(tiles[0], (querysize, data, alpha, (wx, wy, wxsize, wysize)))]
+
+    # Split the query of the metatile into the queries of its tiles
+    if data:
+        dsmetatile = mem_drv.Create('', querysize * metatile_size, querysize * metatile_size,
+                                    tilebands)
+        dsmetatile.WriteRaster(wx, wy, wxsize, wysize, data,
+                               band_list=list(range(1, dataBandsCount + 1)))
+        dsmetatile.WriteRaster(wx, wy, wxsize, wysize, alpha, band_list=[tilebands])
+        del data
+
+    queries = []
+    for tile in tiles:
+        tz, tx, ty = tile
+        if tile in existing_tiles:
+            queries.append((tile, None))
+            continue
+
+        tile_data = tile_alpha = None
+        if alpha:
+            qx = (tx - tile_detail.tx) * querysize
+            qy = (tile_detail.ty - ty) * querysize
+            tile_alpha = dsmetatile.ReadRaster(qx, qy, querysize, querysize,
+                                               band_list=[tilebands])
+
+            # Detect totally transparent tile and skip its creation
+            if (tile_job_info.exclude_transparent and
+                    len(tile_alpha) == tile_alpha.count('\x00'.encode('ascii'))):
+                tiling_stats.count(tz, 'skipped_empty')
+                queries.append((tile, EMPTY_TILE))
+                continue
+
+            tile_data = dsmetatile.ReadRaster(qx, qy, querysize, querysize,
+                                              band_list=list(range(1, dataBandsCount + 1)))
+
+        queries.append((tile, (querysize, tile_data, tile_alpha, (0, 0, querysize, querysize))))
+
+    return queries
+
+
+def resample_base_tile(tile_job_info, tile, query):
+    """
+    Resample stage of the generation of a base tile: scale its query down to the tile. The query
+    is made of the pixels and the alpha read from the input raster, written at window
+    (wx, wy, wxsize, wysize) of a query of querysize x querysize pixels.
+    Returns the tile and the tile dataset in memory.
+    """
+
+    dataBandsCount = tile_job_info.nb_data_bands
+    output = tile_job_info.output_file_path
+    tileext = tile_job_info.tile_extension
+    tile_size = tile_job_info.tile_size
+    options = tile_job_info.options
+
+    tilebands = dataBandsCount + 1
+
+    mem_drv = gdal.GetDriverByName('MEM')
+
+    tz, tx, ty = tile
+    querysize, data, alpha, window = query
+    wx, wy, wxsize, wysize = window
+
+    # Tile dataset in memory
+    tilefilename = os.path.join(
+        output, str(tz), str(tx), "%s.%s" % (ty, tileext))
+    if options.output_format == 'directory':
+        makedirs(os.path.dirname(tilefilename))
+    dstile = mem_drv.Create('', tile_size, tile_size, tilebands)
+
     # The tile in memory is a transparent file by default. Write pixel values into it if
     # any
     if data:
@@ -976,18 +1196,46 @@ def create_base_tile(tile_job_info, tile_detail):
                                 band_list=list(range(1, dataBandsCount + 1)))
             dsquery.WriteRaster(wx, wy, wxsize, wysize, alpha, band_list=[tilebands])
 
-            scale_query_to_tile(dsquery, dstile, tile_job_info.tile_driver, options,
-                                tilefilename=tilefilename)
+            scale_query_to_tile(dsquery, dstile, options, tilefilename=tilefilename)
             del dsquery
 
+    composite_existing_tile(tile_job_info, tile, dstile)
+
     del data
 
-    if options.resampling != 'antialias':
-        # Write a copy of tile to png/jpg
-        out_drv.CreateCopy(tilefilename, dstile, strict=0)
+    return tile, dstile
+
 
+def encode_base_tile(tile_job_info, tile, dstile):
+    """
+    Encode stage of the generation of a base tile. Returns the tile, its pixels to be kept in the
+    TileCache (or None), and the encoded tile as returned by encode_tile().
+    """
+    tile_data = get_tile_data_for_cache(tile_job_info, tile[0], dstile)
+
+    out_drv = gdal.GetDriverByName(tile_job_info.tile_driver)
+    encoded_tile = encode_tile(tile_job_info, out_drv, dstile)
     del dstile
 
+    return tile, tile_data, encoded_tile
+
+
+def write_base_tile(tile_job_info, tile, tile_data, encoded_tile):
+    """
+    Write stage of the generation of a base tile: write the tile, and its KML file.
+    Returns the result of the tile as described in create_base_tiles().
+    """
+    output = tile_job_info.output_file_path
+    options = tile_job_info.options
+
+    tz, tx, ty = tile
+    tilefilename = os.path.join(
+        output, str(tz), str(tx), "%s.%s" % (ty, tile_job_info.tile_extension))
+
+    tile_blob = write_tile(tile_job_info, tilefilename, *encoded_tile)
+    tiling_stats.count(tz, 'tiles')
+    tiling_stats.count(tz, 'bytes', len(encoded_tile[0] or b''))
+
     # Create a KML file for this tile.
     if tile_job_info.kml:
         kmlfilename = os.path.join(output, str(tz), str(tx), '%d.kml' % ty)
@@ -998,128 +1246,1166 @@ def create_base_tile(tile_job_info, tile_detail):
                     get_tile_swne(tile_job_info, options), tile_job_info.options
                 ).encode('utf-8'))
 
+    return tile, tile_data, tile_blob
 
 
-def create_overview_tiles(tile_job_info, output_folder, options):
-    """Generation of the overview tiles (higher in the pyramid) based on existing tiles"""
-    mem_driver = gdal.GetDriverByName('MEM')
+def create_base_tiles(tile_job_info, tile_details):
+    """
+    Generation of the base tiles (the lowest in the pyramid) of a list of metatiles directly from
+    the input raster, by a BaseTilePipeline. Returns a list with, for each tile, the (tz, tx, ty)
+    of the tile, so that its overview tile can be scheduled, the pixels of the tile to be kept in
+    the TileCache (or None), and the encoded tile to be written by the TileWriter (or None if the
+    tile has already been written to disk, or EMPTY_TILE if it is empty).
+    """
+    return list(BaseTilePipeline(tile_job_info).run(tile_details))
+
+
+def group_tile_details(tile_details, nb_tile_details):
+    """
+    Group the tile details generated lazily by GDAL2Tiles.generate_tile_details() into lists of
+    nb_tile_details, to be generated by the same process
+    """
+    tile_details = iter(tile_details)
+    while True:
+        group = list(islice(tile_details, nb_tile_details))
+        if not group:
+            return
+        yield group
+
+
+class BaseTilePipeline(object):
+    """
+    Generation of the base tiles by stages connected by bounded queues, so that the latency of
+    the storage does not stall the resampling and the encoding of the other tiles: the source
+    read, by the calling thread which owns the cached input dataset; the resampling and the
+    encoding, each by options.pipeline_threads threads; and the writing, by a single thread, so
+    that a tile deduplicated by --dedup is only linked to a tile already written.
+    The GDAL calls of the resampling, encoding and writing stages release the GIL.
+    With 0 pipeline threads, the stages are run one after the other by the calling thread.
+    """
+
+    def __init__(self, tile_job_info):
+        self.tile_job_info = tile_job_info
+        self.nb_threads = tile_job_info.options.pipeline_threads
+        self.queue_size = tile_job_info.options.pipeline_queue_size
+        self.error = None
+
+    def read(self, tile_detail):
+        start = time.time()
+        queries = read_base_tile_queries(self.tile_job_info, tile_detail)
+        tiling_stats.add_time('read', len(queries), time.time() - start)
+        return queries
+
+    def run_stage(self, stage, func, *args):
+        start = time.time()
+        result = func(self.tile_job_info, *args)
+        tiling_stats.add_time(stage, 1, time.time() - start)
+        return result
+
+    def run(self, tile_details):
+        """
+        Generate the base tiles of the metatiles of tile_details, and yield the result of each
+        tile, as described in create_base_tiles(), as soon as it is available
+        """
+        if not self.nb_threads:
+            for tile_detail in tile_details:
+                for tile, query in self.read(tile_detail):
+                    if not query:
+                        yield tile, None, query
+                        continue
+                    result = self.run_stage('resample', resample_base_tile, tile, query)
+                    result = self.run_stage('encode', encode_base_tile, *result)
+                    yield self.run_stage('write', write_base_tile, *result)
+            return
+
+        resample_queue = Queue(self.queue_size)
+        encode_queue = Queue(self.queue_size)
+        write_queue = Queue(self.queue_size)
+        # Not bounded, as it is drained by the calling thread between the reads
+        results = Queue()
+        stage_threads = [
+            (resample_queue, self.start_threads('resample', resample_base_tile, resample_queue,
+                                                encode_queue, self.nb_threads)),
+            (encode_queue, self.start_threads('encode', encode_base_tile, encode_queue,
+                                              write_queue, self.nb_threads)),
+            (write_queue, self.start_threads('write', write_base_tile, write_queue, results, 1)),
+        ]
+
+        try:
+            for tile_detail in tile_details:
+                for tile, query in self.read(tile_detail):
+                    if not query:
+                        results.put((tile, None, query))
+                    else:
+                        resample_queue.put((tile, query))
+                for result in self.get_completed(results):
+                    yield result
+                if self.error is not None:
+                    break
+        finally:
+            # Each stage is finished once the previous ones are
+            for input_queue, threads in stage_threads:
+                for _ in threads:
+                    input_queue.put(None)
+                for thread in threads:
+                    thread.join()
+
+        if self.error is not None:
+            raise self.error
+        for result in self.get_completed(results):
+            yield result
+
+    def start_threads(self, stage, func, input_queue, output_queue, nb_threads):
+        threads = []
+        for _ in range(nb_threads):
+            thread = threading.Thread(target=self.run_thread,
+                                      args=(stage, func, input_queue, output_queue))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def run_thread(self, stage, func, input_queue, output_queue):
+        while True:
+            item = input_queue.get()
+            if item is None:
+                return
+            # After an error, only drain the queue, so that the previous stages do not block
+            if self.error is not None:
+                continue
+            try:
+                output_queue.put(self.run_stage(stage, func, *item))
+            except BaseException as e:
+                # Including the SystemExit raised by exit_with_error(), re-raised by run()
+                self.error = e
+
+    @staticmethod
+    def get_completed(results):
+        while True:
+            try:
+                yield results.get(False)
+            except Empty:
+                return
+
+
+class TilingStats(object):
+    """
+    Statistics of the generation of the tiles: the number of tiles processed by each phase, and
+    the time spent doing so, summed over the threads and the processes; and for each zoom level,
+    the number of tiles written, the size of their encoded content (0 for the tiles linked by
+    --dedup), and the number of tiles skipped because they are empty, already exist (--resume)
+    or did not change (--update).
+    Each process records its statistics in tiling_stats. The pool workers send them back to the
+    main process along with the result of each job, see run_and_collect_stats().
+    """
+
+    phases = ('plan', 'read', 'resample', 'encode', 'write', 'overview_read',
+              'overview_resample', 'overview_encode', 'overview_write', 'store')
+    counters = ('tiles', 'bytes', 'skipped_empty', 'skipped_existing', 'skipped_unchanged')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.times = OrderedDict((phase, [0, 0.0]) for phase in self.phases)
+        self.zooms = {}
+
+    def add_time(self, phase, nb_tiles, duration):
+        with self.lock:
+            self.times[phase][0] += nb_tiles
+            self.times[phase][1] += duration
+
+    def count(self, tz, counter, value=1):
+        with self.lock:
+            zoom = self.zooms.get(tz)
+            if zoom is None:
+                zoom = self.zooms[tz] = OrderedDict((c, 0) for c in self.counters)
+            zoom[counter] += value
+
+    def timed(self, phase, iterable):
+        """
+        Yield the items of iterable, accounting the time taken to generate them to phase
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add_time(phase, 1, time.time() - start)
+            yield item
+
+    def take(self):
+        """
+        Return the statistics recorded since the previous call, and reset them
+        """
+        with self.lock:
+            stats = self.times, self.zooms
+            self.reset()
+        return stats
+
+    def merge(self, stats):
+        times, zooms = stats
+        for phase, (nb_tiles, duration) in times.items():
+            self.add_time(phase, nb_tiles, duration)
+        for tz, counters in zooms.items():
+            for counter, value in counters.items():
+                self.count(tz, counter, value)
+
+    def report(self):
+        print("Time per phase:")
+        for phase, (nb_tiles, duration) in self.times.items():
+            if nb_tiles:
+                print("\t%s: %d tiles in %.2f s, %.1f tiles/s per thread" %
+                      (phase, nb_tiles, duration, nb_tiles / duration if duration else 0))
+        print("Tiles per zoom level:")
+        for tz in sorted(self.zooms):
+            print("\t%d: %s" % (tz, ", ".join("%s %d" % (counter, value)
+                                              for counter, value in self.zooms[tz].items())))
+
+    def write(self, filename, elapsed):
+        """
+        Write the statistics to a JSON file, with the elapsed time of the whole run
+        """
+        nb_tiles = sum(zoom['tiles'] for zoom in self.zooms.values())
+        stats = OrderedDict([
+            ('elapsed', elapsed),
+            ('tiles_per_second', nb_tiles / elapsed if elapsed else 0),
+            ('totals', OrderedDict((counter, sum(zoom[counter] for zoom in self.zooms.values()))
+                                   for counter in self.counters)),
+            ('zooms', OrderedDict((str(tz), self.zooms[tz]) for tz in sorted(self.zooms))),
+            ('phases', OrderedDict((phase, OrderedDict([('tiles', nb), ('seconds', duration)]))
+                                   for phase, (nb, duration) in self.times.items())),
+        ])
+        with open(filename, 'w') as f:
+            json.dump(stats, f, indent=2)
+
+
+tiling_stats = TilingStats()
+
+
+def run_and_collect_stats(func, *args):
+    """
+    Run func(*args) in a pool worker, and return its result along with the statistics recorded
+    by the worker since its previous job, to be merged into the tiling_stats of the main process
+    """
+    result = func(*args)
+    return result, tiling_stats.take()
+
+
+def run_and_collect_stats_or_error(func, *args):
+    """
+    Same as run_and_collect_stats(), but return the exception raised by func instead of raising
+    it, for the jobs submitted with Pool.apply_async(), which takes no error callback in Python 2
+    """
+    try:
+        return run_and_collect_stats(func, *args)
+    except Exception as e:   # pylint: disable=broad-except
+        return e
+
+
+def read_vsimem_file(filename):
+    f = gdal.VSIFOpenL(filename, 'rb')
+    content = gdal.VSIFReadL(1, gdal.VSIStatL(filename).size, f)
+    gdal.VSIFCloseL(f)
+    return content
+
+
+def encode_tile(tile_job_info, out_drv, dstile):
+    """
+    Encode the tile in the format of the tiles. Returns the arguments of write_tile(): the encoded
+    tile, the key of the tile in the DedupCache, and the file of the identical tile to link to.
+    With --dedup, the tiles whose pixels are identical to a tile already saved by this process
+    are not encoded again: they are linked to the file of this tile, or share its content.
+    """
+    options = tile_job_info.options
+    dedup_key = None
+    if options.dedup:
+        dedup_key = hashlib.sha1(dstile.ReadRaster()).digest()
+        duplicate = dedup_cache.get(dedup_key)
+        if duplicate is not None:
+            if options.output_format != 'directory':
+                return duplicate, None, None
+            return None, dedup_key, duplicate
+
+    vsi_filename = '/vsimem/%s.%s' % (uuid4(), tile_job_info.tile_extension)
+    out_drv.CreateCopy(vsi_filename, dstile, strict=0)
+    tile_blob = read_vsimem_file(vsi_filename)
+    gdal.Unlink(vsi_filename)
+    if gdal.VSIStatL(vsi_filename + '.aux.xml'):
+        gdal.Unlink(vsi_filename + '.aux.xml')
+    if dedup_key is not None and options.output_format != 'directory':
+        dedup_cache.put(dedup_key, tile_blob)
+        dedup_key = None
+    return tile_blob, dedup_key, None
+
+
+def write_tile(tile_job_info, tilefilename, tile_blob, dedup_key=None, duplicate=None):
+    """
+    Write the encoded tile to tilefilename, or link it to the file duplicate of an identical tile,
+    or return it when the tiles are stored in a single file by a TileWriter.
+    """
+    if tile_job_info.options.output_format != 'directory':
+        return tile_blob
+
+    if duplicate is not None and link_tile(duplicate, tilefilename):
+        return None
+
+    # Do not write through a link to the file of another tile (left by --dedup)
+    if os.path.lexists(tilefilename):
+        os.unlink(tilefilename)
+    if tile_blob is None:
+        # Hard links are not supported
+        shutil.copyfile(duplicate, tilefilename)
+    else:
+        with open(tilefilename, 'wb') as f:
+            f.write(tile_blob)
+    # Only once written, so that no other tile is linked to a missing file
+    if dedup_key is not None:
+        dedup_cache.put(dedup_key, tilefilename)
+    return None
+
+
+class DedupCache(object):
+    """
+    Bounded LRU cache of the file name (directory output) or the encoded content (single file
+    outputs) of the last tiles saved by a process, indexed by the hash of their pixels.
+    Shared by the threads of the BaseTilePipeline of the process.
+    """
+
+    max_entries = 1024
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+dedup_cache = DedupCache()
+
+
+def link_tile(filename, tilefilename):
+    """
+    Make tilefilename a hard link to the tile file filename. Returns False if the filesystem does
+    not support hard links.
+    No symbolic link is made instead, as a tile rewritten by --update or --resume would then
+    silently change all the tiles linked to it, while a hard link is unlinked before being
+    written.
+    """
+    if os.path.lexists(tilefilename):
+        os.unlink(tilefilename)
+    try:
+        os.link(filename, tilefilename)
+        return True
+    except (AttributeError, OSError):
+        return False
+
+
+def read_tile(tile_job_info, tile):
+    """
+    Read back the raw pixels of a tile that has been previously generated, or return None if it
+    does not exist
+    """
+    tz, tx, ty = tile
+    tile_size = tile_job_info.tile_size
+    options = tile_job_info.options
+
+    if options.output_format == 'directory':
+        tilefilename = os.path.join(tile_job_info.output_file_path, str(tz), str(tx),
+                                    "%s.%s" % (ty, tile_job_info.tile_extension))
+        if not os.path.isfile(tilefilename):
+            return None
+        ds = gdal.Open(tilefilename, gdal.GA_ReadOnly)
+        return ds.ReadRaster(0, 0, tile_size, tile_size)
+
+    tile_blob = get_tile_reader(tile_job_info).read(tile)
+    if tile_blob is None:
+        return None
+    vsi_filename = '/vsimem/%s.%s' % (uuid4(), tile_job_info.tile_extension)
+    gdal.FileFromMemBuffer(vsi_filename, tile_blob)
+    ds = gdal.Open(vsi_filename, gdal.GA_ReadOnly)
+    data = ds.ReadRaster(0, 0, tile_size, tile_size)
+    ds = None
+    gdal.Unlink(vsi_filename)
+    return data
+
+
+def remove_tile(tile_job_info, tile, tile_writer=None):
+    """
+    Remove a tile, and its KML file, from the output if they exist
+    """
+    if tile_writer is not None:
+        tile_writer.delete(tile)
+        return
+
+    tz, tx, ty = tile
+    for filename in ("%s.%s" % (ty, tile_job_info.tile_extension), "%d.kml" % ty):
+        filename = os.path.join(tile_job_info.output_file_path, str(tz), str(tx), filename)
+        if os.path.lexists(filename):
+            os.unlink(filename)
+
+
+def tile_exists(tile_job_info, tile):
+    if tile_job_info.options.output_format == 'directory':
+        tz, tx, ty = tile
+        return os.path.exists(os.path.join(tile_job_info.output_file_path, str(tz), str(tx),
+                                           "%s.%s" % (ty, tile_job_info.tile_extension)))
+    return get_tile_reader(tile_job_info).exists(tile)
+
+
+def get_tile_data_for_cache(tile_job_info, tz, dstile):
+    """
+    Return the raw pixels of a generated tile if they may be used to build its overview tile
+    """
+    if not tile_job_info.options.overview_cache or tz <= tile_job_info.tminz:
+        return None
+    return dstile.ReadRaster(0, 0, tile_job_info.tile_size, tile_job_info.tile_size)
+
+
+def get_overview_tminmax(tile_job_info):
+    """
+    Return, for each zoom level, the range of tiles that can actually be generated from the base
+    tiles. An overview tile is only kept if at least one of its children is in the range of the
+    zoom level just below.
+    """
+    tminmax = list(tile_job_info.tminmax)
+    for tz in range(tile_job_info.tmaxz - 1, tile_job_info.tminz - 1, -1):
+        tminx, tminy, tmaxx, tmaxy = tile_job_info.tminmax[tz]
+        cminx, cminy, cmaxx, cmaxy = tminmax[tz + 1]
+        tminmax[tz] = (max(tminx, cminx // 2), max(tminy, cminy // 2),
+                       min(tmaxx, cmaxx // 2), min(tmaxy, cmaxy // 2))
+    return tminmax
+
+
+def count_overview_tiles(tile_job_info):
+    tminmax = get_overview_tminmax(tile_job_info)
+
+    tile_number = 0
+    for tz in range(tile_job_info.tmaxz - 1, tile_job_info.tminz - 1, -1):
+        tminx, tminy, tmaxx, tmaxy = tminmax[tz]
+        if tmaxx >= tminx and tmaxy >= tminy:
+            tile_number += (1 + tmaxx - tminx) * (1 + tmaxy - tminy)
+
+    return tile_number
+
+
+class OverviewTileScheduler(object):
+    """
+    Dispatches the overview tiles as soon as all their children are available, instead of
+    waiting for a whole zoom level to be completed.
+
+    Every tile of the pyramid (base tiles included, even when their generation is skipped)
+    must be reported once through tile_done(), along with its pixels if they are available,
+    and its encoded content if it has to be written by the TileWriter.
+    With --update, the overview tiles none of whose children changed are not generated again,
+    but directly reported as unchanged themselves, and the tiles reported as EMPTY_TILE are
+    removed from the output, where a previous run may have left them.
+    The submit callable is called with the (tz, tx, ty) of each overview tile that becomes
+    ready to be generated, and with the pixels of its children found in the TileCache.
+    """
+
+    def __init__(self, tile_job_info, submit, tile_cache, tile_writer=None):
+        self.tile_job_info = tile_job_info
+        self.tminz = tile_job_info.tminz
+        self.tmaxz = tile_job_info.tmaxz
+        self.tminmax = get_overview_tminmax(tile_job_info)
+        self.submit = submit
+        self.tile_cache = tile_cache
+        self.tile_writer = tile_writer
+        self.nb_tiles = count_overview_tiles(tile_job_info)
+        self.incremental = tile_job_info.options.update
+        # Number of children still missing for the overview tiles with at least one child done
+        self.pending = {}
+        # Overview tiles pending with at least one changed child
+        self.changed = set()
+        self.nb_submitted = 0
+        self.nb_done = 0
+
+    def children_count(self, tz, tx, ty):
+        cminx, cminy, cmaxx, cmaxy = self.tminmax[tz + 1]
+        nb_x = min(2 * tx + 1, cmaxx) - max(2 * tx, cminx) + 1
+        nb_y = min(2 * ty + 1, cmaxy) - max(2 * ty, cminy) + 1
+        return max(0, nb_x) * max(0, nb_y)
+
+    def has_running_tiles(self):
+        return self.nb_done < self.nb_submitted
+
+    def tile_done(self, tile, tile_data=None, tile_blob=None, changed=True):
+        tz, tx, ty = tile
+        if tile_blob == EMPTY_TILE:
+            # Before its overview tile reads it back
+            if self.incremental:
+                remove_tile(self.tile_job_info, tile, self.tile_writer)
+        elif tile_blob is not None:
+            start = time.time()
+            self.tile_writer.write(tile, tile_blob)
+            tiling_stats.add_time('store', 1, time.time() - start)
+        if tz < self.tmaxz:
+            self.nb_done += 1
+        if tz <= self.tminz:
+            return
+
+        self.tile_cache.put(tile, tile_data)
+
+        overview_tile = (tz - 1, tx // 2, ty // 2)
+        if changed:
+            self.changed.add(overview_tile)
+        remaining = self.pending.pop(overview_tile, None)
+        if remaining is None:
+            remaining = self.children_count(*overview_tile)
+        remaining -= 1
+        if remaining > 0:
+            self.pending[overview_tile] = remaining
+            return
+
+        children_data = self.tile_cache.pop_children(overview_tile)
+        if self.incremental and overview_tile not in self.changed:
+            tiling_stats.count(overview_tile[0], 'skipped_unchanged')
+            self.nb_submitted += 1
+            self.tile_done(overview_tile, changed=False)
+            return
+        self.changed.discard(overview_tile)
+
+        if self.tile_writer:
+            self.tile_writer.flush_children(overview_tile, children_data)
+        self.nb_submitted += 1
+        self.submit(overview_tile, children_data)
+
+
+def create_overview_tile(tile_job_info, overview_tile, children_data=None):
+    """
+    Generation of an overview tile (higher in the pyramid) from its (up to) four children tiles,
+    which must already have been generated. The pixels of the children found in children_data
+    (indexed by (x, y)) are used directly, the other children are read back from disk.
+    Returns the same as create_base_tiles() for each tile.
+    """
+    tz, tx, ty = overview_tile
+    output_folder = tile_job_info.output_file_path
+    options = tile_job_info.options
+    tile_size = tile_job_info.tile_size
     tile_driver = tile_job_info.tile_driver
+
+    mem_driver = gdal.GetDriverByName('MEM')
     out_driver = gdal.GetDriverByName(tile_driver)
 
     tilebands = tile_job_info.nb_data_bands + 1
 
-    # Usage of existing tiles: from 4 underlying tiles generate one as overview.
+    tilefilename = os.path.join(tile_job_info.output_file_path,
+                                str(tz),
+                                str(tx),
+                                "%s.%s" % (ty, tile_job_info.tile_extension))
 
-    tcount = 0
-    for tz in range(tile_job_info.tmaxz - 1, tile_job_info.tminz - 1, -1):
-        tminx, tminy, tmaxx, tmaxy = tile_job_info.tminmax[tz]
-        tcount += (1 + abs(tmaxx - tminx)) * (1 + abs(tmaxy - tminy))
+    if options.verbose:
+        print(tilefilename)
+
+    if options.resume and tile_exists(tile_job_info, overview_tile):
+        if options.verbose:
+            print("Tile generation skipped because of --resume")
+        tiling_stats.count(tz, 'skipped_existing')
+        return overview_tile, None, None
+
+    start = time.time()
+
+    # Create directories for the tile
+    if options.output_format == 'directory':
+        makedirs(os.path.dirname(tilefilename))
+
+    dsquery = mem_driver.Create('', 2 * tile_size, 2 * tile_size, tilebands)
+    # TODO: fill the null value
+    dstile = mem_driver.Create('', tile_size, tile_size, tilebands)
+
+    children = []
+    # Read the tiles and write them to query window
+    minx, miny, maxx, maxy = tile_job_info.tminmax[tz + 1]
+    for y in range(2 * ty, 2 * ty + 2):
+        for x in range(2 * tx, 2 * tx + 2):
+            if x >= minx and x <= maxx and y >= miny and y <= maxy:
+                child_data = children_data.get((x, y)) if children_data else None
+                if child_data is None:
+                    child_data = read_tile(tile_job_info, (tz + 1, x, y))
+                    if child_data is None:
+                        continue
+
+                tileposx = (x - 2 * tx) * tile_size
+                tileposy = (2 * ty + 1 - y) * tile_size
+                dsquery.WriteRaster(
+                    tileposx, tileposy, tile_size, tile_size, child_data,
+                    band_list=list(range(1, tilebands + 1)))
+                children.append([x, y, tz + 1])
+
+    tile_data = tile_blob = None
+    tiling_stats.add_time('overview_read', 1, time.time() - start)
+    if children:
+        start = time.time()
+        scale_query_to_tile(dsquery, dstile, options, tilefilename=tilefilename)
+        composite_existing_tile(tile_job_info, overview_tile, dstile)
+        tile_data = get_tile_data_for_cache(tile_job_info, tz, dstile)
+        tiling_stats.add_time('overview_resample', 1, time.time() - start)
+
+        # Write a copy of tile to png/jpg
+        start = time.time()
+        encoded_tile = encode_tile(tile_job_info, out_driver, dstile)
+        tiling_stats.add_time('overview_encode', 1, time.time() - start)
+        start = time.time()
+        tile_blob = write_tile(tile_job_info, tilefilename, *encoded_tile)
+        tiling_stats.add_time('overview_write', 1, time.time() - start)
+        tiling_stats.count(tz, 'tiles')
+        tiling_stats.count(tz, 'bytes', len(encoded_tile[0] or b''))
+
+        if options.verbose:
+            print("\tbuild from zoom", tz + 1,
+                  " tiles:", (2 * tx, 2 * ty), (2 * tx + 1, 2 * ty),
+                  (2 * tx, 2 * ty + 1), (2 * tx + 1, 2 * ty + 1))
+
+        # Create a KML file for this tile.
+        if tile_job_info.kml:
+            with open(os.path.join(
+                output_folder,
+                '%d/%d/%d.kml' % (tz, tx, ty)
+            ), 'wb') as f:
+                f.write(generate_kml(
+                    tx, ty, tz, tile_job_info.tile_extension, tile_size,
+                    get_tile_swne(tile_job_info, options), options, children
+                ).encode('utf-8'))
+    else:
+        tiling_stats.count(tz, 'skipped_empty')
+        tile_blob = EMPTY_TILE
+
+    return overview_tile, tile_data, tile_blob
+
+
+class TileCache(object):
+    """
+    Bounded LRU cache of the raw pixels of the generated tiles, indexed by (tz, tx, ty), from
+    which the overview tiles are built instead of reading back and decoding the tile files.
+    Each entry is used once, by the overview tile of the cached tile, and is then removed.
+    When the memory budget is exceeded, the least recently added tiles are evicted: their
+    overview tile will read them from disk.
+    """
 
-    ti = 0
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.tiles = OrderedDict()
 
-    if tcount == 0:
+    def put(self, tile, data):
+        if data is None or len(data) > self.max_size:
+            return
+        self.tiles[tile] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            _, evicted_data = self.tiles.popitem(last=False)
+            self.size -= len(evicted_data)
+
+    def pop_children(self, overview_tile):
+        """Remove from the cache and return the children data of an overview tile"""
+        tz, tx, ty = overview_tile
+        children_data = {}
+        for y in range(2 * ty, 2 * ty + 2):
+            for x in range(2 * tx, 2 * tx + 2):
+                data = self.tiles.pop((tz + 1, x, y), None)
+                if data is not None:
+                    self.size -= len(data)
+                    children_data[(x, y)] = data
+        return children_data
+
+
+def makedirs(path):
+    """
+    Create a directory and its parents if they do not exist yet. Safe against other processes
+    creating the same directory concurrently.
+    """
+    if os.path.isdir(path):
         return
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
 
-    if not options.quiet:
-        print("Generating Overview Tiles:")
 
-    progress_bar = ProgressBar(tcount)
-    progress_bar.start()
+def get_gpkg_tile_matrix(tile_job_info, tz):
+    """
+    Return the width and height (in tiles), and the pixel size of the GeoPackage tile matrix of
+    a zoom level
+    """
+    options = tile_job_info.options
+    if options.profile == 'mercator':
+        return 2**tz, 2**tz, GlobalMercator(tile_job_info.tile_size).Resolution(tz)
+    geodetic = GlobalGeodetic(options.tmscompatible, tile_job_info.tile_size)
+    width = 2**(tz + 1) if options.tmscompatible else 2**tz
+    return width, 2**tz, geodetic.Resolution(tz)
 
-    for tz in range(tile_job_info.tmaxz - 1, tile_job_info.tminz - 1, -1):
-        tminx, tminy, tmaxx, tmaxy = tile_job_info.tminmax[tz]
-        for ty in range(tmaxy, tminy - 1, -1):
-            for tx in range(tminx, tmaxx + 1):
 
-                ti += 1
-                tilefilename = os.path.join(output_folder,
-                                            str(tz),
-                                            str(tx),
-                                            "%s.%s" % (ty, tile_job_info.tile_extension))
+def get_sqlite_tile_row(tile_job_info, tz, ty):
+    """
+    MBTiles rows are numbered from the bottom, as the TMS tiles, and GeoPackage ones from the top
+    """
+    if tile_job_info.options.output_format == 'gpkg':
+        return get_gpkg_tile_matrix(tile_job_info, tz)[1] - 1 - ty
+    return ty
 
-                if options.verbose:
-                    print(ti, '/', tcount, tilefilename)
 
-                if options.resume and os.path.exists(tilefilename):
-                    if options.verbose:
-                        print("Tile generation skipped because of --resume")
-                    else:
-                        progress_bar.log_progress()
-                    continue
-
-                # Create directories for the tile
-                if not os.path.exists(os.path.dirname(tilefilename)):
-                    os.makedirs(os.path.dirname(tilefilename))
-
-                dsquery = mem_driver.Create('', 2 * tile_job_info.tile_size,
-                                            2 * tile_job_info.tile_size, tilebands)
-                # TODO: fill the null value
-                dstile = mem_driver.Create('', tile_job_info.tile_size, tile_job_info.tile_size,
-                                           tilebands)
-
-                # TODO: Implement more clever walking on the tiles with cache functionality
-                # probably walk should start with reading of four tiles from top left corner
-                # Hilbert curve
-
-                children = []
-                # Read the tiles and write them to query window
-                for y in range(2 * ty, 2 * ty + 2):
-                    for x in range(2 * tx, 2 * tx + 2):
-                        minx, miny, maxx, maxy = tile_job_info.tminmax[tz + 1]
-                        if x >= minx and x <= maxx and y >= miny and y <= maxy:
-                            base_tile_path = os.path.join(output_folder, str(tz + 1), str(x),
-                                                          "%s.%s" % (y, tile_job_info.tile_extension))
-                            if not os.path.isfile(base_tile_path):
-                                continue
-
-                            dsquerytile = gdal.Open(
-                                base_tile_path,
-                                gdal.GA_ReadOnly)
-                            if (ty == 0 and y == 1) or (ty != 0 and (y % (2 * ty)) != 0):
-                                tileposy = 0
-                            else:
-                                tileposy = tile_job_info.tile_size
-                            if tx:
-                                tileposx = x % (2 * tx) * tile_job_info.tile_size
-                            elif tx == 0 and x == 1:
-                                tileposx = tile_job_info.tile_size
-                            else:
-                                tileposx = 0
-                            dsquery.WriteRaster(
-                                tileposx, tileposy, tile_job_info.tile_size,
-                                tile_job_info.tile_size,
-                                dsquerytile.ReadRaster(0, 0,
-                                                       tile_job_info.tile_size,
-                                                       tile_job_info.tile_size),
-                                band_list=list(range(1, tilebands + 1)))
-                            children.append([x, y, tz + 1])
-
-                if children:
-                    scale_query_to_tile(dsquery, dstile, tile_driver, options,
-                                        tilefilename=tilefilename)
-                    # Write a copy of tile to png/jpg
-                    if options.resampling != 'antialias':
-                        # Write a copy of tile to png/jpg
-                        out_driver.CreateCopy(tilefilename, dstile, strict=0)
-
-                    if options.verbose:
-                        print("\tbuild from zoom", tz + 1,
-                              " tiles:", (2 * tx, 2 * ty), (2 * tx + 1, 2 * ty),
-                              (2 * tx, 2 * ty + 1), (2 * tx + 1, 2 * ty + 1))
-
-                    # Create a KML file for this tile.
-                    if tile_job_info.kml:
-                        with open(os.path.join(
-                            output_folder,
-                            '%d/%d/%d.kml' % (tz, tx, ty)
-                        ), 'wb') as f:
-                            f.write(generate_kml(
-                                tx, ty, tz, tile_job_info.tile_extension, tile_job_info.tile_size,
-                                get_tile_swne(tile_job_info, options), options, children
-                            ).encode('utf-8'))
-
-                if not options.verbose and not options.quiet:
-                    progress_bar.log_progress()
+class TileReader(object):
+    """
+    Read access to the tiles of a MBTiles or GeoPackage file, while the TileWriter of the main
+    process is filling it
+    """
+
+    def __init__(self, tile_job_info):
+        self.tile_job_info = tile_job_info
+        self.filename = tile_job_info.output_file_path
+        self.conn = None
+
+    def query(self, column, tile):
+        if self.conn is None:
+            # Do not create the file if it does not exist yet
+            if not os.path.isfile(self.filename):
+                return None
+            self.conn = sqlite3.connect(self.filename, timeout=60)
+
+        tz, tx, ty = tile
+        row = self.conn.execute(
+            "SELECT %s FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?" %
+            column, (tz, tx, get_sqlite_tile_row(self.tile_job_info, tz, ty))).fetchone()
+        return row[0] if row else None
+
+    def read(self, tile):
+        tile_blob = self.query('tile_data', tile)
+        return bytes(tile_blob) if tile_blob is not None else None
+
+    def exists(self, tile):
+        return self.query('1', tile) is not None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def get_tile_reader(tile_job_info):
+    tile_reader = getattr(threadLocal, 'tile_reader', None)
+    if tile_reader is None or tile_reader.filename != tile_job_info.output_file_path:
+        tile_reader = TileReader(tile_job_info)
+        threadLocal.tile_reader = tile_reader
+    return tile_reader
+
+
+class TileWriter(object):
+    """
+    Base class of the writers of the tiles in a single SQLite file (MBTiles or GeoPackage).
+    The tiles are encoded by the workers, and inserted by the main process only, in large
+    transactions, so that the throughput does not depend on filesystem metadata operations.
+    """
+
+    # Number of tiles inserted in each transaction
+    batch_size = 2000
+
+    def __init__(self, tile_job_info, create_schema):
+        """
+        Open the output file, and call create_schema() to create its tables and metadata with
+        self.conn if it does not exist yet
+        """
+        self.tile_job_info = tile_job_info
+        self.filename = tile_job_info.output_file_path
+        self.pending_tiles = set()
+
+        create = not os.path.exists(self.filename)
+        self.conn = sqlite3.connect(self.filename, timeout=60)
+        # Let the TileReader of the workers access the committed tiles while we write
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        if create:
+            create_schema()
+            self.conn.commit()
+
+    def write(self, tile, tile_blob):
+        tz, tx, ty = tile
+        self.conn.execute(
+            "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) "
+            "VALUES (?, ?, ?, ?)",
+            (tz, tx, get_sqlite_tile_row(self.tile_job_info, tz, ty), sqlite3.Binary(tile_blob)))
+        self.pending_tiles.add(tile)
+        if len(self.pending_tiles) >= self.batch_size:
+            self.flush()
+
+    def delete(self, tile):
+        tz, tx, ty = tile
+        self.conn.execute(
+            "DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (tz, tx, get_sqlite_tile_row(self.tile_job_info, tz, ty)))
+        self.pending_tiles.add(tile)
+        if len(self.pending_tiles) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.conn.commit()
+        self.pending_tiles.clear()
+
+    def flush_children(self, overview_tile, children_data):
+        """
+        Commit the current transaction if the overview tile has to read back from the file some
+        children that are part of it
+        """
+        tz, tx, ty = overview_tile
+        for y in range(2 * ty, 2 * ty + 2):
+            for x in range(2 * tx, 2 * tx + 2):
+                if (x, y) not in children_data and (tz + 1, x, y) in self.pending_tiles:
+                    self.flush()
+                    return
+
+    def close(self):
+        self.flush()
+        # Back to a standalone file, without -wal and -shm companions
+        try:
+            self.conn.execute("PRAGMA journal_mode = DELETE")
+        except sqlite3.OperationalError:
+            # Still opened by a TileReader
+            pass
+        self.conn.close()
+
+
+class MBTilesWriter(TileWriter):
+    """
+    With --dedup, the tiles are stored in the 'map' and 'images' tables, under the hash of their
+    content, so that identical tiles share their data, and 'tiles' is a view joining them
+    """
+
+    def __init__(self, tile_job_info):
+        TileWriter.__init__(self, tile_job_info, self.create_schema)
+        self.shared_blobs = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'images'").fetchone()
+
+    def write(self, tile, tile_blob):
+        if not self.shared_blobs:
+            TileWriter.write(self, tile, tile_blob)
+            return
+
+        tz, tx, ty = tile
+        tile_id = hashlib.md5(tile_blob).hexdigest()
+        self.conn.execute("INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)",
+                          (tile_id, sqlite3.Binary(tile_blob)))
+        self.conn.execute(
+            "INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) "
+            "VALUES (?, ?, ?, ?)",
+            (tz, tx, get_sqlite_tile_row(self.tile_job_info, tz, ty), tile_id))
+        self.pending_tiles.add(tile)
+        if len(self.pending_tiles) >= self.batch_size:
+            self.flush()
+
+    def delete(self, tile):
+        if not self.shared_blobs:
+            TileWriter.delete(self, tile)
+            return
+
+        tz, tx, ty = tile
+        self.conn.execute(
+            "DELETE FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (tz, tx, get_sqlite_tile_row(self.tile_job_info, tz, ty)))
+        self.pending_tiles.add(tile)
+        if len(self.pending_tiles) >= self.batch_size:
+            self.flush()
+
+    def close(self):
+        if self.shared_blobs:
+            # Data of the tiles that have been replaced by --update or --resume
+            self.conn.execute("DELETE FROM images WHERE tile_id NOT IN "
+                              "(SELECT tile_id FROM map)")
+        TileWriter.close(self)
+
+    def create_schema(self):
+        conf = self.tile_job_info
+        mercator = GlobalMercator(conf.tile_size)
+        south, west = mercator.MetersToLatLon(conf.ominx, conf.ominy)
+        north, east = mercator.MetersToLatLon(conf.omaxx, conf.omaxy)
+        south, west = max(-85.05112878, south), max(-180.0, west)
+        north, east = min(85.05112878, north), min(180.0, east)
+
+        self.conn.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        if conf.options.dedup:
+            self.conn.execute("CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, "
+                              "tile_row INTEGER, tile_id TEXT)")
+            self.conn.execute("CREATE UNIQUE INDEX map_index ON map "
+                              "(zoom_level, tile_column, tile_row)")
+            self.conn.execute("CREATE TABLE images (tile_id TEXT PRIMARY KEY, tile_data BLOB)")
+            self.conn.execute("CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level, "
+                              "map.tile_column AS tile_column, map.tile_row AS tile_row, "
+                              "images.tile_data AS tile_data FROM map "
+                              "JOIN images ON images.tile_id = map.tile_id")
+        else:
+            self.conn.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, "
+                              "tile_row INTEGER, tile_data BLOB)")
+            self.conn.execute("CREATE UNIQUE INDEX tile_index ON tiles "
+                              "(zoom_level, tile_column, tile_row)")
+        metadata = [
+            ('name', conf.options.title),
+            ('description', conf.options.title),
+            ('type', 'overlay'),
+            ('version', '1.1'),
+            ('format', conf.tile_extension),
+            ('bounds', '%.14f,%.14f,%.14f,%.14f' % (west, south, east, north)),
+            ('minzoom', str(conf.tminz)),
+            ('maxzoom', str(conf.tmaxz)),
+        ]
+        if conf.options.copyright:
+            metadata.append(('attribution', conf.options.copyright))
+        self.conn.executemany("INSERT INTO metadata (name, value) VALUES (?, ?)", metadata)
+
+
+class GPKGTileWriter(TileWriter):
+
+    def __init__(self, tile_job_info):
+        TileWriter.__init__(self, tile_job_info, self.create_schema)
+
+    def create_schema(self):
+        conf = self.tile_job_info
+        if conf.options.profile == 'mercator':
+            srs_id = 3857
+            extent = GlobalMercator(conf.tile_size).originShift
+            tms_minx, tms_miny, tms_maxx, tms_maxy = -extent, -extent, extent, extent
+        else:
+            srs_id = 4326
+            width, height, res = get_gpkg_tile_matrix(conf, 0)
+            tms_minx, tms_miny = -180.0, -90.0
+            tms_maxx = tms_minx + width * conf.tile_size * res
+            tms_maxy = tms_miny + height * conf.tile_size * res
+
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(srs_id)
+
+        self.conn.execute("PRAGMA application_id = %d" % 0x47504B47)
+        self.conn.execute("PRAGMA user_version = 10200")
+        self.conn.execute(
+            "CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, "
+            "srs_id INTEGER NOT NULL PRIMARY KEY, organization TEXT NOT NULL, "
+            "organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, "
+            "description TEXT)")
+        self.conn.executemany(
+            "INSERT INTO gpkg_spatial_ref_sys (srs_name, srs_id, organization, "
+            "organization_coordsys_id, definition, description) VALUES (?, ?, ?, ?, ?, ?)",
+            [('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', None),
+             ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', None),
+             (srs.GetName(), srs_id, 'EPSG', srs_id, srs.ExportToWkt(), None)])
+        if srs_id != 4326:
+            srs.ImportFromEPSG(4326)
+            self.conn.execute(
+                "INSERT INTO gpkg_spatial_ref_sys (srs_name, srs_id, organization, "
+                "organization_coordsys_id, definition) VALUES (?, 4326, 'EPSG', 4326, ?)",
+                (srs.GetName(), srs.ExportToWkt()))
+        self.conn.execute(
+            "CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, "
+            "data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '', "
+            "last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), "
+            "min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER, "
+            "CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) "
+            "REFERENCES gpkg_spatial_ref_sys(srs_id))")
+        self.conn.execute(
+            "INSERT INTO gpkg_contents (table_name, data_type, identifier, description, "
+            "min_x, min_y, max_x, max_y, srs_id) VALUES ('tiles', 'tiles', ?, '', ?, ?, ?, ?, ?)",
+            (conf.options.title, conf.ominx, conf.ominy, conf.omaxx, conf.omaxy, srs_id))
+        self.conn.execute(
+            "CREATE TABLE gpkg_tile_matrix_set (table_name TEXT NOT NULL PRIMARY KEY, "
+            "srs_id INTEGER NOT NULL, min_x DOUBLE NOT NULL, min_y DOUBLE NOT NULL, "
+            "max_x DOUBLE NOT NULL, max_y DOUBLE NOT NULL, "
+            "CONSTRAINT fk_gtms_table_name FOREIGN KEY (table_name) "
+            "REFERENCES gpkg_contents(table_name), "
+            "CONSTRAINT fk_gtms_srs FOREIGN KEY (srs_id) "
+            "REFERENCES gpkg_spatial_ref_sys (srs_id))")
+        self.conn.execute(
+            "INSERT INTO gpkg_tile_matrix_set (table_name, srs_id, min_x, min_y, max_x, max_y) "
+            "VALUES ('tiles', ?, ?, ?, ?, ?)", (srs_id, tms_minx, tms_miny, tms_maxx, tms_maxy))
+        self.conn.execute(
+            "CREATE TABLE gpkg_tile_matrix (table_name TEXT NOT NULL, "
+            "zoom_level INTEGER NOT NULL, matrix_width INTEGER NOT NULL, "
+            "matrix_height INTEGER NOT NULL, tile_width INTEGER NOT NULL, "
+            "tile_height INTEGER NOT NULL, pixel_x_size DOUBLE NOT NULL, "
+            "pixel_y_size DOUBLE NOT NULL, "
+            "CONSTRAINT pk_ttm PRIMARY KEY (table_name, zoom_level), "
+            "CONSTRAINT fk_tmm_table_name FOREIGN KEY (table_name) "
+            "REFERENCES gpkg_contents(table_name))")
+        for tz in range(conf.tminz, conf.tmaxz + 1):
+            width, height, res = get_gpkg_tile_matrix(conf, tz)
+            self.conn.execute(
+                "INSERT INTO gpkg_tile_matrix (table_name, zoom_level, matrix_width, "
+                "matrix_height, tile_width, tile_height, pixel_x_size, pixel_y_size) "
+                "VALUES ('tiles', ?, ?, ?, ?, ?, ?, ?)",
+                (tz, width, height, conf.tile_size, conf.tile_size, res, res))
+        self.conn.execute(
+            "CREATE TABLE tiles (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "zoom_level INTEGER NOT NULL, tile_column INTEGER NOT NULL, "
+            "tile_row INTEGER NOT NULL, tile_data BLOB NOT NULL, "
+            "UNIQUE (zoom_level, tile_column, tile_row))")
+
+
+def get_tile_writer(tile_job_info):
+    """Return the TileWriter of the output, or None if the workers write the tiles themselves"""
+    if tile_job_info.options.output_format == 'mbtiles':
+        return MBTilesWriter(tile_job_info)
+    if tile_job_info.options.output_format == 'gpkg':
+        return GPKGTileWriter(tile_job_info)
+    return None
+
+
+def get_manifest_filename(output_folder, options):
+    """Return the file name of the TileManifest of the output"""
+    if options.output_format == 'directory':
+        return os.path.join(output_folder, 'gdal2tiles_manifest.sqlite')
+    return output_folder + '.manifest.sqlite'
+
+
+def get_input_files(input_dataset):
+    """
+    Return the files of the input raster, as a list of (filename, footprint) where the footprint
+    is the (minx, miny, maxx, maxy) window of the input raster, in pixels, covered by the file.
+    The sources of a VRT mosaic cover their destination window, the other files the whole raster.
+    """
+    whole_raster = (0, 0, input_dataset.RasterXSize, input_dataset.RasterYSize)
+    if input_dataset.GetDriver().ShortName != 'VRT':
+        return [(filename, whole_raster) for filename in input_dataset.GetFileList() or []]
+
+    vrt_dirname = os.path.dirname(input_dataset.GetDescription())
+    footprints = OrderedDict()
+    for element in ElementTree.fromstring(input_dataset.GetMetadata('xml:VRT')[0]).iter():
+        if element.tag == 'SourceDataset':
+            # Source of a warped VRT
+            filename_element = element
+        else:
+            filename_element = element.find('SourceFilename')
+        if filename_element is None or not filename_element.text:
+            continue
+
+        filename = filename_element.text
+        if filename_element.get('relativeToVRT') == '1':
+            filename = os.path.join(vrt_dirname, filename)
+
+        dst_rect = element.find('DstRect')
+        if dst_rect is None:
+            footprint = whole_raster
+        else:
+            xoff, yoff, xsize, ysize = [float(dst_rect.get(key))
+                                        for key in ('xOff', 'yOff', 'xSize', 'ySize')]
+            footprint = (xoff, yoff, xoff + xsize, yoff + ysize)
+
+        # Union of the footprints of the file in the different bands
+        if filename in footprints:
+            other = footprints[filename]
+            footprint = (min(footprint[0], other[0]), min(footprint[1], other[1]),
+                         max(footprint[2], other[2]), max(footprint[3], other[3]))
+        footprints[filename] = footprint
+
+    return list(footprints.items())
+
+
+class TileManifest(object):
+    """
+    Records, for each base tile, the window of the input raster it is rendered from and a
+    signature of the input files covering this window (their name, size and modification time),
+    so that --update only regenerates the base tiles whose window or input files changed since
+    the previous run, or that intersect a changed window.
+
+    input_files is a list of (filename, footprint), where footprint is the (minx, miny, maxx, maxy)
+    window, in pixels of the (warped) input raster, that the file may contribute to, as are the
+    changed_windows. The manifest is a SQLite file, whose changes are only committed by close()
+    once all the tiles have been generated.
+    """
+
+    def __init__(self, filename, config, input_files, changed_windows=()):
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, "
+                          "value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, "
+                          "tile_column INTEGER, tile_row INTEGER, rx INTEGER, ry INTEGER, "
+                          "rxsize INTEGER, rysize INTEGER, signature TEXT, "
+                          "PRIMARY KEY (zoom_level, tile_column, tile_row))")
+        row = self.conn.execute("SELECT value FROM metadata WHERE name = 'config'").fetchone()
+        if row is None or row[0] != config:
+            # The tiles generated with other settings cannot be kept
+            self.conn.execute("DELETE FROM tiles")
+            self.conn.execute("INSERT OR REPLACE INTO metadata VALUES ('config', ?)", (config,))
+
+        self.changed_windows = list(changed_windows)
+
+        # Grid index of the footprints of the input files
+        self.input_files = []
+        for filename, footprint in input_files:
+            stat = gdal.VSIStatL(filename)
+            self.input_files.append(('%s %s %s' % (filename, stat.size, stat.mtime)
+                                     if stat else '%s missing' % filename, footprint))
+        self.cell_size = 1024
+        max_footprint = max([1] + [max(f[2] - f[0], f[3] - f[1]) for _, f in input_files])
+        while max_footprint / self.cell_size > 64:
+            self.cell_size *= 2
+        self.cells = {}
+        for i, (_, footprint) in enumerate(self.input_files):
+            for cell in self.get_cells(footprint):
+                self.cells.setdefault(cell, []).append(i)
+
+    def get_cells(self, footprint):
+        minx, miny, maxx, maxy = footprint
+        return [(cx, cy)
+                for cy in range(int(math.floor(miny / self.cell_size)),
+                                int(math.floor(maxy / self.cell_size)) + 1)
+                for cx in range(int(math.floor(minx / self.cell_size)),
+                                int(math.floor(maxx / self.cell_size)) + 1)]
+
+    def get_signature(self, window):
+        """Signature of the input files whose footprint intersects the (rx, ry, rxsize, rysize)
+        window"""
+        rx, ry, rxsize, rysize = window
+        if rxsize <= 0 or rysize <= 0:
+            return ''
+        box = (rx, ry, rx + rxsize, ry + rysize)
+        files = set()
+        for cell in self.get_cells(box):
+            for i in self.cells.get(cell, []):
+                if intersects(box, self.input_files[i][1]):
+                    files.add(self.input_files[i][0])
+        return hashlib.md5('\n'.join(sorted(files)).encode('utf-8')).hexdigest()
+
+    def tile_changed(self, tile, window):
+        """
+        Whether the tile has to be generated again, in which case its new window and signature
+        are recorded
+        """
+        rx, ry, rxsize, rysize = window
+        signature = self.get_signature(window)
+        tz, tx, ty = tile
+        row = self.conn.execute(
+            "SELECT rx, ry, rxsize, rysize, signature FROM tiles WHERE zoom_level = ? AND "
+            "tile_column = ? AND tile_row = ?", (tz, tx, ty)).fetchone()
+        box = (rx, ry, rx + rxsize, ry + rysize)
+        if (row is not None and tuple(row) == (rx, ry, rxsize, rysize, signature) and
+                not any(intersects(box, changed) for changed in self.changed_windows)):
+            return False
+
+        self.conn.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                          (tz, tx, ty, rx, ry, rxsize, rysize, signature))
+        return True
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def intersects(box, other_box):
+    """Whether two (minx, miny, maxx, maxy) boxes intersect"""
+    return (box[0] < other_box[2] and other_box[0] < box[2] and
+            box[1] < other_box[3] and other_box[1] < box[3])
 
 
 def optparse_init():
@@ -1141,6 +2427,13 @@ def optparse_init():
                  help="Zoom levels to render (format:'2-5' or '10').")
     p.add_option('-e', '--resume', dest="resume", action="store_true",
                  help="Resume mode. Generate only missing files.")
+    p.add_option('--update', dest="update", action="store_true",
+                 help=("Incremental mode. Generate only the base tiles whose input files changed "
+                       "since the previous run, as recorded in the manifest of the output, and "
+                       "their overview tiles."))
+    p.add_option('--changed-bbox', dest="changed_bbox", metavar="MINX,MINY,MAXX,MAXY",
+                 help=("With --update, also generate the tiles intersecting this extent, "
+                       "expressed in the georeferenced coordinates of the input file."))
     p.add_option('-a', '--srcnodata', dest="srcnodata", metavar="NODATA",
                  help="NODATA transparency value to assign to the input data")
     p.add_option('-d', '--tmscompatible', dest="tmscompatible", action="store_true",
@@ -1159,6 +2452,50 @@ def optparse_init():
                  dest="nb_processes",
                  type='int',
                  help="Number of processes to use for tiling")
+    p.add_option("--output-format",
+                 dest="output_format",
+                 type='choice', choices=output_format_list,
+                 help=("Storage of the tiles (%s) - default 'directory', or deduced from the "
+                       "extension of the output (.mbtiles, .gpkg)" % ",".join(output_format_list)))
+    p.add_option("--overview-cache",
+                 dest="overview_cache",
+                 type='int', metavar="SIZE_MB",
+                 help=("Memory budget (in MB) of the cache of generated tiles, from which the "
+                       "overview tiles are built without reading the tiles back from disk. "
+                       "0 to disable - default 256"))
+    p.add_option("--metatile",
+                 dest="metatile",
+                 type='int', metavar="N",
+                 help=("Render the base tiles by blocks of NxN tiles, so that the input raster "
+                       "is read and warped once per block - default 1"))
+    p.add_option("--dedup",
+                 dest="dedup", action="store_true",
+                 help=("Encode only once the tiles with identical pixels, and hardlink them "
+                       "in a directory, or store their data once in a MBTiles file"))
+    p.add_option("--stats",
+                 dest="stats_file", metavar="FILE",
+                 help=("Write to this JSON file the number of tiles and bytes written and of "
+                       "tiles skipped per zoom level, and the time spent in each phase of the "
+                       "generation of the tiles"))
+    p.add_option("--pipeline-threads",
+                 dest="pipeline_threads",
+                 type='int', metavar="N",
+                 help=("Number of threads of each of the resampling and encoding stages of the "
+                       "generation of the base tiles, which overlap with the reading of the "
+                       "input and the writing of the tiles. 0 to run the stages one after the "
+                       "other - default 1"))
+    p.add_option("--pipeline-queue-size",
+                 dest="pipeline_queue_size",
+                 type='int', metavar="N",
+                 help=("Maximum number of tiles waiting between two stages of the generation "
+                       "of the base tiles - default 4"))
+    p.add_option("--tile-order",
+                 dest="tile_order",
+                 type='choice', choices=tile_order_list,
+                 help=("Order in which the base tiles are rendered (%s) - default 'hilbert'. "
+                       "Tiles rendered one after the other, and by the same process, are close "
+                       "to each other along the Hilbert and Morton curves, which makes a better "
+                       "use of the caches of the input raster" % ",".join(tile_order_list)))
 
     # KML options
     g = OptionGroup(p, "KML (Google Earth) options",
@@ -1191,7 +2528,8 @@ def optparse_init():
     p.set_defaults(verbose=False, profile="mercator", kml=False, url='',
                    webviewer='all', copyright='', resampling='average', resume=False,
                    googlekey='INSERT_YOUR_KEY_HERE', bingkey='INSERT_YOUR_KEY_HERE',
-                   processes=1)
+                   processes=1, overview_cache=256, update=False, dedup=False, metatile=1,
+                   tile_order='hilbert', pipeline_threads=1, pipeline_queue_size=4)
 
     return p
 
@@ -1217,6 +2555,8 @@ def process_args(argv):
     else:
         # Directory with input filename without extension in actual directory
         output_folder = os.path.splitext(os.path.basename(input_file))[0]
+        if options.output_format and options.output_format != 'directory':
+            output_folder += '.' + options.output_format
 
     options = options_post_processing(options, input_file, output_folder)
 
@@ -1235,10 +2575,55 @@ def options_post_processing(options, input_file, output_folder):
             out_path = out_path[:-1]
         options.url += os.path.basename(out_path) + '/'
 
+    if not options.output_format:
+        ext = os.path.splitext(output_folder)[1].lower()
+        if ext == '.mbtiles':
+            options.output_format = 'mbtiles'
+        elif ext == '.gpkg':
+            options.output_format = 'gpkg'
+        else:
+            options.output_format = 'directory'
+
     # Supported options
     if options.resampling == 'antialias' and not numpy_available:
         exit_with_error("'antialias' resampling algorithm is not available.",
-                        "Install PIL (Python Imaging Library) and numpy.")
+                        "Install numpy.")
+
+    if options.output_format != 'directory':
+        if not sqlite3:
+            exit_with_error("'%s' output format is not available." % options.output_format,
+                            "Install the sqlite3 Python module.")
+        if options.output_format == 'mbtiles' and options.profile != 'mercator':
+            exit_with_error("'mbtiles' output format is only available with the 'mercator' "
+                            "profile.")
+        if options.profile == 'raster':
+            exit_with_error("'%s' output format is not available with the 'raster' profile." %
+                            options.output_format)
+
+    if options.changed_bbox:
+        try:
+            options.changed_bbox = [float(v) for v in options.changed_bbox.split(',')]
+        except ValueError:
+            options.changed_bbox = []
+        if len(options.changed_bbox) != 4:
+            exit_with_error("--changed-bbox must be given as MINX,MINY,MAXX,MAXY.")
+        options.update = True
+
+    if options.update:
+        if not sqlite3:
+            exit_with_error("--update is not available.", "Install the sqlite3 Python module.")
+        if options.resume:
+            exit_with_error("--update and --resume cannot be used together.")
+
+    if options.metatile < 1:
+        exit_with_error("--metatile must be a strictly positive integer.")
+    if options.metatile > 1 and options.profile == 'raster':
+        exit_with_error("--metatile is not available with the 'raster' profile.")
+
+    if options.pipeline_threads < 0:
+        exit_with_error("--pipeline-threads must be a positive integer.")
+    if options.pipeline_queue_size < 1:
+        exit_with_error("--pipeline-queue-size must be a strictly positive integer.")
 
     try:
         os.path.basename(input_file).encode('ascii')
@@ -1280,6 +2665,7 @@ class TileDetail(object):
     wxsize = 0
     wysize = 0
     querysize = 0
+    metatile_size = 1
 
     def __init__(self, **kwargs):
         for key in kwargs:
@@ -1312,7 +2698,10 @@ class TileJobInfo(object):
     tmaxz = 0
     in_srs_wkt = 0
     out_geo_trans = []
+    ominx = 0
     ominy = 0
+    omaxx = 0
+    omaxy = 0
     is_epsg_4326 = False
     options = None
     exclude_transparent = False
@@ -1342,7 +2731,10 @@ class GDAL2Tiles(object):
         """Constructor function - initialization"""
         self.out_drv = None
         self.mem_drv = None
+        self.input_dataset = None
         self.warped_input_dataset = None
+        self.warped_transformer = None
+        self.manifest = None
         self.out_srs = None
         self.nativezoom = None
         self.tminmax = None
@@ -1369,8 +2761,8 @@ class GDAL2Tiles(object):
         self.tile_size = 256
         self.tiledriver = 'PNG'
         self.tileext = 'png'
-        self.tmp_dir = tempfile.mkdtemp()
-        self.tmp_vrt_filename = os.path.join(self.tmp_dir, str(uuid4()) + '.vrt')
+        # In memory, so that it is inherited by the forked worker processes
+        self.tmp_vrt_filename = '/vsimem/gdal2tiles/%s.vrt' % uuid4()
 
         # Should we read bigger window of the input raster and scale it down?
         # Note: Modified later by open_input()
@@ -1509,6 +2901,7 @@ class GDAL2Tiles(object):
 
         if not self.warped_input_dataset:
             self.warped_input_dataset = input_dataset
+        self.input_dataset = input_dataset
 
         gdal.GetDriverByName('VRT').CreateCopy(self.tmp_vrt_filename,
                                                self.warped_input_dataset)
@@ -1523,7 +2916,8 @@ class GDAL2Tiles(object):
         srs4326.ImportFromEPSG(4326)
         srs4326.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
         if self.out_srs and srs4326.ExportToProj4() == self.out_srs.ExportToProj4():
-            self.kml = True
+            # No KML with the single file outputs
+            self.kml = self.options.output_format == 'directory'
             self.isepsg4326 = True
             if self.options.verbose:
                 print("KML autotest OK!")
@@ -1687,6 +3081,10 @@ class GDAL2Tiles(object):
         tiles are generated during the tile processing).
         """
 
+        # The metadata of the single file outputs are written by their TileWriter
+        if self.options.output_format != 'directory':
+            return
+
         if not os.path.exists(self.output_folder):
             os.makedirs(self.output_folder)
 
@@ -1771,9 +3169,11 @@ class GDAL2Tiles(object):
                             self.options, children
                         ).encode('utf-8'))
 
-    def generate_base_tiles(self):
+    def generate_base_tiles(self, skipped_tiles=None):
         """
-        Generation of the base tiles (the lowest in the pyramid) directly from the input raster
+        Generation of the base tiles (the lowest in the pyramid) directly from the input raster.
+        Returns the TileJobInfo and the generator of the TileDetail of the base tiles, see
+        generate_tile_details() for skipped_tiles.
         """
 
         if not self.options.quiet:
@@ -1785,101 +3185,12 @@ class GDAL2Tiles(object):
             print("----------------------------------------")
             print('')
 
-        # Set the bounds
-        tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tmaxz]
-
-        ds = self.warped_input_dataset
         tilebands = self.dataBandsCount + 1
-        querysize = self.querysize
 
         if self.options.verbose:
             print("dataBandsCount: ", self.dataBandsCount)
             print("tilebands: ", tilebands)
 
-        tcount = (1 + abs(tmaxx - tminx)) * (1 + abs(tmaxy - tminy))
-        ti = 0
-
-        tile_details = []
-
-        tz = self.tmaxz
-        for ty in range(tmaxy, tminy - 1, -1):
-            for tx in range(tminx, tmaxx + 1):
-
-                ti += 1
-                tilefilename = os.path.join(
-                    self.output_folder, str(tz), str(tx), "%s.%s" % (ty, self.tileext))
-                if self.options.verbose:
-                    print(ti, '/', tcount, tilefilename)
-
-                if self.options.resume and os.path.exists(tilefilename):
-                    if self.options.verbose:
-                        print("Tile generation skipped because of --resume")
-                    continue
-
-                # Create directories for the tile
-                if not os.path.exists(os.path.dirname(tilefilename)):
-                    os.makedirs(os.path.dirname(tilefilename))
-
-                if self.options.profile == 'mercator':
-                    # Tile bounds in EPSG:3857
-                    b = self.mercator.TileBounds(tx, ty, tz)
-                elif self.options.profile == 'geodetic':
-                    b = self.geodetic.TileBounds(tx, ty, tz)
-
-                # Don't scale up by nearest neighbour, better change the querysize
-                # to the native resolution (and return smaller query tile) for scaling
-
-                if self.options.profile in ('mercator', 'geodetic'):
-                    rb, wb = self.geo_query(ds, b[0], b[3], b[2], b[1])
-
-                    # Pixel size in the raster covering query geo extent
-                    nativesize = wb[0] + wb[2]
-                    if self.options.verbose:
-                        print("\tNative Extent (querysize", nativesize, "): ", rb, wb)
-
-                    # Tile bounds in raster coordinates for ReadRaster query
-                    rb, wb = self.geo_query(ds, b[0], b[3], b[2], b[1], querysize=querysize)
-
-                    rx, ry, rxsize, rysize = rb
-                    wx, wy, wxsize, wysize = wb
-
-                else:     # 'raster' profile:
-
-                    tsize = int(self.tsize[tz])   # tile_size in raster coordinates for actual zoom
-                    xsize = self.warped_input_dataset.RasterXSize     # size of the raster in pixels
-                    ysize = self.warped_input_dataset.RasterYSize
-                    if tz >= self.nativezoom:
-                        querysize = self.tile_size
-
-                    rx = (tx) * tsize
-                    rxsize = 0
-                    if tx == tmaxx:
-                        rxsize = xsize % tsize
-                    if rxsize == 0:
-                        rxsize = tsize
-
-                    rysize = 0
-                    if ty == tmaxy:
-                        rysize = ysize % tsize
-                    if rysize == 0:
-                        rysize = tsize
-                    ry = ysize - (ty * tsize) - rysize
-
-                    wx, wy = 0, 0
-                    wxsize = int(rxsize / float(tsize) * self.tile_size)
-                    wysize = int(rysize / float(tsize) * self.tile_size)
-                    if wysize != self.tile_size:
-                        wy = self.tile_size - wysize
-
-                # Read the source raster if anything is going inside the tile as per the computed
-                # geo_query
-                tile_details.append(
-                    TileDetail(
-                        tx=tx, ty=ty, tz=tz, rx=rx, ry=ry, rxsize=rxsize, rysize=rysize, wx=wx,
-                        wy=wy, wxsize=wxsize, wysize=wysize, querysize=querysize,
-                    )
-                )
-
         conf = TileJobInfo(
             src_file=self.tmp_vrt_filename,
             nb_data_bands=self.dataBandsCount,
@@ -1893,13 +3204,299 @@ class GDAL2Tiles(object):
             tmaxz=self.tmaxz,
             in_srs_wkt=self.in_srs_wkt,
             out_geo_trans=self.out_gt,
+            ominx=self.ominx,
             ominy=self.ominy,
+            omaxx=self.omaxx,
+            omaxy=self.omaxy,
             is_epsg_4326=self.isepsg4326,
             options=self.options,
             exclude_transparent=self.options.exclude_transparent,
         )
 
-        return conf, tile_details
+        if self.options.update:
+            self.open_manifest()
+
+        return conf, self.generate_tile_details(skipped_tiles)
+
+    def open_manifest(self):
+        """
+        Open the TileManifest of the output, with the footprints of the input files (and of
+        --changed-bbox) in pixels of the warped input raster
+        """
+        # The manifest is reset when the tiles are generated with other settings
+        config = repr([self.options.profile, self.options.resampling, self.options.s_srs,
+                       self.options.srcnodata, self.options.tmscompatible,
+                       self.options.exclude_transparent, self.options.output_format,
+                       self.tiledriver, self.tile_size, self.tminz, self.tmaxz])
+
+        input_files = [(filename, self.get_warped_window(footprint))
+                       for filename, footprint in get_input_files(self.input_dataset)]
+
+        changed_windows = []
+        if self.options.changed_bbox:
+            minx, miny, maxx, maxy = self.options.changed_bbox
+            inv_gt = gdal.InvGeoTransform(self.input_dataset.GetGeoTransform())
+            corners = [gdal.ApplyGeoTransform(inv_gt, x, y)
+                       for x, y in ((minx, miny), (minx, maxy), (maxx, miny), (maxx, maxy))]
+            changed_windows.append(self.get_warped_window(
+                (min(c[0] for c in corners), min(c[1] for c in corners),
+                 max(c[0] for c in corners), max(c[1] for c in corners))))
+
+        self.manifest = TileManifest(get_manifest_filename(self.output_folder, self.options),
+                                     config, input_files, changed_windows)
+
+    def get_warped_window(self, window):
+        """
+        Convert a (minx, miny, maxx, maxy) window in pixels of the input raster to the window of
+        the warped input raster it may contribute to
+        """
+        if self.warped_input_dataset is self.input_dataset:
+            return window
+
+        minx, miny, maxx, maxy = window
+        points = []
+        for i in range(11):
+            x = minx + (maxx - minx) * i / 10.0
+            y = miny + (maxy - miny) * i / 10.0
+            points += [(x, miny), (x, maxy), (minx, y), (maxx, y)]
+        if not self.warped_transformer:
+            self.warped_transformer = gdal.Transformer(self.input_dataset,
+                                                       self.warped_input_dataset, [])
+        points, success = self.warped_transformer.TransformPoints(0, points)
+        points = [point for point, ok in zip(points, success) if ok]
+        if not points:
+            return (0, 0, self.warped_input_dataset.RasterXSize,
+                    self.warped_input_dataset.RasterYSize)
+
+        wminx = min(point[0] for point in points)
+        wminy = min(point[1] for point in points)
+        wmaxx = max(point[0] for point in points)
+        wmaxy = max(point[1] for point in points)
+
+        # Margin of a few input pixels, for the resampling kernel of the warping
+        margin = 4 * max(1, (wmaxx - wminx) / max(1, maxx - minx),
+                         (wmaxy - wminy) / max(1, maxy - miny))
+        return (wminx - margin, wminy - margin, wmaxx + margin, wmaxy + margin)
+
+    def generate_tile_details(self, skipped_tiles=None):
+        """
+        Generator of the TileDetail of the metatiles of the base tiles. The tile details are
+        computed lazily, so that the memory used by the planning does not depend on the number
+        of tiles.
+        With --exclude, the metatiles known to be empty in the mask of the input raster without
+        reading it are not generated, nor are the metatiles whose input did not change with
+        --update. The
+        ((tz, tx, ty), changed) of their tiles are put in the skipped_tiles Queue instead.
+        """
+
+        # Set the bounds
+        tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tmaxz]
+
+        ds = self.warped_input_dataset
+        querysize = self.querysize
+
+        tcount = (1 + abs(tmaxx - tminx)) * (1 + abs(tmaxy - tminy))
+        ti = 0
+
+        # With --metatile, the base tiles are rendered by blocks of NxN tiles aligned on
+        # multiples of N, each block being read from the input raster with a single query
+        metatile_size = self.options.metatile
+        if self.options.profile == 'raster':
+            metatile_size = 1
+
+        mask_overview = None
+        check_mask = (self.options.exclude_transparent and
+                      ds.GetRasterBand(1).GetMaskFlags() != gdal.GMF_ALL_VALID)
+        if check_mask:
+            mask_overview = self.get_planning_mask_overview()
+            if self.options.verbose and mask_overview:
+                print("Empty tiles detected from the mask overview of size",
+                      (mask_overview.XSize, mask_overview.YSize))
+
+        tz = self.tmaxz
+        for mtx, mty in get_tiles_in_order(tminx // metatile_size, tminy // metatile_size,
+                                           tmaxx // metatile_size, tmaxy // metatile_size,
+                                           self.options.tile_order):
+
+            # Top left tile of the metatile
+            mtminx = mtx * metatile_size
+            mtmaxy = mty * metatile_size + metatile_size - 1
+
+            # Tiles of the metatile within the bounds
+            tiles = [(tz, tx, ty)
+                     for ty in range(min(mtmaxy, tmaxy),
+                                     max(mtmaxy - metatile_size + 1, tminy) - 1, -1)
+                     for tx in range(max(mtminx, tminx),
+                                     min(mtminx + metatile_size - 1, tmaxx) + 1)]
+
+            if self.options.verbose:
+                for _, tx, ty in tiles:
+                    ti += 1
+                    tilefilename = os.path.join(
+                        self.output_folder, str(tz), str(tx), "%s.%s" % (ty, self.tileext))
+                    print(ti, '/', tcount, tilefilename)
+
+            tx, ty = mtminx, mtmaxy
+
+            if self.options.profile == 'mercator':
+                # Metatile bounds in EPSG:3857, from its lower left and upper right tiles
+                lower_left = self.mercator.TileBounds(tx, ty - metatile_size + 1, tz)
+                upper_right = self.mercator.TileBounds(tx + metatile_size - 1, ty, tz)
+            elif self.options.profile == 'geodetic':
+                lower_left = self.geodetic.TileBounds(tx, ty - metatile_size + 1, tz)
+                upper_right = self.geodetic.TileBounds(tx + metatile_size - 1, ty, tz)
+
+            # Don't scale up by nearest neighbour, better change the querysize
+            # to the native resolution (and return smaller query tile) for scaling
+
+            if self.options.profile in ('mercator', 'geodetic'):
+                b = (lower_left[0], lower_left[1], upper_right[2], upper_right[3])
+                rb, wb = self.geo_query(ds, b[0], b[3], b[2], b[1])
+
+                # Pixel size in the raster covering query geo extent
+                nativesize = wb[0] + wb[2]
+                if self.options.verbose:
+                    print("\tNative Extent (querysize", nativesize, "): ", rb, wb)
+
+                # Tile bounds in raster coordinates for ReadRaster query
+                rb, wb = self.geo_query(ds, b[0], b[3], b[2], b[1],
+                                        querysize=querysize * metatile_size)
+
+                rx, ry, rxsize, rysize = rb
+                wx, wy, wxsize, wysize = wb
+
+            else:     # 'raster' profile:
+
+                tsize = int(self.tsize[tz])   # tile_size in raster coordinates for actual zoom
+                xsize = self.warped_input_dataset.RasterXSize     # size of the raster in pixels
+                ysize = self.warped_input_dataset.RasterYSize
+                if tz >= self.nativezoom:
+                    querysize = self.tile_size
+
+                rx = (tx) * tsize
+                rxsize = 0
+                if tx == tmaxx:
+                    rxsize = xsize % tsize
+                if rxsize == 0:
+                    rxsize = tsize
+
+                rysize = 0
+                if ty == tmaxy:
+                    rysize = ysize % tsize
+                if rysize == 0:
+                    rysize = tsize
+                ry = ysize - (ty * tsize) - rysize
+
+                wx, wy = 0, 0
+                wxsize = int(rxsize / float(tsize) * self.tile_size)
+                wysize = int(rysize / float(tsize) * self.tile_size)
+                if wysize != self.tile_size:
+                    wy = self.tile_size - wysize
+
+            # With --update, only the metatiles with a tile whose input changed are generated
+            if self.manifest and not self.any_tile_changed(tiles, (rx, ry, rxsize, rysize)):
+                if self.options.verbose:
+                    print("\tTile generation skipped because its input did not change")
+                if skipped_tiles is not None:
+                    for tile in tiles:
+                        skipped_tiles.put((tile, False))
+                continue
+
+            # Do not even dispatch the tiles that would be excluded because they are transparent
+            if self.options.exclude_transparent and (
+                    rxsize == 0 or rysize == 0 or wxsize == 0 or wysize == 0 or
+                    (check_mask and
+                     self.is_empty_in_mask(mask_overview, rx, ry, rxsize, rysize))):
+                if self.options.verbose:
+                    print("\tTile generation skipped because the tile is empty")
+                if skipped_tiles is not None:
+                    for tile in tiles:
+                        skipped_tiles.put((tile, True))
+                continue
+
+            # Read the source raster if anything is going inside the tile as per the computed
+            # geo_query
+            yield TileDetail(
+                tx=tx, ty=ty, tz=tz, rx=rx, ry=ry, rxsize=rxsize, rysize=rysize, wx=wx,
+                wy=wy, wxsize=wxsize, wysize=wysize, querysize=querysize,
+                metatile_size=metatile_size,
+            )
+
+    def any_tile_changed(self, tiles, window):
+        """
+        Whether the input of any of the tiles of a metatile changed according to the manifest,
+        window being the window of the metatile with the 'raster' profile (where a metatile is a
+        single tile)
+        """
+        changed = False
+        for tile in tiles:
+            if self.options.profile == 'mercator':
+                b = self.mercator.TileBounds(tile[1], tile[2], tile[0])
+                window = self.geo_query(self.warped_input_dataset, b[0], b[3], b[2], b[1])[0]
+            elif self.options.profile == 'geodetic':
+                b = self.geodetic.TileBounds(tile[1], tile[2], tile[0])
+                window = self.geo_query(self.warped_input_dataset, b[0], b[3], b[2], b[1])[0]
+            # Record the new state of all the tiles
+            changed = self.manifest.tile_changed(tile, window) or changed
+        return changed
+
+    def get_planning_mask_overview(self):
+        """
+        Return the coarsest overview of the mask of the input raster that still has a few pixels
+        per base tile, from which the empty base tiles are detected when planning them. Returns
+        None if the input raster has no mask or no such overview.
+        """
+        ds = self.warped_input_dataset
+        mask_band = ds.GetRasterBand(1).GetMaskBand()
+        if ds.GetRasterBand(1).GetMaskFlags() == gdal.GMF_ALL_VALID:
+            return None
+
+        # Number of base tiles across the input raster
+        tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tmaxz]
+        min_xsize = 4 * (tmaxx - tminx + 1)
+        min_ysize = 4 * (tmaxy - tminy + 1)
+
+        mask_overview = None
+        for i in range(mask_band.GetOverviewCount()):
+            overview = mask_band.GetOverview(i)
+            if (overview.XSize >= min_xsize and overview.YSize >= min_ysize and
+                    (mask_overview is None or overview.XSize < mask_overview.XSize)):
+                mask_overview = overview
+        return mask_overview
+
+    def is_empty_in_mask(self, mask_overview, rx, ry, rxsize, rysize):
+        """
+        Whether the window of the input raster is known to be entirely masked without reading it
+        at full resolution, as this runs in the planning thread. The window is first checked in
+        mask_overview, if any, enlarged by one pixel of the overview, which is enough to tell
+        most windows with valid pixels cheaply. As an overview computed with NEAREST, or not
+        updated after the raster, may miss valid pixels, a window empty in the overview is only
+        reported empty if the driver reports no data in the mask there, as for the missing
+        blocks of a sparse GeoTIFF. The other windows are dispatched, and their transparency is
+        checked by the workers.
+        """
+        ds = self.warped_input_dataset
+        if mask_overview:
+            xfactor = mask_overview.XSize / float(ds.RasterXSize)
+            yfactor = mask_overview.YSize / float(ds.RasterYSize)
+
+            ox = max(0, int(math.floor(rx * xfactor)) - 1)
+            oy = max(0, int(math.floor(ry * yfactor)) - 1)
+            oxmax = min(mask_overview.XSize, int(math.ceil((rx + rxsize) * xfactor)) + 1)
+            oymax = min(mask_overview.YSize, int(math.ceil((ry + rysize) * yfactor)) + 1)
+
+            mask = mask_overview.ReadRaster(ox, oy, oxmax - ox, oymax - oy)
+            if len(mask) != mask.count('\x00'.encode('ascii')):
+                return False
+
+        band = ds.GetRasterBand(1)
+        if band.GetMaskFlags() & gdal.GMF_NODATA:
+            # The missing blocks of a sparse raster are read as the nodata value
+            coverage_band = band
+        else:
+            coverage_band = band.GetMaskBand()
+        status = coverage_band.GetDataCoverageStatus(rx, ry, rxsize, rysize)
+        return status == gdal.GDAL_DATA_COVERAGE_STATUS_EMPTY
 
     def geo_query(self, ds, ulx, uly, lrx, lry, querysize=0):
         """
@@ -2746,12 +4343,12 @@ class GDAL2Tiles(object):
         return s
 
 
-def worker_tile_details(input_file, output_folder, options):
+def worker_tile_details(input_file, output_folder, options, skipped_tiles=None):
       gdal2tiles = GDAL2Tiles(input_file, output_folder, options)
       gdal2tiles.open_input()
       gdal2tiles.generate_metadata()
-      tile_job_info, tile_details = gdal2tiles.generate_base_tiles()
-      return tile_job_info, tile_details
+      tile_job_info, tile_details = gdal2tiles.generate_base_tiles(skipped_tiles)
+      return tile_job_info, tile_details, gdal2tiles.manifest
 
 class ProgressBar(object):
 
@@ -2760,9 +4357,16 @@ class ProgressBar(object):
         self.nb_items_done = 0
         self.current_progress = 0
         self.STEP = 2.5
+        # Reference of the throughput shown every 10%
+        self.mark_time = None
+        self.mark_items = 0
 
-    def start(self):
+    def start(self, nb_items_done=0):
         sys.stdout.write("0")
+        if nb_items_done:
+            self.log_progress(nb_items_done)
+        self.mark_time = time.time()
+        self.mark_items = self.nb_items_done
 
     def log_progress(self, nb_items=1):
         self.nb_items_done += nb_items
@@ -2774,6 +4378,7 @@ class ProgressBar(object):
                     self.current_progress += self.STEP
                     if self.current_progress % 10 == 0:
                         sys.stdout.write(str(int(self.current_progress)))
+                        self.log_throughput()
                         if self.current_progress == 100:
                             sys.stdout.write("\n")
                     else:
@@ -2782,6 +4387,19 @@ class ProgressBar(object):
                     done = True
         sys.stdout.flush()
 
+    def log_throughput(self):
+        """
+        Show the number of tiles per second since the previous 10% step
+        """
+        now = time.time()
+        if (self.mark_time is None or now <= self.mark_time or
+                self.nb_items_done <= self.mark_items):
+            return
+        sys.stdout.write(" (%d tiles/s)" % ((self.nb_items_done - self.mark_items) /
+                                            (now - self.mark_time)))
+        self.mark_time = now
+        self.mark_items = self.nb_items_done
+
 
 def get_tile_swne(tile_job_info, options):
     if options.profile == 'mercator':
@@ -2821,68 +4439,230 @@ def get_tile_swne(tile_job_info, options):
     return tile_swne
 
 
+def report_skipped_base_tiles(skipped_tiles, scheduler, progress_bar):
+    """
+    Report to the OverviewTileScheduler the base tiles that have been skipped when planning them
+    """
+    while True:
+        try:
+            tile, changed = skipped_tiles.get(False)
+        except Empty:
+            return
+        # Skipped because they are empty, or because their input did not change
+        tiling_stats.count(tile[0], 'skipped_empty' if changed else 'skipped_unchanged')
+        scheduler.tile_done(tile, tile_blob=EMPTY_TILE if changed else None, changed=changed)
+        if progress_bar:
+            progress_bar.log_progress()
+
+
+def start_overview_progress(scheduler, options):
+    """
+    Start the progress report of the overview tiles, accounting for the ones that have already
+    been generated alongside the base tiles
+    """
+    if options.verbose or options.quiet or not scheduler.nb_tiles:
+        return None
+
+    print("Generating Overview Tiles:")
+    progress_bar = ProgressBar(scheduler.nb_tiles)
+    progress_bar.start(scheduler.nb_done)
+    return progress_bar
+
+
+def init_worker(src_file, src_vrt, cache_max):
+    """
+    Initialization of the pool workers. The VRT of the input is shared through /vsimem/, which
+    the workers inherit when they are forked, and is otherwise created from its content src_vrt.
+    """
+    gdal.SetCacheMax(cache_max)
+    if gdal.VSIStatL(src_file) is None:
+        gdal.FileFromMemBuffer(src_file, src_vrt)
+
+
+def report_tiling_stats(options, start_time):
+    """
+    Report the TilingStats of the run with --verbose, and write them to the --stats file
+    """
+    if options.verbose:
+        tiling_stats.report()
+    if options.stats_file:
+        tiling_stats.write(options.stats_file, time.time() - start_time)
+
+
 def single_threaded_tiling(input_file, output_folder, options):
     """
     Keep a single threaded version that stays clear of multiprocessing, for platforms that would not
     support it
     """
+    start_time = time.time()
     if options.verbose:
         print("Begin tiles details calc")
-    conf, tile_details = worker_tile_details(input_file, output_folder, options)
+    skipped_base_tiles = Queue()
+    conf, tile_details, manifest = worker_tile_details(input_file, output_folder, options,
+                                                       skipped_base_tiles)
 
     if options.verbose:
         print("Tiles details calc complete.")
 
+    tminx, tminy, tmaxx, tmaxy = conf.tminmax[conf.tmaxz]
+    nb_base_tiles = (1 + tmaxx - tminx) * (1 + tmaxy - tminy)
+
+    progress_bar = None
     if not options.verbose and not options.quiet:
-        progress_bar = ProgressBar(len(tile_details))
+        progress_bar = ProgressBar(nb_base_tiles)
         progress_bar.start()
 
-    for tile_detail in tile_details:
-        create_base_tile(conf, tile_detail)
+    def generate_overview_tile(overview_tile, children_data):
+        scheduler.tile_done(*create_overview_tile(conf, overview_tile, children_data))
+
+    # Overview tiles are generated as soon as their children are available, so that the
+    # children are still in the tile cache
+    tile_writer = get_tile_writer(conf)
+    scheduler = OverviewTileScheduler(conf, generate_overview_tile,
+                                      TileCache(options.overview_cache * 1024 * 1024),
+                                      tile_writer)
+
+    pipeline = BaseTilePipeline(conf)
+    for result in pipeline.run(tiling_stats.timed('plan', tile_details)):
+        report_skipped_base_tiles(skipped_base_tiles, scheduler, progress_bar)
 
-        if not options.verbose and not options.quiet:
+        scheduler.tile_done(*result)
+
+        if progress_bar:
             progress_bar.log_progress()
 
+    report_skipped_base_tiles(skipped_base_tiles, scheduler, progress_bar)
+
     if getattr(threadLocal, 'cached_ds', None):
         del threadLocal.cached_ds
+    if getattr(threadLocal, 'tile_reader', None):
+        threadLocal.tile_reader.close()
+        del threadLocal.tile_reader
+
+    # All the overview tiles have been generated along with the base tiles
+    start_overview_progress(scheduler, options)
 
-    create_overview_tiles(conf, output_folder, options)
+    if tile_writer:
+        tile_writer.close()
 
-    shutil.rmtree(os.path.dirname(conf.src_file))
+    # The tiles recorded in the manifest have all been generated
+    if manifest:
+        manifest.close()
+
+    gdal.Unlink(conf.src_file)
+
+    report_tiling_stats(options, start_time)
 
 
 def multi_threaded_tiling(input_file, output_folder, options):
     nb_processes = options.nb_processes or 1
 
     # Make sure that all processes do not consume more than GDAL_CACHEMAX
-    os.environ['GDAL_CACHEMAX'] = '%d' % int(gdal.GetCacheMax() / nb_processes)
+    cache_max = int(gdal.GetCacheMax() / nb_processes)
+    os.environ['GDAL_CACHEMAX'] = '%d' % cache_max
 
-    pool = Pool(processes=nb_processes)
+    start_time = time.time()
 
     if options.verbose:
         print("Begin tiles details calc")
 
-    conf, tile_details = pool.apply(worker_tile_details, [input_file, output_folder, options])
+    # The input is only opened by this process, which generates the tile details lazily and
+    # streams them to the workers, while they render the first tiles
+    skipped_base_tiles = Queue()
+    conf, tile_details, manifest = worker_tile_details(input_file, output_folder, options,
+                                                       skipped_base_tiles)
 
     if options.verbose:
         print("Tiles details calc complete.")
-        
+
+    pool = Pool(processes=nb_processes, initializer=init_worker,
+                initargs=(conf.src_file, read_vsimem_file(conf.src_file), cache_max))
+
+    tminx, tminy, tmaxx, tmaxy = conf.tminmax[conf.tmaxz]
+    nb_base_tiles = (1 + tmaxx - tminx) * (1 + tmaxy - tminy)
+
+    progress_bar = None
     if not options.verbose and not options.quiet:
-        progress_bar = ProgressBar(len(tile_details))
+        progress_bar = ProgressBar(nb_base_tiles)
         progress_bar.start()
 
+    # Overview tiles are submitted to the pool as soon as their four children exist, so that
+    # the zoom levels overlap with each other and with the base tiles. The exceptions of the jobs
+    # are returned as their results, to be raised by collect_overview_tile() instead of leaving
+    # it waiting for a result that never comes
+    completed_overview_tiles = Queue()
+    callbacks = {'callback': completed_overview_tiles.put}
+    if sys.version_info >= (3, 0):
+        # The errors raised outside of the job, such as when pickling its result
+        callbacks['error_callback'] = completed_overview_tiles.put
+
+    def submit_overview_tile(overview_tile, children_data):
+        pool.apply_async(run_and_collect_stats_or_error,
+                         (create_overview_tile, conf, overview_tile, children_data), **callbacks)
+
+    def collect_overview_tile(block):
+        result = completed_overview_tiles.get(block)
+        if isinstance(result, BaseException):
+            raise result
+        result, stats = result
+        tiling_stats.merge(stats)
+        scheduler.tile_done(*result)
+
+    def collect_completed_overview_tiles():
+        while scheduler.has_running_tiles():
+            try:
+                collect_overview_tile(False)
+            except Empty:
+                return
+
+    tile_writer = get_tile_writer(conf)
+    scheduler = OverviewTileScheduler(conf, submit_overview_tile,
+                                      TileCache(options.overview_cache * 1024 * 1024),
+                                      tile_writer)
+
+    # Keep the chunks of work of the same size in tiles whatever the size of the metatiles. As the
+    # tile details are generated along a space filling curve, each chunk covers a compact area
+    # of the input raster, whose blocks stay in the cache of the process rendering it. Each chunk
+    # is generated by the BaseTilePipeline of a process
+    chunksize = max(1, 128 // (options.metatile * options.metatile))
+    tile_details = group_tile_details(tiling_stats.timed('plan', tile_details), chunksize)
+
     # TODO: gbataille - check the confs for which each element is an array... one useless level?
     # TODO: gbataille - assign an ID to each job for print in verbose mode "ReadRaster Extent ..."
-    for _ in pool.imap_unordered(partial(create_base_tile, conf), tile_details, chunksize=128):
-        if not options.verbose and not options.quiet:
-            progress_bar.log_progress()
+    for results, stats in pool.imap_unordered(partial(run_and_collect_stats, create_base_tiles,
+                                                      conf), tile_details):
+        tiling_stats.merge(stats)
+        for result in results:
+            scheduler.tile_done(*result)
+        report_skipped_base_tiles(skipped_base_tiles, scheduler, progress_bar)
+        collect_completed_overview_tiles()
+
+        if progress_bar:
+            progress_bar.log_progress(len(results))
+
+    # The tile details have all been generated by now
+    report_skipped_base_tiles(skipped_base_tiles, scheduler, progress_bar)
+
+    progress_bar = start_overview_progress(scheduler, options)
+    while scheduler.has_running_tiles():
+        collect_overview_tile(True)
+        if progress_bar:
+            # Including the overview tiles skipped by --update along the way
+            progress_bar.log_progress(scheduler.nb_done - progress_bar.nb_items_done)
 
     pool.close()
     pool.join()     # Jobs finished
 
-    create_overview_tiles(conf, output_folder, options)
+    if tile_writer:
+        tile_writer.close()
+
+    # The tiles recorded in the manifest have all been generated
+    if manifest:
+        manifest.close()
+
+    gdal.Unlink(conf.src_file)
 
-    shutil.rmtree(os.path.dirname(conf.src_file))
+    report_tiling_stats(options, start_time)
 
 
 def main():
@@ -44,13 +44,31 @@
 ################################################################
 
 from optparse import OptionParser, OptionConflictError, Values
+from multiprocessing.pool import ThreadPool
+import ast
+import math
 import os
 import os.path
 import sys
 import shlex
+import threading
+from uuid import uuid4
 
-import numpy
+try:
+    from math import gcd
+except ImportError:
+    from fractions import gcd
 
+import numpy
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
 from osgeo import gdal
 from osgeo import gdalnumeric
 
@@ -62,6 +80,27 @@ AlphaList =  ["A", "B", "C", "D", "E", "F", "G", "H", "I", "J", "K", "L", "M",
 # set up some default nodatavalues for each datatype
 DefaultNDVLookup = {'Byte': 255, 'UInt16': 65535, 'Int16': -32767, 'UInt32': 4294967293, 'Int32': -2147483647, 'Float32': 3.402823466E+38, 'Float64': 1.7976931348623158E+308}
 
+# ways of reading input files on different grids, besides the grid of one of them
+ExtentList = ['fail', 'union', 'intersect']
+
+# backends evaluating the calculation on a block
+BackendList = ['numpy', 'chunked', 'numexpr']
+
+# number of pixels evaluated at once by the chunked backend, so that the
+# temporary arrays of the calculation stay in the CPU cache
+ChunkSize = 16384
+
+# element-wise functions allowed with the chunked backend, besides the numpy ufuncs and
+# scalar types
+ChunkedFunctions = [abs, numpy.where, numpy.clip]
+
+# syntax allowed with the chunked backend: operators, comparisons, conditional expressions,
+# calls, names and constants, but no subscripts, attributes of the inputs, comprehensions...
+ChunkedNodes = tuple(getattr(ast, name) for name in
+                     ('Expression', 'BinOp', 'UnaryOp', 'Compare', 'IfExp', 'Call', 'keyword',
+                      'Name', 'Load', 'Num', 'Str', 'NameConstant', 'Constant',
+                      'operator', 'unaryop', 'cmpop') if hasattr(ast, name))
+
 
 def DoesDriverHandleExtension(drv, ext):
     exts = drv.GetMetadataItem(gdal.DMD_EXTENSIONS)
@@ -111,26 +150,254 @@ def GetOutputDriverFor(filename):
         print("Several drivers matching %s extension. Using %s" % (ext, drv_list[0]))
     return drv_list[0]
 
+
+def GetReferencedNames(calc):
+    """ Return the names read by the calculation, leaving out the ones it binds itself
+    (comprehension variables, lambda arguments) and the branches of conditional
+    expressions that a constant condition never evaluates """
+    loaded = set()
+    bound = set()
+    nodes = [calc]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, ast.IfExp):
+            try:
+                test = ast.literal_eval(node.test)
+            except (ValueError, TypeError):
+                pass
+            else:
+                nodes.append(node.body if test else node.orelse)
+                continue
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loaded.add(node.id)
+            else:
+                bound.add(node.id)
+        elif hasattr(ast, 'arg') and isinstance(node, ast.arg):
+            bound.add(node.arg)
+        nodes.extend(ast.iter_child_nodes(node))
+    return loaded - bound
+
+
+def GetNodeName(node):
+    """ Return the dotted name of a name or attribute node, or its node type otherwise """
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return "%s.%s" % (GetNodeName(node.value), node.attr)
+    return type(node).__name__.lower()
+
+
+def GetNodeValue(node, global_namespace):
+    """ Return the function, module or constant a name or attribute node refers to, or None
+    for the input layers and anything else """
+    if isinstance(node, ast.Name):
+        if node.id in global_namespace:
+            return global_namespace[node.id]
+        return getattr(builtins, node.id, None)
+    if isinstance(node, ast.Attribute):
+        value = GetNodeValue(node.value, global_namespace)
+        if value is not None:
+            return getattr(value, node.attr, None)
+    return None
+
+
+def GetNonElementWise(calc, global_namespace, inputs):
+    """ Return the names of the parts of the calculation that are not known to be element-wise,
+    and so cannot be evaluated chunk by chunk: any syntax but operators, comparisons and calls,
+    functions other than the numpy ufuncs and scalar types, and attributes other than constants
+    (like A.T, A.mean or numpy.roll) """
+    found = set()
+    nodes = [calc]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, ast.Call):
+            func = GetNodeValue(node.func, global_namespace)
+            if not (isinstance(func, numpy.ufunc) or
+                    (isinstance(func, type) and issubclass(func, numpy.generic)) or
+                    any(func is f for f in ChunkedFunctions)) or \
+                    getattr(node, 'starargs', None) or getattr(node, 'kwargs', None):
+                found.add(GetNodeName(node.func))
+            nodes.extend(node.args)
+            nodes.extend(keyword.value for keyword in node.keywords)
+            continue
+        if isinstance(node, (ast.Name, ast.Attribute)):
+            if isinstance(node, ast.Name) and node.id in inputs:
+                continue
+            value = GetNodeValue(node, global_namespace)
+            if value is None or not isinstance(value, (int, float, complex, numpy.number)):
+                found.add(GetNodeName(node))
+            continue
+        if not isinstance(node, ChunkedNodes):
+            found.add(type(node).__name__.lower())
+        nodes.extend(ast.iter_child_nodes(node))
+    return found
+
+
+def GetBounds(ds, wkt):
+    """ Return the (xmin, ymin, xmax, ymax) bounds and the (xres, yres) resolution of a
+    dataset in the wkt projection, or in its own if either one is unknown """
+    geotransform = ds.GetGeoTransform()
+    xsize, ysize = ds.RasterXSize, ds.RasterYSize
+    projection = ds.GetProjection()
+    if (wkt and projection and projection != wkt) or geotransform[2] != 0 or geotransform[4] != 0:
+        warped = gdal.AutoCreateWarpedVRT(ds, projection or None, wkt or projection or None)
+        geotransform = warped.GetGeoTransform()
+        xsize, ysize = warped.RasterXSize, warped.RasterYSize
+        warped = None
+    bounds = (geotransform[0], geotransform[3] + ysize * geotransform[5],
+              geotransform[0] + xsize * geotransform[1], geotransform[3])
+    return bounds, (abs(geotransform[1]), abs(geotransform[5]))
+
+
+def GetCommonGrid(files, extent, wkt):
+    """ Return the geotransform and the size of the grid covering the union or the
+    intersection of the extents of the files in the wkt projection, at the finest of
+    their resolutions """
+    bounds, resolutions = zip(*[GetBounds(ds, wkt) for ds in files])
+    xres = min([res[0] for res in resolutions])
+    yres = min([res[1] for res in resolutions])
+    if extent == 'union':
+        xmin, ymin = min([b[0] for b in bounds]), min([b[1] for b in bounds])
+        xmax, ymax = max([b[2] for b in bounds]), max([b[3] for b in bounds])
+    else:
+        xmin, ymin = max([b[0] for b in bounds]), max([b[1] for b in bounds])
+        xmax, ymax = min([b[2] for b in bounds]), min([b[3] for b in bounds])
+        if xmin >= xmax or ymin >= ymax:
+            raise Exception("Error! The extents of the input files do not intersect.  Cannot proceed")
+    # a tolerance to not add a column or a row for rounding errors
+    xsize = max(1, int(math.ceil((xmax - xmin) / xres - 1e-6)))
+    ysize = max(1, int(math.ceil((ymax - ymin) / yres - 1e-6)))
+    return [xmin, xres, 0, ymax, 0, -yres], [xsize, ysize]
+
+
+def GetAlignedView(ds, filename, geotransform, size, wkt):
+    """ Return the dataset, or a warped VRT of it written to filename when it is not on the
+    grid given by geotransform, size and wkt.  The VRT has an alpha band, masking the pixels
+    outside of the dataset or of its mask, unless all the bands have a nodata value """
+    projection = ds.GetProjection()
+    if (list(ds.GetGeoTransform()) == list(geotransform) and
+            [ds.RasterXSize, ds.RasterYSize] == list(size) and
+            (not wkt or not projection or projection == wkt)):
+        return ds
+    # the VRT is not kept, so that it is closed and written as soon as it is created, and
+    # can be opened again by each thread
+    gdal.Warp(filename, ds, format='VRT',
+              outputBounds=(geotransform[0], geotransform[3] + size[1] * geotransform[5],
+                            geotransform[0] + size[0] * geotransform[1], geotransform[3]),
+              width=size[0], height=size[1],
+              dstSRS=wkt if (wkt and projection and projection != wkt) else None,
+              dstAlpha=any(ds.GetRasterBand(i + 1).GetNoDataValue() is None
+                           for i in range(ds.RasterCount)))
+    return gdal.Open(filename, gdal.GA_ReadOnly)
+
+
+def GetWindowSize(block_sizes, raster_size, bytes_per_pixel, max_memory):
+    """ Return the size of the windows processed at once: a multiple of the block sizes of all
+    the rasters, as large as fits in max_memory bytes, and full-width strips when possible """
+    unit = [1, 1]
+    for block_size in block_sizes:
+        for i in (0, 1):
+            unit[i] = unit[i] * block_size[i] // gcd(unit[i], block_size[i])
+    unit = [min(unit[i], raster_size[i]) for i in (0, 1)]
+
+    max_pixels = max(1, max_memory // bytes_per_pixel)
+    if unit[0] * unit[1] > max_pixels:
+        # no common multiple of the block sizes fits: align on the blocks of the first raster
+        unit = [min(block_sizes[0][i], raster_size[i]) for i in (0, 1)]
+
+    if raster_size[0] * unit[1] <= max_pixels:
+        xsize = raster_size[0]
+        ysize = max(unit[1], max_pixels // xsize // unit[1] * unit[1])
+    else:
+        ysize = unit[1]
+        xsize = max(unit[0], max_pixels // ysize // unit[0] * unit[0])
+    return [min(xsize, raster_size[0]), min(ysize, raster_size[1])]
+
+
+def GetNoDataType(ndv, out_type=None):
+    """ Return the smallest numpy type holding the nodata value, float32 for non-integer
+    values it represents exactly, or that a Float32 output stores rounded to float32 anyway
+    (like its default nodata value), and float64 otherwise """
+    ndv = float(ndv)
+    if ndv.is_integer() and -2**63 <= ndv < 2**64:
+        return numpy.min_scalar_type(int(ndv))
+    if not numpy.isfinite(ndv):
+        return numpy.dtype(numpy.float32)
+    if abs(ndv) <= float(numpy.finfo(numpy.float32).max) and \
+            (out_type == 'Float32' or float(numpy.float32(ndv)) == ndv):
+        return numpy.dtype(numpy.float32)
+    return numpy.dtype(numpy.float64)
+
+
+def EvalChunked(code, global_namespace, local_namespace, shape):
+    """ Evaluate an element-wise calculation over ChunkSize pixels at a time, writing each
+    chunk of the result into the output array, in the type of all the chunks.  Only a
+    calculation that does not use any input may give a scalar """
+    size = shape[0] * shape[1]
+    constant = not set(code.co_names) & set(local_namespace)
+    flat_namespace = dict([(key, numpy.ravel(value)) for key, value in local_namespace.items()])
+    myResult = None
+    for start in range(0, size, ChunkSize):
+        end = min(start + ChunkSize, size)
+        chunk_namespace = dict([(key, value[start:end]) for key, value in flat_namespace.items()])
+        myChunk = eval(code, global_namespace, chunk_namespace)
+        if numpy.shape(myChunk) != (end - start,) and not (constant and numpy.ndim(myChunk) == 0):
+            raise Exception("Error! the chunked backend only supports element-wise calculations")
+        myType = numpy.asarray(myChunk).dtype
+        if myResult is None:
+            myResult = numpy.empty(size, dtype=myType)
+        elif numpy.promote_types(myResult.dtype, myType) != myResult.dtype:
+            # a chunk of a wider type than the previous ones, which are converted to it
+            myResult = myResult.astype(numpy.promote_types(myResult.dtype, myType))
+        myResult[start:end] = myChunk
+    return myResult.reshape(shape)
+
 ################################################################
 
 
 def doit(opts, args):
     # pylint: disable=unused-argument
 
+    if not opts.calc:
+        raise Exception("No calculation provided.")
+    elif not opts.outF:
+        raise Exception("No output file provided.")
+
+    # several calculations can be given as a list, each one written to its own output file,
+    # or to the next band of a single output file
+    myCalcList = opts.calc if isinstance(opts.calc, list) else [opts.calc]
+    myOutFileList = opts.outF if isinstance(opts.outF, list) else [opts.outF]
+
     if opts.debug:
-        print("gdal_calc.py starting calculation %s" % (opts.calc))
+        print("gdal_calc.py starting calculation %s" % (", ".join(myCalcList)))
 
     # set up global namespace for eval with all functions of gdalnumeric
     global_namespace = dict([(key, getattr(gdalnumeric, key))
                              for key in dir(gdalnumeric) if not key.startswith('__')])
 
-    if not opts.calc:
-        raise Exception("No calculation provided.")
-    elif not opts.outF:
-        raise Exception("No output file provided.")
+    if len(myOutFileList) == 1:
+        myOutFileList = myOutFileList * len(myCalcList)
+    elif len(myOutFileList) != len(myCalcList):
+        raise Exception("Error! %d calculations were given for %d output files.  Cannot proceed" %
+                        (len(myCalcList), len(myOutFileList)))
+    if opts.allBands and len(myCalcList) > 1:
+        raise Exception("Error! allBands option cannot be used with several calculations.  Cannot proceed")
+
+    # parse and compile the calculations once, rather than for each block
+    myCalcs = []
+    myCodes = []
+    for calc in myCalcList:
+        try:
+            myCalcs.append(ast.parse(calc.strip(), mode='eval'))
+            myCodes.append(compile(myCalcs[-1], '<calc>', 'eval'))
+        except SyntaxError as e:
+            raise Exception("Error! invalid calculation %s: %s" % (calc, e))
 
-    if opts.format is None:
-        opts.format = GetOutputDriverFor(opts.outF)
+    if opts.backend not in BackendList:
+        raise Exception("Error! unknown backend %s, must be one of %s" % (opts.backend, BackendList))
+    if opts.backend == 'numexpr' and numexpr is None:
+        raise Exception("Error! the numexpr backend requires the numexpr module")
 
     ################################################################
     # fetch details of input layers
@@ -143,6 +410,8 @@ def doit(opts, args):
     myDataType = []
     myDataTypeNum = []
     myNDV = []
+    myUseMask = []
+    myRasterCount = []
     DimensionsCheck = None
 
     # loop through input files - checking dimensions
@@ -164,9 +433,14 @@ def doit(opts, args):
             myDataType.append(gdal.GetDataTypeName(myFile.GetRasterBand(myBand).DataType))
             myDataTypeNum.append(myFile.GetRasterBand(myBand).DataType)
             myNDV.append(myFile.GetRasterBand(myBand).GetNoDataValue())
-            # check that the dimensions of each layer are the same
+            myRasterCount.append(myFile.RasterCount)
+            # use the mask band of the file (.msk or internal mask), but not an alpha band,
+            # which is left to the calculation
+            myUseMask.append(myNDV[-1] is None and
+                             myFile.GetRasterBand(myBand).GetMaskFlags() == gdal.GMF_PER_DATASET)
+            # check that the dimensions of each layer are the same, unless --extent aligns them
             if DimensionsCheck:
-                if DimensionsCheck != [myFile.RasterXSize, myFile.RasterYSize]:
+                if DimensionsCheck != [myFile.RasterXSize, myFile.RasterYSize] and opts.extent == 'fail':
                     raise Exception("Error! Dimensions of file %s (%i, %i) are different from other files (%i, %i).  Cannot proceed" %
                                     (myF, myFile.RasterXSize, myFile.RasterYSize, DimensionsCheck[0], DimensionsCheck[1]))
             else:
@@ -175,6 +449,39 @@ def doit(opts, args):
             if opts.debug:
                 print("file %s: %s, dimensions: %s, %s, type: %s" % (myI, myF, DimensionsCheck[0], DimensionsCheck[1], myDataType[-1]))
 
+    # read the input files through views on a common grid
+    myViewFiles = []
+    if opts.extent != 'fail':
+        if opts.extent in myAlphaList:
+            myRefFile = myFiles[myAlphaList.index(opts.extent)]
+            myOutWkt = myRefFile.GetProjection()
+            myOutGeoTransform = myRefFile.GetGeoTransform()
+            DimensionsCheck = [myRefFile.RasterXSize, myRefFile.RasterYSize]
+        elif opts.extent in ExtentList:
+            # in the projection of the first input file in alphabetical order
+            myOutWkt = myFiles[myAlphaList.index(min(myAlphaList))].GetProjection()
+            myOutGeoTransform, DimensionsCheck = GetCommonGrid(myFiles, opts.extent, myOutWkt)
+        else:
+            raise Exception("Error! extent option must be one of %s or an input file (A-Z), not %s.  Cannot proceed" %
+                            (ExtentList, opts.extent))
+
+        if opts.debug:
+            print("reading the input files on a grid of %s x %s, geotransform: %s" %
+                  (DimensionsCheck[0], DimensionsCheck[1], myOutGeoTransform))
+
+        for i, Alpha in enumerate(myAlphaList):
+            myViewFile = '/vsimem/gdal_calc/%s_%s.vrt' % (uuid4(), Alpha)
+            myView = GetAlignedView(myFiles[i], myViewFile, myOutGeoTransform, DimensionsCheck, myOutWkt)
+            if myView is not myFiles[i]:
+                myViewFiles.append(myViewFile)
+                myFiles[i] = myView
+                # the nodata value is kept by the warping, otherwise the alpha band of the
+                # view masks the pixels outside of the file
+                myNDV[i] = myView.GetRasterBand(myBands[i]).GetNoDataValue()
+                myUseMask[i] = myNDV[i] is None
+                if opts.debug:
+                    print("file %s is read through a warped view" % Alpha)
+
     # process allBands option
     allBandsIndex = None
     allBandsCount = 1
@@ -183,179 +490,346 @@ def doit(opts, args):
             allBandsIndex = myAlphaList.index(opts.allBands)
         except ValueError:
             raise Exception("Error! allBands option was given but Band %s not found.  Cannot proceed" % (opts.allBands))
-        allBandsCount = myFiles[allBandsIndex].RasterCount
+        # not counting the alpha band added to a warped view
+        allBandsCount = myRasterCount[allBandsIndex]
         if allBandsCount <= 1:
             allBandsIndex = None
 
+    # check that the calculations only use input layers and known functions
+    myReferencedNames = set()
+    for calc, myCalc in zip(myCalcList, myCalcs):
+        myCalcNames = GetReferencedNames(myCalc)
+        myUnknownNames = myCalcNames - set(myAlphaList) - \
+            set(global_namespace) - set(dir(builtins))
+        if myUnknownNames:
+            raise Exception("Error! calculation %s uses %s, which are neither input layers nor functions.  Cannot proceed" %
+                            (calc, ", ".join(sorted(myUnknownNames))))
+        myReferencedNames |= myCalcNames
+        if opts.backend == 'chunked':
+            myNonElementWise = GetNonElementWise(myCalc, global_namespace, myAlphaList)
+            if myNonElementWise:
+                raise Exception("Error! the chunked backend only supports element-wise calculations, but calculation %s uses %s.  Cannot proceed" %
+                                (calc, ", ".join(sorted(myNonElementWise))))
+
+    # only read the input layers used by the calculations, or the nodata masks of the ones
+    # whose nodata pixels are propagated to the outputs
+    myReadInput = [Alpha in myReferencedNames or myNDV[i] is not None or myUseMask[i]
+                   for i, Alpha in enumerate(myAlphaList)]
+    if opts.debug:
+        for i, Alpha in enumerate(myAlphaList):
+            if not myReadInput[i]:
+                print("file %s is not used by the calculations, skipping it" % Alpha)
+            elif Alpha not in myReferencedNames:
+                print("file %s is not used by the calculations, only reading its nodata mask" % Alpha)
+
     ################################################################
-    # set up output file
+    # set up output files
     ################################################################
 
-    # open output file exists
-    if os.path.isfile(opts.outF) and not opts.overwrite:
-        if allBandsIndex is not None:
-            raise Exception("Error! allBands option was given but Output file exists, must use --overwrite option!")
-        if opts.debug:
-            print("Output file %s exists - filling in results into file" % (opts.outF))
-        myOut = gdal.Open(opts.outF, gdal.GA_Update)
-        if [myOut.RasterXSize, myOut.RasterYSize] != DimensionsCheck:
-            raise Exception("Error! Output exists, but is the wrong size.  Use the --overwrite option to automatically overwrite the existing file")
-        myOutB = myOut.GetRasterBand(1)
-        myOutNDV = myOutB.GetNoDataValue()
-        myOutType = gdal.GetDataTypeName(myOutB.DataType)
-
-    else:
-        # remove existing file and regenerate
-        if os.path.isfile(opts.outF):
-            os.remove(opts.outF)
-        # create a new file
-        if opts.debug:
-            print("Generating output file %s" % (opts.outF))
+    # the output files, in the order of their first calculation, and for each calculation
+    # the index of its output file and the band of that file it writes
+    myOutFiles = []
+    myCalcOut = []
+    myCalcBand = []
+    for outF in myOutFileList:
+        if outF not in myOutFiles:
+            myOutFiles.append(outF)
+        myCalcOut.append(myOutFiles.index(outF))
+        myCalcBand.append(myCalcOut.count(myCalcOut[-1]))
+
+    # set up some lists to store data for each output file
+    myOuts = []
+    myOutNDVList = []
+    myOutTypeList = []
+    myOutNDVTypeList = []
+
+    for myOutIndex, outF in enumerate(myOutFiles):
+        myOutBandCount = allBandsCount * myCalcOut.count(myOutIndex)
+
+        # open output file exists
+        if os.path.isfile(outF) and not opts.overwrite:
+            if allBandsIndex is not None:
+                raise Exception("Error! allBands option was given but Output file exists, must use --overwrite option!")
+            if opts.debug:
+                print("Output file %s exists - filling in results into file" % (outF))
+            myOut = gdal.Open(outF, gdal.GA_Update)
+            if [myOut.RasterXSize, myOut.RasterYSize] != DimensionsCheck:
+                raise Exception("Error! Output exists, but is the wrong size.  Use the --overwrite option to automatically overwrite the existing file")
+            if myOut.RasterCount < myOutBandCount:
+                raise Exception("Error! Output exists, but has less than %d bands.  Use the --overwrite option to automatically overwrite the existing file" % myOutBandCount)
+            myOutB = myOut.GetRasterBand(1)
+            myOutNDV = myOutB.GetNoDataValue()
+            myOutType = gdal.GetDataTypeName(myOutB.DataType)
 
-        # find data type to use
-        if not opts.type:
-            # use the largest type of the input files
-            myOutType = gdal.GetDataTypeName(max(myDataTypeNum))
         else:
-            myOutType = opts.type
+            # remove existing file and regenerate
+            if os.path.isfile(outF):
+                os.remove(outF)
+            # create a new file
+            if opts.debug:
+                print("Generating output file %s" % (outF))
 
-        # create file
-        myOutDrv = gdal.GetDriverByName(opts.format)
-        myOut = myOutDrv.Create(
-            opts.outF, DimensionsCheck[0], DimensionsCheck[1], allBandsCount,
-            gdal.GetDataTypeByName(myOutType), opts.creation_options)
+            # find data type to use
+            if not opts.type:
+                # use the largest type of the input files
+                myOutType = gdal.GetDataTypeName(max(myDataTypeNum))
+            else:
+                myOutType = opts.type
 
-        # set output geo info based on first input layer
-        myOut.SetGeoTransform(myFiles[0].GetGeoTransform())
-        myOut.SetProjection(myFiles[0].GetProjection())
+            # create file
+            if opts.format is None:
+                myOutDrv = gdal.GetDriverByName(GetOutputDriverFor(outF))
+            else:
+                myOutDrv = gdal.GetDriverByName(opts.format)
+            myOut = myOutDrv.Create(
+                outF, DimensionsCheck[0], DimensionsCheck[1], myOutBandCount,
+                gdal.GetDataTypeByName(myOutType), opts.creation_options)
 
-        if opts.NoDataValue is not None:
-            myOutNDV = opts.NoDataValue
-        else:
-            myOutNDV = DefaultNDVLookup[myOutType]
+            # set output geo info based on first input layer
+            myOut.SetGeoTransform(myFiles[0].GetGeoTransform())
+            myOut.SetProjection(myFiles[0].GetProjection())
 
-        for i in range(1, allBandsCount + 1):
-            myOutB = myOut.GetRasterBand(i)
-            myOutB.SetNoDataValue(myOutNDV)
-            # write to band
-            myOutB = None
+            if opts.NoDataValue is not None:
+                myOutNDV = opts.NoDataValue
+            else:
+                myOutNDV = DefaultNDVLookup[myOutType]
+
+            for i in range(1, myOutBandCount + 1):
+                myOutB = myOut.GetRasterBand(i)
+                myOutB.SetNoDataValue(myOutNDV)
+                # write to band
+                myOutB = None
+
+        myOuts.append(myOut)
+        myOutNDVList.append(myOutNDV)
+        myOutTypeList.append(myOutType)
+        # smallest type holding the output nodata value, into which the results are promoted
+        # when they have nodata pixels
+        if myOutNDV is not None:
+            myOutNDVTypeList.append(GetNoDataType(myOutNDV, myOutType))
+        else:
+            myOutNDVTypeList.append(None)
 
-    if opts.debug:
-        print("output file: %s, dimensions: %s, %s, type: %s" % (opts.outF, myOut.RasterXSize, myOut.RasterYSize, myOutType))
+        if opts.debug:
+            print("output file: %s, dimensions: %s, %s, type: %s" % (outF, myOut.RasterXSize, myOut.RasterYSize, myOutType))
 
     ################################################################
     # find block size to chop grids into bite-sized chunks
     ################################################################
 
-    # use the block size of the first layer to read efficiently
-    myBlockSize = myFiles[0].GetRasterBand(myBands[0]).GetBlockSize()
+    # read and write whole blocks of all the layers, in windows as large as --max-memory allows
+    myBlockSizes = [myFile.GetRasterBand(myBand).GetBlockSize()
+                    for myFile, myBand in zip(myFiles, myBands)]
+    myBlockSizes.extend([myOut.GetRasterBand(1).GetBlockSize() for myOut in myOuts])
+    # input arrays, nodata mask, and the output array and float64 result of each calculation
+    myBytesPerPixel = sum([gdal.GetDataTypeSize(myType) // 8 for myType in myDataTypeNum]) + 8
+    for myOutIndex in myCalcOut:
+        myBytesPerPixel += gdal.GetDataTypeSize(
+            gdal.GetDataTypeByName(myOutTypeList[myOutIndex])) // 8 + 8
+    # with --threads, up to 2 windows per thread are in memory at once
+    myWindowCount = 2 * opts.threads if opts.threads > 1 else 1
+    myBlockSize = GetWindowSize(myBlockSizes, DimensionsCheck, myBytesPerPixel,
+                                opts.max_memory * 1024 * 1024 // myWindowCount)
     # find total x and y blocks to be read
     nXBlocks = (int)((DimensionsCheck[0] + myBlockSize[0] - 1) / myBlockSize[0])
     nYBlocks = (int)((DimensionsCheck[1] + myBlockSize[1] - 1) / myBlockSize[1])
-    myBufSize = myBlockSize[0] * myBlockSize[1]
 
     if opts.debug:
-        print("using blocksize %s x %s" % (myBlockSize[0], myBlockSize[1]))
+        print("using window size %s x %s" % (myBlockSize[0], myBlockSize[1]))
 
     # variables for displaying progress
     ProgressCt = -1
     ProgressMk = -1
     ProgressEnd = nXBlocks * nYBlocks * allBandsCount
 
-    ################################################################
-    # start looping through each band in allBandsCount
-    ################################################################
-
-    for bandNo in range(1, allBandsCount + 1):
-
-        ################################################################
-        # start looping through blocks of data
-        ################################################################
-        
-        # store these numbers in variables that may change later
-        nXValid = myBlockSize[0]
-        nYValid = myBlockSize[1]
+    def GetBlocks():
+        """ Yield the (bandNo, xoff, yoff, xsize, ysize) of the blocks to compute, in the order
+        in which they are written """
 
         # loop through X-lines
         for X in range(0, nXBlocks):
 
             # in case the blocks don't fit perfectly
             # change the block size of the final piece
+            nXValid = myBlockSize[0]
             if X == nXBlocks - 1:
                 nXValid = DimensionsCheck[0] - X * myBlockSize[0]
 
-            # find X offset
-            myX = X * myBlockSize[0]
-
-            # reset buffer size for start of Y loop
-            nYValid = myBlockSize[1]
-            myBufSize = nXValid * nYValid
-
             # loop through Y lines
             for Y in range(0, nYBlocks):
-                ProgressCt += 1
-                if 10 * ProgressCt / ProgressEnd % 10 != ProgressMk and not opts.quiet:
-                    ProgressMk = 10 * ProgressCt / ProgressEnd % 10
-                    from sys import version_info
-                    if version_info >= (3, 0, 0):
-                        exec('print("%d.." % (10*ProgressMk), end=" ")')
-                    else:
-                        exec('print 10*ProgressMk, "..",')
 
                 # change the block size of the final piece
+                nYValid = myBlockSize[1]
                 if Y == nYBlocks - 1:
                     nYValid = DimensionsCheck[1] - Y * myBlockSize[1]
-                    myBufSize = nXValid * nYValid
 
-                # find Y offset
-                myY = Y * myBlockSize[1]
+                # loop through each band in allBandsCount last, so that the layers not
+                # iterated by --allBands are read once for all the bands of a window
+                for bandNo in range(1, allBandsCount + 1):
+                    yield bandNo, X * myBlockSize[0], Y * myBlockSize[1], nXValid, nYValid
+
+    # with --threads, each thread reads the input files through its own datasets
+    # and keeps its own copy of the layers not iterated by --allBands
+    threadData = threading.local()
+
+    def CalcBlock(block):
+        """ Read a block of the input layers and compute the block of each calculation """
+        bandNo, myX, myY, nXValid, nYValid = block
 
-                # create empty buffer to mark where nodata occurs
-                myNDVs = None
+        if opts.threads > 1:
+            if not hasattr(threadData, 'files'):
+                threadData.files = [gdal.Open(myFile.GetDescription(), gdal.GA_ReadOnly)
+                                    for myFile in myFiles]
+            myBlockFiles = threadData.files
+        else:
+            myBlockFiles = myFiles
+
+        # values and nodata masks of the layers not iterated by --allBands in this window
+        myWindow = (myX, myY, nXValid, nYValid)
+        if getattr(threadData, 'window', None) != myWindow:
+            threadData.window = myWindow
+            threadData.inputs = {}
+        myWindowInputs = threadData.inputs
+
+        # boolean mask of the pixels where any input is nodata
+        myNDVs = None
 
-                # make local namespace for calculation
-                local_namespace = {}
+        # make local namespace for calculation
+        local_namespace = {}
 
-                # fetch data for each input layer
-                for i, Alpha in enumerate(myAlphaList):
+        # fetch data for each input layer
+        for i, Alpha in enumerate(myAlphaList):
+            if not myReadInput[i]:
+                continue
 
-                    # populate lettered arrays with values
-                    if allBandsIndex is not None and allBandsIndex == i:
-                        myBandNo = bandNo
-                    else:
-                        myBandNo = myBands[i]
-                    myval = gdalnumeric.BandReadAsArray(myFiles[i].GetRasterBand(myBandNo),
-                                                        xoff=myX, yoff=myY,
+            myIterated = allBandsIndex is not None and allBandsIndex == i
+            if not myIterated and i in myWindowInputs:
+                myval, myInvalid = myWindowInputs[i]
+            else:
+                # populate lettered arrays with values
+                if myIterated:
+                    myBandNo = bandNo
+                else:
+                    myBandNo = myBands[i]
+                myBand = myBlockFiles[i].GetRasterBand(myBandNo)
+                myval = None
+                if Alpha in myReferencedNames:
+                    myval = gdalnumeric.BandReadAsArray(myBand, xoff=myX, yoff=myY,
                                                         win_xsize=nXValid, win_ysize=nYValid)
 
-                    # fill in nodata values
-                    if myNDV[i] is not None:
-                        if myNDVs is None:
-                            myNDVs = numpy.zeros(myBufSize)
-                            myNDVs.shape = (nYValid, nXValid)
-                        myNDVs = 1 * numpy.logical_or(myNDVs == 1, myval == myNDV[i])
-
-                    # add an array of values for this block to the eval namespace
-                    local_namespace[Alpha] = myval
-                    myval = None
-
-                # try the calculation on the array blocks
-                try:
-                    myResult = eval(opts.calc, global_namespace, local_namespace)
-                except:
-                    print("evaluation of calculation %s failed" % (opts.calc))
-                    raise
-
-                # Propagate nodata values (set nodata cells to zero
-                # then add nodata value to these cells).
-                if myNDVs is not None:
-                    myResult = ((1 * (myNDVs == 0)) * myResult) + (myOutNDV * myNDVs)
-                elif not isinstance(myResult, numpy.ndarray):
-                    myResult = numpy.ones((nYValid, nXValid)) * myResult
-
-                # write data block to the output file
-                myOutB = myOut.GetRasterBand(bandNo)
+                # find nodata values, from the nodata mask band of the input layers whose
+                # values are not used
+                myInvalid = None
+                if myNDV[i] is not None and myval is not None:
+                    myInvalid = myval == myNDV[i]
+                elif myNDV[i] is not None or myUseMask[i]:
+                    myInvalid = gdalnumeric.BandReadAsArray(myBand.GetMaskBand(),
+                                                            xoff=myX, yoff=myY,
+                                                            win_xsize=nXValid,
+                                                            win_ysize=nYValid) == 0
+                if not myIterated:
+                    myWindowInputs[i] = (myval, myInvalid)
+
+            # fill in nodata values, without modifying the masks kept for the other bands
+            if myInvalid is not None:
+                if myNDVs is None:
+                    myNDVs = myInvalid
+                else:
+                    myNDVs = numpy.logical_or(myNDVs, myInvalid)
+                myInvalid = None
+
+            # add an array of values for this block to the eval namespace
+            if Alpha in myReferencedNames:
+                local_namespace[Alpha] = myval
+            myval = None
+
+        # evaluate each calculation on the same array blocks
+        myBlockResults = []
+        for calc, myCode, myOutIndex in zip(myCalcList, myCodes, myCalcOut):
+
+            # try the calculation on the array blocks
+            try:
+                if opts.backend == 'numexpr':
+                    myResult = numexpr.evaluate(calc, local_dict=local_namespace, global_dict={})
+                elif opts.backend == 'chunked':
+                    myResult = EvalChunked(myCode, global_namespace, local_namespace,
+                                           (nYValid, nXValid))
+                else:
+                    myResult = eval(myCode, global_namespace, local_namespace)
+            except:
+                print("evaluation of calculation %s failed" % (calc))
+                raise
+
+            # Propagate nodata values, in the type of the result unless it cannot hold the
+            # output nodata value
+            myOutNDV = myOutNDVList[myOutIndex]
+            if myNDVs is not None and myOutNDV is not None:
+                myResultType = numpy.promote_types(numpy.asarray(myResult).dtype,
+                                                   myOutNDVTypeList[myOutIndex])
+                myResult = numpy.where(myNDVs, myResultType.type(myOutNDV), myResult)
+                myResult = myResult.astype(myResultType, copy=False)
+            elif numpy.shape(myResult) != (nYValid, nXValid):
+                myResult = numpy.ones((nYValid, nXValid)) * myResult
+
+            myBlockResults.append(myResult)
+            myResult = None
+
+        return block, myBlockResults
+
+    ################################################################
+    # compute the blocks, concurrently with --threads, and write them
+    # in order from this thread
+    ################################################################
+
+    myPool = None
+    if opts.threads > 1:
+        myPool = ThreadPool(opts.threads)
+        # cap the number of blocks read or computed ahead of the writes
+        myInFlight = threading.Semaphore(2 * opts.threads)
+        myStopping = []
+
+        def ThrottleBlocks(blocks):
+            for block in blocks:
+                myInFlight.acquire()
+                if myStopping:
+                    return
+                yield block
+
+        myComputedBlocks = myPool.imap(CalcBlock, ThrottleBlocks(GetBlocks()))
+    else:
+        myComputedBlocks = (CalcBlock(block) for block in GetBlocks())
+
+    try:
+        for (bandNo, myX, myY, nXValid, nYValid), myBlockResults in myComputedBlocks:
+            ProgressCt += 1
+            if 10 * ProgressCt / ProgressEnd % 10 != ProgressMk and not opts.quiet:
+                ProgressMk = 10 * ProgressCt / ProgressEnd % 10
+                from sys import version_info
+                if version_info >= (3, 0, 0):
+                    exec('print("%d.." % (10*ProgressMk), end=" ")')
+                else:
+                    exec('print 10*ProgressMk, "..",')
+
+            # write the data block of each calculation to its output file, bandNo being the
+            # band iterated by --allBands, which only allows a single calculation
+            for myCalcIndex, myResult in enumerate(myBlockResults):
+                myOut = myOuts[myCalcOut[myCalcIndex]]
+                myOutB = myOut.GetRasterBand(myCalcBand[myCalcIndex] + bandNo - 1)
                 gdalnumeric.BandWriteArray(myOutB, myResult, xoff=myX, yoff=myY)
+            myBlockResults = None
+
+            if myPool:
+                myInFlight.release()
+    finally:
+        if myPool:
+            # unblock the generation of the blocks if it is waiting for a write
+            myStopping.append(True)
+            myInFlight.release()
+            myPool.terminate()
+            myPool.join()
+
+    for myViewFile in myViewFiles:
+        gdal.Unlink(myViewFile)
 
     if not opts.quiet:
         print("100 - Done")
@@ -363,7 +837,7 @@ def doit(opts, args):
 ################################################################
 
 
-def Calc(calc, outfile, NoDataValue=None, type=None, format=None, creation_options=None, allBands='', overwrite=False, debug=False, quiet=False, **input_files):
+def Calc(calc, outfile, NoDataValue=None, type=None, format=None, creation_options=None, allBands='', overwrite=False, debug=False, quiet=False, threads=1, backend='numpy', max_memory=64, extent='fail', **input_files):
     """ Perform raster calculations with numpy syntax.
     Use any basic arithmetic supported by numpy arrays such as +-*\ along with logical
     operators such as >. Note that all files must have the same dimensions, but no projection checking is performed.
@@ -381,6 +855,12 @@ def Calc(calc, outfile, NoDataValue=None, type=None, format=None, creation_optio
 
     set values of zero and below to null:
         Calc(calc="A*(A>0)", A="input.tif", A_band=2, outfile="result.tif", NoDataValue=0)
+
+    compute several calculations in a single pass, each one in its own file:
+        Calc(calc=["A+B", "A-B"], A="input1.tif", B="input2.tif", outfile=["sum.tif", "diff.tif"])
+
+    or as the bands of a single file:
+        Calc(calc=["A+B", "A-B"], A="input1.tif", B="input2.tif", outfile="result.tif")
     """
     opts = Values()
     opts.input_files = input_files
@@ -394,6 +874,10 @@ def Calc(calc, outfile, NoDataValue=None, type=None, format=None, creation_optio
     opts.overwrite = overwrite
     opts.debug = debug
     opts.quiet = quiet
+    opts.threads = threads
+    opts.backend = backend
+    opts.max_memory = max_memory
+    opts.extent = extent
 
     doit(opts, None)
 
@@ -422,10 +906,10 @@ def main():
     parser = OptionParser(usage)
 
     # define options
-    parser.add_option("--calc", dest="calc", help="calculation in gdalnumeric syntax using +-/* or any numpy array functions (i.e. log10())", metavar="expression")
+    parser.add_option("--calc", dest="calc", action="append", help="calculation in gdalnumeric syntax using +-/* or any numpy array functions (i.e. log10()), may be repeated to compute several calculations in a single pass", metavar="expression")
     add_alpha_args(parser, sys.argv)
 
-    parser.add_option("--outfile", dest="outF", help="output file to generate or fill", metavar="filename")
+    parser.add_option("--outfile", dest="outF", action="append", help="output file to generate or fill, may be repeated to give the output file of each calculation (default one band per calculation in a single file)", metavar="filename")
     parser.add_option("--NoDataValue", dest="NoDataValue", type=float, help="output nodata value (default datatype specific value)", metavar="value")
     parser.add_option("--type", dest="type", help="output datatype, must be one of %s" % list(DefaultNDVLookup.keys()), metavar="datatype")
     parser.add_option("--format", dest="format", help="GDAL format for output file", metavar="gdal_format")
@@ -438,6 +922,10 @@ def main():
     parser.add_option("--overwrite", dest="overwrite", action="store_true", help="overwrite output file if it already exists")
     parser.add_option("--debug", dest="debug", action="store_true", help="print debugging information")
     parser.add_option("--quiet", dest="quiet", action="store_true", help="suppress progress messages")
+    parser.add_option("--extent", dest="extent", default="fail", help="how to handle input files of different dimensions: fail, or read them on the union or the intersection of their extents, or on the grid of the given input file (A-Z) (default fail)", metavar="fail|union|intersect|[A-Z]")
+    parser.add_option("--threads", dest="threads", type=int, default=1, help="number of threads reading and computing the blocks (default 1)", metavar="n")
+    parser.add_option("--max-memory", dest="max_memory", type=int, default=64, help="memory for the windows of the layers processed at once, in MB (default 64)", metavar="MB")
+    parser.add_option("--backend", dest="backend", type="choice", choices=BackendList, default="numpy", help="how to evaluate the calculation, must be one of %s (default numpy)" % BackendList, metavar="backend")
     parser.add_option("--optfile", dest="optfile", metavar="optfile", help="Read the named file and substitute the contents into the command line options list.")
 
     (opts, args) = parser.parse_args()
@@ -471,6 +959,14 @@ def main():
         print("No output file provided. Cannot proceed.")
         parser.print_help()
         sys.exit(1)
+    elif opts.threads < 1:
+        print("The number of threads must be at least 1.")
+        parser.print_help()
+        sys.exit(1)
+    elif opts.max_memory < 1:
+        print("The maximum memory must be at least 1 MB.")
+        parser.print_help()
+        sys.exit(1)
     else:
         try:
             doit(opts, args)
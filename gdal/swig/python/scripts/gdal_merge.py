@@ -30,10 +30,14 @@
 # building the stack.
 # anssi.pekkarinen@fao.org
 
+import collections
+import json
 import math
 import os.path
 import sys
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
 from osgeo import gdal
 
@@ -43,6 +47,13 @@ __version__ = '$id$'[5:-1]
 verbose = 0
 quiet = 0
 
+# Default maximum memory, in bytes, used by the arrays of the copies.
+DEFAULT_MAX_MEMORY = 64 * 1024 * 1024
+max_memory = DEFAULT_MAX_MEMORY
+
+# Maximum number of source files kept open by -blockwise.
+MAX_OPEN_DATASETS = 64
+
 
 def DoesDriverHandleExtension(drv, ext):
     exts = drv.GetMetadataItem(gdal.DMD_EXTENSIONS)
@@ -109,14 +120,7 @@ def raster_copy(s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
             t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n,
             nodata)
 
-    s_band = s_fh.GetRasterBand(s_band_n)
-    m_band = None
-    # Works only in binary mode and doesn't take into account
-    # intermediate transparency values for compositing.
-    if s_band.GetMaskFlags() != gdal.GMF_ALL_VALID:
-        m_band = s_band.GetMaskBand()
-    elif s_band.GetColorInterpretation() == gdal.GCI_AlphaBand:
-        m_band = s_band
+    m_band = get_mask_band(s_fh.GetRasterBand(s_band_n))
     if m_band is not None:
         return raster_copy_with_mask(
             s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
@@ -126,16 +130,107 @@ def raster_copy(s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
     s_band = s_fh.GetRasterBand(s_band_n)
     t_band = t_fh.GetRasterBand(t_band_n)
 
-    data = s_band.ReadRaster(s_xoff, s_yoff, s_xsize, s_ysize,
-                             t_xsize, t_ysize, t_band.DataType)
-    t_band.WriteRaster(t_xoff, t_yoff, t_xsize, t_ysize,
-                       data, t_xsize, t_ysize, t_band.DataType)
+    pixel_bytes = gdal.GetDataTypeSize(t_band.DataType) // 8
+    for xoff, yoff, xsize, ysize in get_copy_chunks(t_band, t_xoff, t_yoff, t_xsize, t_ysize,
+                                                    pixel_bytes):
+        c_xoff, c_yoff, c_xsize, c_ysize = get_source_chunk(
+            s_xoff, s_yoff, s_xsize, s_ysize, t_xoff, t_yoff, t_xsize, t_ysize,
+            xoff, yoff, xsize, ysize)
+        data = s_band.ReadRaster(c_xoff, c_yoff, c_xsize, c_ysize,
+                                 xsize, ysize, t_band.DataType)
+        t_band.WriteRaster(xoff, yoff, xsize, ysize,
+                           data, xsize, ysize, t_band.DataType)
 
     return 0
 
 # =============================================================================
 
 
+def get_chunks(xoff, yoff, xsize, ysize, block_xsize, block_ysize, max_pixels):
+    """
+    Return the (xoff, yoff, xsize, ysize) chunks of a window of a band, in the
+    order of its blocks.
+
+    The chunks are made of whole blocks of the band, clipped to the window.
+    Small blocks are grouped into chunks of up to the full width of the window
+    and of at most max_pixels pixels, unless a single block is larger.
+    """
+    if xsize * block_ysize <= max_pixels:
+        chunk_xsize = xsize
+        chunk_ysize = max(1, max_pixels // (xsize * block_ysize)) * block_ysize
+        xs = [xoff, xoff + xsize]
+    else:
+        chunk_xsize = max(1, max_pixels // (block_xsize * block_ysize)) * block_xsize
+        chunk_ysize = block_ysize
+        xs = get_chunk_bounds(xoff, xsize, chunk_xsize)
+    ys = get_chunk_bounds(yoff, ysize, chunk_ysize)
+
+    return [(x0, y0, x1 - x0, y1 - y0)
+            for y0, y1 in zip(ys[:-1], ys[1:])
+            for x0, x1 in zip(xs[:-1], xs[1:])]
+
+
+def get_chunk_bounds(off, size, chunk_size):
+    """Split [off, off + size] at the multiples of chunk_size."""
+    return [off] + list(range((off // chunk_size + 1) * chunk_size, off + size, chunk_size)) + \
+        [off + size]
+
+# =============================================================================
+
+
+def get_copy_chunks(t_band, t_xoff, t_yoff, t_xsize, t_ysize, pixel_bytes):
+    """
+    Return the chunks of a window of a target band to copy one at a time, so
+    that the arrays of pixel_bytes bytes per pixel of a chunk fit in
+    max_memory.
+    """
+    block_xsize, block_ysize = t_band.GetBlockSize()
+    return get_chunks(t_xoff, t_yoff, t_xsize, t_ysize, block_xsize, block_ysize,
+                      max(1, max_memory // pixel_bytes))
+
+
+def get_source_chunk(s_xoff, s_yoff, s_xsize, s_ysize,
+                     t_xoff, t_yoff, t_xsize, t_ysize,
+                     xoff, yoff, xsize, ysize):
+    """
+    Return the window of the source matching a chunk of the target window.
+
+    When the source is resampled, the window is in fractional pixels, so that
+    the pixels of the chunk are the ones a copy of the whole window would get.
+    """
+    if s_xsize == t_xsize:
+        c_xoff = s_xoff + xoff - t_xoff
+        c_xsize = xsize
+    else:
+        c_xoff = s_xoff + (xoff - t_xoff) * float(s_xsize) / t_xsize
+        c_xsize = xsize * float(s_xsize) / t_xsize
+    if s_ysize == t_ysize:
+        c_yoff = s_yoff + yoff - t_yoff
+        c_ysize = ysize
+    else:
+        c_yoff = s_yoff + (yoff - t_yoff) * float(s_ysize) / t_ysize
+        c_ysize = ysize * float(s_ysize) / t_ysize
+    return c_xoff, c_yoff, c_xsize, c_ysize
+
+# =============================================================================
+
+
+def get_mask_band(s_band):
+    """
+    Return the band whose zero pixels are not to be copied from s_band, or
+    None if all its pixels are to be copied.
+    """
+    # Works only in binary mode and doesn't take into account
+    # intermediate transparency values for compositing.
+    if s_band.GetMaskFlags() != gdal.GMF_ALL_VALID:
+        return s_band.GetMaskBand()
+    elif s_band.GetColorInterpretation() == gdal.GCI_AlphaBand:
+        return s_band
+    return None
+
+# =============================================================================
+
+
 def raster_copy_with_nodata(s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
                             t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n,
                             nodata):
@@ -147,18 +242,26 @@ def raster_copy_with_nodata(s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
     s_band = s_fh.GetRasterBand(s_band_n)
     t_band = t_fh.GetRasterBand(t_band_n)
 
-    data_src = s_band.ReadAsArray(s_xoff, s_yoff, s_xsize, s_ysize,
-                                  t_xsize, t_ysize)
-    data_dst = t_band.ReadAsArray(t_xoff, t_yoff, t_xsize, t_ysize)
+    # The source, destination, nodata test and result arrays of a chunk.
+    pixel_bytes = 3 * get_max_pixel_bytes(s_band, t_band) + 1
+    for xoff, yoff, xsize, ysize in get_copy_chunks(t_band, t_xoff, t_yoff, t_xsize, t_ysize,
+                                                    pixel_bytes):
+        c_xoff, c_yoff, c_xsize, c_ysize = get_source_chunk(
+            s_xoff, s_yoff, s_xsize, s_ysize, t_xoff, t_yoff, t_xsize, t_ysize,
+            xoff, yoff, xsize, ysize)
 
-    if not Numeric.isnan(nodata):
-        nodata_test = Numeric.equal(data_src, nodata)
-    else:
-        nodata_test = Numeric.isnan(data_src)
+        data_src = s_band.ReadAsArray(c_xoff, c_yoff, c_xsize, c_ysize,
+                                      xsize, ysize)
+        data_dst = t_band.ReadAsArray(xoff, yoff, xsize, ysize)
 
-    to_write = Numeric.choose(nodata_test, (data_src, data_dst))
+        if not Numeric.isnan(nodata):
+            nodata_test = Numeric.equal(data_src, nodata)
+        else:
+            nodata_test = Numeric.isnan(data_src)
+
+        to_write = Numeric.choose(nodata_test, (data_src, data_dst))
 
-    t_band.WriteArray(to_write, t_xoff, t_yoff)
+        t_band.WriteArray(to_write, xoff, yoff)
 
     return 0
 
@@ -176,39 +279,577 @@ def raster_copy_with_mask(s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
     s_band = s_fh.GetRasterBand(s_band_n)
     t_band = t_fh.GetRasterBand(t_band_n)
 
-    data_src = s_band.ReadAsArray(s_xoff, s_yoff, s_xsize, s_ysize,
-                                  t_xsize, t_ysize)
-    data_mask = m_band.ReadAsArray(s_xoff, s_yoff, s_xsize, s_ysize,
-                                   t_xsize, t_ysize)
-    data_dst = t_band.ReadAsArray(t_xoff, t_yoff, t_xsize, t_ysize)
+    # The source, mask, destination, mask test and result arrays of a chunk.
+    pixel_bytes = 3 * get_max_pixel_bytes(s_band, t_band) + \
+        gdal.GetDataTypeSize(m_band.DataType) // 8 + 1
+    for xoff, yoff, xsize, ysize in get_copy_chunks(t_band, t_xoff, t_yoff, t_xsize, t_ysize,
+                                                    pixel_bytes):
+        c_xoff, c_yoff, c_xsize, c_ysize = get_source_chunk(
+            s_xoff, s_yoff, s_xsize, s_ysize, t_xoff, t_yoff, t_xsize, t_ysize,
+            xoff, yoff, xsize, ysize)
 
-    mask_test = Numeric.equal(data_mask, 0)
-    to_write = Numeric.choose(mask_test, (data_src, data_dst))
+        data_src = s_band.ReadAsArray(c_xoff, c_yoff, c_xsize, c_ysize,
+                                      xsize, ysize)
+        data_mask = m_band.ReadAsArray(c_xoff, c_yoff, c_xsize, c_ysize,
+                                       xsize, ysize)
+        data_dst = t_band.ReadAsArray(xoff, yoff, xsize, ysize)
 
-    t_band.WriteArray(to_write, t_xoff, t_yoff)
+        mask_test = Numeric.equal(data_mask, 0)
+        to_write = Numeric.choose(mask_test, (data_src, data_dst))
+
+        t_band.WriteArray(to_write, xoff, yoff)
 
     return 0
 
 # =============================================================================
 
 
-def names_to_fileinfos(names):
+def get_max_pixel_bytes(*bands):
+    """Return the largest size in bytes of the pixels of bands."""
+    return max(gdal.GetDataTypeSize(band.DataType) // 8 for band in bands)
+
+# =============================================================================
+
+
+def get_block_windows(t_fh, max_pixels):
+    """
+    Return the (xoff, yoff, xsize, ysize) windows of the target file, in the
+    order of its blocks.
+
+    The windows are made of whole blocks.  Small blocks are grouped into
+    windows of up to full-width strips of at most max_pixels pixels, so that
+    a file of one-line strips is not processed line by line.
+    """
+    block_xsize, block_ysize = t_fh.GetRasterBand(1).GetBlockSize()
+    return get_chunks(0, 0, t_fh.RasterXSize, t_fh.RasterYSize,
+                      block_xsize, block_ysize, max_pixels)
+
+# =============================================================================
+
+
+class dataset_cache(object):
+    """A cache of the most recently used source files opened by -blockwise."""
+
+    def __init__(self, max_size=MAX_OPEN_DATASETS):
+        self.datasets = collections.OrderedDict()
+        self.max_size = max_size
+
+    def open(self, filename):
+        """Return the gdal.Dataset object of filename, opening it if needed."""
+        fh = self.datasets.pop(filename, None)
+        if fh is None:
+            fh = gdal.Open(filename)
+        self.datasets[filename] = fh
+        if len(self.datasets) > self.max_size:
+            self.datasets.popitem(last=False)
+        return fh
+
+# =============================================================================
+
+
+class extent_index(object):
+    """
+    A grid index of the extents of file_info objects, to find the ones
+    intersecting a region without testing all of them.
+    """
+
+    def __init__(self, file_infos, cell_xsize, cell_ysize):
+        """
+        Index file_infos in a grid of cells of cell_xsize x cell_ysize in
+        georeferenced units.
+        """
+        self.cell_xsize = abs(cell_xsize)
+        self.cell_ysize = abs(cell_ysize)
+        self.cells = {}
+        for n, fi in enumerate(file_infos):
+            for cell in self.get_cells(fi.ulx, fi.uly, fi.lrx, fi.lry):
+                self.cells.setdefault(cell, []).append(n)
+
+    def get_cells(self, ulx, uly, lrx, lry):
+        """Return the cells of the grid intersecting a region."""
+        min_x = int(math.floor(min(ulx, lrx) / self.cell_xsize))
+        max_x = int(math.floor(max(ulx, lrx) / self.cell_xsize))
+        min_y = int(math.floor(min(uly, lry) / self.cell_ysize))
+        max_y = int(math.floor(max(uly, lry) / self.cell_ysize))
+        return [(x, y) for y in range(min_y, max_y + 1)
+                for x in range(min_x, max_x + 1)]
+
+    def query(self, ulx, uly, lrx, lry):
+        """
+        Return the positions of the file_info objects whose extent may
+        intersect a region, in increasing order.
+        """
+        found = set()
+        for cell in self.get_cells(ulx, uly, lrx, lry):
+            found.update(self.cells.get(cell, ()))
+        return sorted(found)
+
+# =============================================================================
+
+
+def composite_window(t_geotransform, t_xsize, t_ysize, t_type, xoff, yoff, xsize, ysize,
+                     sources, datasets, nodata=None, init_value=None, blend=None):
+    """
+    Composite the sources into a window of a target band.
+
+    t_geotransform -- geotransform of the target file.
+    t_xsize, t_ysize -- size of the target file in pixels.
+    t_type -- numpy data type of the target band.
+    sources -- list of the (file_info, source band number) to copy into the
+    target band, in priority order, the last one being copied over the others.
+    datasets -- dataset_cache of the source files.
+    nodata -- value of the source pixels not to copy, or None.
+    init_value -- value to initialize the window with, or None to composite
+    over the current content of the target band.
+    blend -- None to copy the valid pixels of the sources over each other,
+    or 'alpha' or 'feather' to blend them with blend_window().
+
+    Returns (data, covered), data being the composited window, in a type
+    holding the values of the target band and of the sources, and covered
+    None if all the pixels of data are to be written, or a boolean array of
+    the pixels to be written over the current content of the target band.
+    Returns (None, None) if there is nothing to write.
+    """
+    import numpy
+
+    # The sources intersecting the window, with their source and target
+    # windows, the target windows being relative to the window.  They are
+    # cut from the windows of the sources in the whole target file, so that
+    # the pixels copied are the ones copy_into() would copy.
+    copies = []
+    for fi, s_band_n in sources:
+        windows = fi.get_windows(t_geotransform, t_xsize, t_ysize)
+        if windows is None:
+            continue
+        tw_xoff, tw_yoff, tw_xsize, tw_ysize = windows[4:]
+        x0 = max(xoff, tw_xoff)
+        x1 = min(xoff + xsize, tw_xoff + tw_xsize)
+        y0 = max(yoff, tw_yoff)
+        y1 = min(yoff + ysize, tw_yoff + tw_ysize)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        s_window = get_source_chunk(*(windows + (x0, y0, x1 - x0, y1 - y0)))
+        copies.append((fi, s_band_n, s_window + (x0 - xoff, y0 - yoff, x1 - x0, y1 - y0)))
+
+    if blend is not None:
+        if not copies and init_value is None:
+            return None, None
+        return blend_window(t_geotransform, t_xsize, t_ysize, t_type,
+                            xoff, yoff, xsize, ysize, copies, datasets,
+                            nodata, init_value, blend)
+
+    # The sources below the last one covering the whole window with all its
+    # pixels valid, if any, are hidden and need not be read, nor does the
+    # current content of the window.
+    first = None
+    for i in range(len(copies) - 1, -1, -1):
+        fi, s_band_n, windows = copies[i]
+        if nodata is None and windows[4:] == (0, 0, xsize, ysize) and \
+           get_mask_band(datasets.open(fi.filename).GetRasterBand(s_band_n)) is None:
+            first = i
+            break
+
+    covered = None
+    if first is not None:
+        data = None
+    elif init_value is not None:
+        # Keep a value that the type of the band cannot hold for the
+        # conversion on writing, as done by Fill().
+        if t_type.kind in 'iu':
+            t_info = numpy.iinfo(t_type)
+            if not float(init_value).is_integer() or \
+               not t_info.min <= init_value <= t_info.max:
+                t_type = numpy.dtype(numpy.float64)
+        data = numpy.full((ysize, xsize), init_value, dtype=t_type)
+        first = 0
+    elif copies:
+        data = numpy.zeros((ysize, xsize), dtype=t_type)
+        covered = numpy.zeros((ysize, xsize), dtype=bool)
+        first = 0
+    else:
+        return None, None
+
+    for fi, s_band_n, windows in copies[first:]:
+        sw_xoff, sw_yoff, sw_xsize, sw_ysize, tw_xoff, tw_yoff, tw_xsize, tw_ysize = windows
+
+        if verbose != 0:
+            print('Copy %g,%g,%g,%g of %s to %d,%d,%d,%d.'
+                  % (sw_xoff, sw_yoff, sw_xsize, sw_ysize, fi.filename,
+                     xoff + tw_xoff, yoff + tw_yoff, tw_xsize, tw_ysize))
+
+        s_band = datasets.open(fi.filename).GetRasterBand(s_band_n)
+        data_src = s_band.ReadAsArray(sw_xoff, sw_yoff, sw_xsize, sw_ysize,
+                                      tw_xsize, tw_ysize)
+
+        if data is None:
+            # The source covering the whole window.
+            data = data_src
+            continue
+
+        # Composite in a type holding the values of all the sources, the
+        # conversion to the type of the target band being done on writing,
+        # with the usual GDAL rules.
+        if not numpy.can_cast(data_src.dtype, data.dtype):
+            data = data.astype(numpy.promote_types(data.dtype, data_src.dtype))
+        data_dst = data[tw_yoff:tw_yoff + tw_ysize, tw_xoff:tw_xoff + tw_xsize]
+
+        if nodata is not None:
+            if not numpy.isnan(nodata):
+                valid = numpy.not_equal(data_src, nodata)
+            else:
+                valid = numpy.logical_not(numpy.isnan(data_src))
+        else:
+            m_band = get_mask_band(s_band)
+            if m_band is not None:
+                valid = numpy.not_equal(
+                    m_band.ReadAsArray(sw_xoff, sw_yoff, sw_xsize, sw_ysize,
+                                       tw_xsize, tw_ysize), 0)
+            else:
+                valid = None
+
+        if valid is None:
+            data_dst[...] = data_src
+        else:
+            numpy.copyto(data_dst, data_src, where=valid)
+
+        if covered is not None:
+            covered_dst = covered[tw_yoff:tw_yoff + tw_ysize, tw_xoff:tw_xoff + tw_xsize]
+            if valid is None:
+                covered_dst[...] = True
+            else:
+                covered_dst |= valid
+
+    return data, covered
+
+# =============================================================================
+
+
+def blend_window(t_geotransform, t_xsize, t_ysize, t_type, xoff, yoff, xsize, ysize,
+                 copies, datasets, nodata=None, init_value=None, blend='alpha'):
+    """
+    Blend the sources intersecting a window of a target band.
+
+    Each pixel of the window is the average of the pixels of the sources
+    weighted by their alpha or mask value, scaled to [0, 1], and by their
+    distance to the edge of their source with blend='feather'.  The sum of
+    the weighted pixels and of the weights are accumulated in float32, and
+    divided once all the sources are read.
+
+    copies -- list of the (file_info, source band number, windows) of the
+    sources intersecting the window, as computed by composite_window().
+
+    Returns (data, covered) as composite_window().
+    """
+    import numpy
+
+    data_sum = numpy.zeros((ysize, xsize), dtype=numpy.float32)
+    weight_sum = numpy.zeros((ysize, xsize), dtype=numpy.float32)
+
+    for fi, s_band_n, windows in copies:
+        sw_xoff, sw_yoff, sw_xsize, sw_ysize, tw_xoff, tw_yoff, tw_xsize, tw_ysize = windows
+
+        if verbose != 0:
+            print('Blend %g,%g,%g,%g of %s to %d,%d,%d,%d.'
+                  % (sw_xoff, sw_yoff, sw_xsize, sw_ysize, fi.filename,
+                     xoff + tw_xoff, yoff + tw_yoff, tw_xsize, tw_ysize))
+
+        s_band = datasets.open(fi.filename).GetRasterBand(s_band_n)
+        data_src = s_band.ReadAsArray(sw_xoff, sw_yoff, sw_xsize, sw_ysize,
+                                      tw_xsize, tw_ysize)
+
+        if nodata is not None:
+            if not numpy.isnan(nodata):
+                weight = numpy.not_equal(data_src, nodata).astype(numpy.float32)
+            else:
+                weight = numpy.logical_not(numpy.isnan(data_src)).astype(numpy.float32)
+        else:
+            m_band = get_mask_band(s_band)
+            if m_band is not None:
+                data_mask = m_band.ReadAsArray(sw_xoff, sw_yoff, sw_xsize, sw_ysize,
+                                               tw_xsize, tw_ysize)
+                weight = data_mask.astype(numpy.float32)
+                if data_mask.dtype.kind in 'iu':
+                    weight /= numpy.iinfo(data_mask.dtype).max
+            else:
+                weight = numpy.ones((tw_ysize, tw_xsize), dtype=numpy.float32)
+
+        if blend == 'feather':
+            # Distance of the centers of the pixels to the nearest edge of
+            # the source, in target pixels.
+            s_xoff, s_yoff, s_xsize, s_ysize = fi.get_windows(t_geotransform, t_xsize, t_ysize)[4:]
+            cols = numpy.arange(xoff + tw_xoff, xoff + tw_xoff + tw_xsize, dtype=numpy.float32)
+            rows = numpy.arange(yoff + tw_yoff, yoff + tw_yoff + tw_ysize, dtype=numpy.float32)
+            x_dist = numpy.minimum(cols - s_xoff, s_xoff + s_xsize - 1 - cols) + 0.5
+            y_dist = numpy.minimum(rows - s_yoff, s_yoff + s_ysize - 1 - rows) + 0.5
+            weight *= numpy.minimum.outer(y_dist, x_dist)
+
+        # NaN pixels would make the whole sum NaN, even with a zero weight.
+        data_src = numpy.where(weight > 0, data_src, 0)
+
+        w_slice = (slice(tw_yoff, tw_yoff + tw_ysize), slice(tw_xoff, tw_xoff + tw_xsize))
+        data_sum[w_slice] += data_src * weight
+        weight_sum[w_slice] += weight
+
+    covered = weight_sum > 0
+    data = numpy.zeros((ysize, xsize), dtype=numpy.promote_types(numpy.float32, t_type))
+    numpy.divide(data_sum, weight_sum, out=data, where=covered)
+
+    if init_value is not None:
+        data[numpy.logical_not(covered)] = init_value
+        covered = None
+
+    return data, covered
+
+# =============================================================================
+
+
+def write_window(t_band, xoff, yoff, data, covered=None):
+    """
+    Write a window composited by composite_window() into a target band.
+
+    Returns 1 on success.
+    """
+    import numpy
+
+    if covered is not None and not covered.all():
+        data_dst = t_band.ReadAsArray(xoff, yoff, data.shape[1], data.shape[0])
+        numpy.copyto(data, data_dst, where=numpy.logical_not(covered))
+
+    t_band.WriteArray(data, xoff, yoff)
+
+    return 1
+
+# =============================================================================
+
+
+def merge_by_blocks(t_fh, band_sources, nodata=None, init_values=None,
+                    threads=1, blend=None):
+    """
+    Composite the source files into the target file window by window.
+
+    The windows, made of whole blocks of the target file, are processed in the
+    order of its blocks, and each one is written exactly once for each band,
+    instead of being read and written again for each source file.
+
+    t_fh -- gdal.Dataset object of the target file.
+    band_sources -- for each target band, the list of (file_info, source band
+    number) to copy into it, in priority order.
+    nodata -- value of the source pixels not to copy, or None.
+    init_values -- for each target band, the value to initialize it with, or
+    None to composite over the current content of the target file.
+    threads -- number of threads compositing the windows.  The windows are
+    still written in order, from the calling thread.
+    blend -- None, 'alpha' or 'feather', as for composite_window().
+
+    Returns 1 on success.
+    """
+    import numpy
+    from osgeo import gdal_array
+
+    # Size the windows so that the arrays of the windows composited or
+    # waiting to be written fit in max_memory: for each band the composited
+    # data, in a type that may be promoted to twice the largest pixel size,
+    # and the pixels it covers, plus the source and mask being read.
+    pixel_bytes = max([gdal.GetDataTypeSize(t_fh.GetRasterBand(i + 1).DataType) // 8
+                       for i in range(len(band_sources))] +
+                      [gdal.GetDataTypeSize(fi.band_type) // 8
+                       for sources in band_sources for fi, s_band_n in sources])
+    data_bytes = min(max(8, pixel_bytes), 2 * pixel_bytes)
+    work_bytes = pixel_bytes + 2
+    if blend is not None:
+        # The blended data is at least float32, and is accumulated in the
+        # float32 sums of the pixels and of the weights, from the weights.
+        data_bytes = max(4, data_bytes)
+        work_bytes += 3 * 4
+    window_bytes = len(band_sources) * (data_bytes + 1) + work_bytes
+    if threads > 1:
+        window_bytes *= 2 * threads
+    windows = get_block_windows(t_fh, max(1, max_memory // window_bytes))
+    t_geotransform = t_fh.GetGeoTransform()
+    t_xsize = t_fh.RasterXSize
+    t_ysize = t_fh.RasterYSize
+    t_types = [numpy.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(
+        t_fh.GetRasterBand(i + 1).DataType)) for i in range(len(band_sources))]
+
+    # Index the sources of each band in a grid of cells of the size of the
+    # windows, so that only the sources near a window are tested against it.
+    # The bands copied from the same files share their index.
+    cell_xsize = windows[0][2] * t_geotransform[1]
+    cell_ysize = windows[0][3] * t_geotransform[5]
+    indexes = []
+    for sources in band_sources:
+        file_infos = [fi for fi, s_band_n in sources]
+        if not indexes or file_infos != indexes[-1][0]:
+            index = extent_index(file_infos, cell_xsize, cell_ysize)
+        else:
+            index = indexes[-1][1]
+        indexes.append((file_infos, index))
+
+    # Each thread reads the source files through its own datasets.
+    thread_data = threading.local()
+
+    def composite_windows(window):
+        if not hasattr(thread_data, 'datasets'):
+            thread_data.datasets = dataset_cache()
+        xoff, yoff, xsize, ysize = window
+        w_ulx = t_geotransform[0] + xoff * t_geotransform[1]
+        w_uly = t_geotransform[3] + yoff * t_geotransform[5]
+        w_lrx = w_ulx + xsize * t_geotransform[1]
+        w_lry = w_uly + ysize * t_geotransform[5]
+
+        results = []
+        for i, sources in enumerate(band_sources):
+            init_value = None
+            if init_values is not None:
+                init_value = init_values[i]
+            index = indexes[i][1]
+            w_sources = [sources[n] for n in index.query(w_ulx, w_uly, w_lrx, w_lry)]
+            results.append(composite_window(t_geotransform, t_xsize, t_ysize, t_types[i],
+                                            xoff, yoff, xsize, ysize,
+                                            w_sources, thread_data.datasets,
+                                            nodata, init_value, blend))
+        return window, results
+
+    pool = None
+    if threads > 1:
+        pool = ThreadPool(threads)
+        # Cap the number of windows composited ahead of the writes.
+        in_flight = threading.Semaphore(2 * threads)
+        stopping = []
+
+        def throttle_windows(windows):
+            for window in windows:
+                in_flight.acquire()
+                if stopping:
+                    return
+                yield window
+
+        composited = pool.imap(composite_windows, throttle_windows(windows))
+    else:
+        composited = (composite_windows(window) for window in windows)
+
+    try:
+        for window_n, ((xoff, yoff, xsize, ysize), results) in enumerate(composited):
+            for i, (data, covered) in enumerate(results):
+                if data is not None:
+                    write_window(t_fh.GetRasterBand(i + 1), xoff, yoff, data, covered)
+            results = None
+
+            if pool:
+                in_flight.release()
+
+            if quiet == 0 and verbose == 0:
+                progress((window_n + 1) / float(len(windows)))
+    finally:
+        if pool:
+            # Unblock the window generator if it is waiting for a write.
+            stopping.append(True)
+            in_flight.release()
+            pool.terminate()
+            pool.join()
+
+    return 1
+
+# =============================================================================
+
+
+def get_file_signature(filename):
+    """
+    Return the [size, mtime] of a file, or None if it is not a file whose
+    headers can be cached, such as a subdataset or a connection string.
+    """
+    stat = gdal.VSIStatL(filename)
+    if stat is None or not stat.IsFile():
+        return None
+    return [stat.size, stat.mtime]
+
+# =============================================================================
+
+
+def load_footprint_cache(cache_file):
+    """
+    Load a footprint cache written by save_footprint_cache().
+
+    Returns a dictionary mapping file names to their signature and file_info
+    dictionary, empty if cache_file does not exist or cannot be read.
+    """
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get('version') != 1:
+        return {}
+    return cache.get('files', {})
+
+# =============================================================================
+
+
+def save_footprint_cache(cache_file, files):
+    """Write the files of a footprint cache, as returned by load_footprint_cache()."""
+    with open(cache_file, 'w') as f:
+        json.dump({'version': 1, 'files': files}, f)
+
+# =============================================================================
+
+
+def names_to_fileinfos(names, threads=1, cache_file=None):
     """
     Translate a list of GDAL filenames, into file_info objects.
 
     names -- list of valid GDAL dataset names.
+    threads -- number of threads opening the files.
+    cache_file -- name of a footprint cache of the file_info objects of the
+    files, keyed by their absolute path (or /vsi name), size and modification
+    time, or None.  The files found unchanged in the cache are not opened,
+    and the cache is rewritten with the files of this run only.
 
     Returns a list of file_info objects.  There may be less file_info objects
     than names if some of the names could not be opened as GDAL files.
     """
 
-    file_infos = []
-    for name in names:
+    cache = {}
+    if cache_file is not None:
+        cache = load_footprint_cache(cache_file)
+    used = {}
+    updated = []
+
+    def scan(name):
         fi = file_info()
-        if fi.init_from_name(name) == 1:
-            file_infos.append(fi)
+        signature = None
+        if cache_file is not None:
+            signature = get_file_signature(name)
+            # The same local file may be given by different relative paths
+            key = name if name.startswith('/vsi') else os.path.abspath(name)
+            entry = cache.get(key)
+            if signature is not None and entry is not None and \
+               entry['signature'] == signature:
+                fi.init_from_dict(entry['info'])
+                fi.filename = name
+                used[key] = entry
+                return fi
+        if fi.init_from_name(name) != 1:
+            return None
+        if signature is not None:
+            updated.append(key)
+            used[key] = {'signature': signature, 'info': fi.to_dict()}
+        return fi
+
+    if threads > 1 and len(names) > 1:
+        pool = ThreadPool(min(threads, len(names)))
+        try:
+            scanned = pool.map(scan, names)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        scanned = [scan(name) for name in names]
 
-    return file_infos
+    # Drop the entries of the files that are not part of this run
+    if updated or len(used) != len(cache):
+        save_footprint_cache(cache_file, used)
+
+    return [fi for fi in scanned if fi is not None]
 
 # *****************************************************************************
 
@@ -262,6 +903,48 @@ class file_info(object):
 
         return 1
 
+    def init_from_dict(self, d):
+        """
+        Initialize file_info from a dictionary returned by to_dict(), without
+        opening the file.
+        """
+        self.filename = d['filename']
+        self.bands = d['bands']
+        self.xsize = d['xsize']
+        self.ysize = d['ysize']
+        self.band_type = d['band_type']
+        self.projection = d['projection']
+        self.geotransform = tuple(d['geotransform'])
+        self.ulx = self.geotransform[0]
+        self.uly = self.geotransform[3]
+        self.lrx = self.ulx + self.geotransform[1] * self.xsize
+        self.lry = self.uly + self.geotransform[5] * self.ysize
+
+        if d['ct'] is not None:
+            self.ct = gdal.ColorTable(d['ct']['interpretation'])
+            for i, entry in enumerate(d['ct']['entries']):
+                self.ct.SetColorEntry(i, tuple(entry))
+        else:
+            self.ct = None
+
+        return 1
+
+    def to_dict(self):
+        """Return the information of the file as a dictionary serializable as JSON."""
+        ct = None
+        if self.ct is not None:
+            ct = {'interpretation': self.ct.GetPaletteInterpretation(),
+                  'entries': [list(self.ct.GetColorEntry(i))
+                              for i in range(self.ct.GetCount())]}
+        return {'filename': self.filename,
+                'bands': self.bands,
+                'xsize': self.xsize,
+                'ysize': self.ysize,
+                'band_type': self.band_type,
+                'projection': self.projection,
+                'geotransform': list(self.geotransform),
+                'ct': ct}
+
     def report(self):
         print('Filename: ' + self.filename)
         print('File Size: %dx%dx%d'
@@ -289,11 +972,34 @@ class file_info(object):
         Returns 1 on success (or if nothing needs to be copied), and zero one
         failure.
         """
-        t_geotransform = t_fh.GetGeoTransform()
+        windows = self.get_windows(t_fh.GetGeoTransform(),
+                                   t_fh.RasterXSize, t_fh.RasterYSize)
+        if windows is None:
+            return 1
+        sw_xoff, sw_yoff, sw_xsize, sw_ysize, tw_xoff, tw_yoff, tw_xsize, tw_ysize = windows
+
+        # Open the source file, and copy the selected region.
+        s_fh = gdal.Open(self.filename)
+
+        return raster_copy(s_fh, sw_xoff, sw_yoff, sw_xsize, sw_ysize, s_band,
+                           t_fh, tw_xoff, tw_yoff, tw_xsize, tw_ysize, t_band,
+                           nodata_arg)
+
+    def get_windows(self, t_geotransform, t_xsize, t_ysize):
+        """
+        Compute the windows of this file and of a target to copy it into.
+
+        t_geotransform -- geotransform of the target.
+        t_xsize, t_ysize -- size of the target in pixels.
+
+        Returns the (sw_xoff, sw_yoff, sw_xsize, sw_ysize, tw_xoff, tw_yoff,
+        tw_xsize, tw_ysize) source and target windows in pixel coordinates, or
+        None if they do not intersect.
+        """
         t_ulx = t_geotransform[0]
         t_uly = t_geotransform[3]
-        t_lrx = t_geotransform[0] + t_fh.RasterXSize * t_geotransform[1]
-        t_lry = t_geotransform[3] + t_fh.RasterYSize * t_geotransform[5]
+        t_lrx = t_geotransform[0] + t_xsize * t_geotransform[1]
+        t_lry = t_geotransform[3] + t_ysize * t_geotransform[5]
 
         # figure out intersection region
         tgw_ulx = max(t_ulx, self.ulx)
@@ -307,11 +1013,11 @@ class file_info(object):
 
         # do they even intersect?
         if tgw_ulx >= tgw_lrx:
-            return 1
+            return None
         if t_geotransform[5] < 0 and tgw_uly <= tgw_lry:
-            return 1
+            return None
         if t_geotransform[5] > 0 and tgw_uly >= tgw_lry:
-            return 1
+            return None
 
         # compute target window in pixel coordinates.
         tw_xoff = int((tgw_ulx - t_geotransform[0]) / t_geotransform[1] + 0.1)
@@ -322,7 +1028,7 @@ class file_info(object):
             - tw_yoff
 
         if tw_xsize < 1 or tw_ysize < 1:
-            return 1
+            return None
 
         # Compute source window in pixel coordinates.
         sw_xoff = int((tgw_ulx - self.geotransform[0]) / self.geotransform[1])
@@ -333,14 +1039,10 @@ class file_info(object):
                        self.geotransform[5] + 0.5) - sw_yoff
 
         if sw_xsize < 1 or sw_ysize < 1:
-            return 1
-
-        # Open the source file, and copy the selected region.
-        s_fh = gdal.Open(self.filename)
+            return None
 
-        return raster_copy(s_fh, sw_xoff, sw_yoff, sw_xsize, sw_ysize, s_band,
-                           t_fh, tw_xoff, tw_yoff, tw_xsize, tw_ysize, t_band,
-                           nodata_arg)
+        return (sw_xoff, sw_yoff, sw_xsize, sw_ysize,
+                tw_xoff, tw_yoff, tw_xsize, tw_ysize)
 
 
 # =============================================================================
@@ -349,7 +1051,9 @@ def Usage():
     print('                     [-ps pixelsize_x pixelsize_y] [-tap] [-separate] [-q] [-v] [-pct]')
     print('                     [-ul_lr ulx uly lrx lry] [-init "value [value...]"]')
     print('                     [-n nodata_value] [-a_nodata output_nodata_value]')
-    print('                     [-ot datatype] [-createonly] input_files')
+    print('                     [-ot datatype] [-createonly] [-blockwise] [-threads n]')
+    print('                     [-footprint_cache filename] [-max_memory MB]')
+    print('                     [-blend alpha|feather] input_files')
     print('                     [--help-general]')
     print('')
 
@@ -361,9 +1065,10 @@ def Usage():
 
 def main(argv=None):
 
-    global verbose, quiet
+    global verbose, quiet, max_memory
     verbose = 0
     quiet = 0
+    max_memory = DEFAULT_MAX_MEMORY
     names = []
     frmt = None
     out_file = 'out.tif'
@@ -378,6 +1083,10 @@ def main(argv=None):
     pre_init = []
     band_type = None
     createonly = 0
+    blockwise = 0
+    threads = 1
+    footprint_cache = None
+    blend = None
     bTargetAlignedPixels = False
     start_time = time.time()
 
@@ -406,6 +1115,36 @@ def main(argv=None):
         elif arg == '-createonly':
             createonly = 1
 
+        elif arg == '-blockwise':
+            blockwise = 1
+
+        elif arg == '-threads':
+            i = i + 1
+            threads = int(argv[i])
+            if threads < 1:
+                print('The number of threads must be at least 1.')
+                sys.exit(1)
+            blockwise = 1
+
+        elif arg == '-blend':
+            i = i + 1
+            blend = argv[i]
+            if blend not in ('alpha', 'feather'):
+                print('Unknown blend mode: %s' % blend)
+                sys.exit(1)
+            blockwise = 1
+
+        elif arg == '-max_memory':
+            i = i + 1
+            max_memory = int(float(argv[i]) * 1024 * 1024)
+            if max_memory < 1:
+                print('The maximum memory must be positive.')
+                sys.exit(1)
+
+        elif arg == '-footprint_cache':
+            i = i + 1
+            footprint_cache = argv[i]
+
         elif arg == '-separate':
             separate = 1
 
@@ -488,7 +1227,7 @@ def main(argv=None):
         sys.exit(1)
 
     # Collect information on all the source files.
-    file_infos = names_to_fileinfos(names)
+    file_infos = names_to_fileinfos(names, threads, footprint_cache)
 
     if ulx is None:
         ulx = file_infos[0].ulx
@@ -564,13 +1303,17 @@ def main(argv=None):
             t_fh.GetRasterBand(i + 1).SetNoDataValue(a_nodata)
 
     # Do we need to pre-initialize the whole mosaic file to some value?
+    init_values = None
     if pre_init is not None:
         if t_fh.RasterCount <= len(pre_init):
-            for i in range(t_fh.RasterCount):
-                t_fh.GetRasterBand(i + 1).Fill(pre_init[i])
+            init_values = pre_init[:t_fh.RasterCount]
         elif len(pre_init) == 1:
-            for i in range(t_fh.RasterCount):
-                t_fh.GetRasterBand(i + 1).Fill(pre_init[0])
+            init_values = pre_init * t_fh.RasterCount
+
+    # With -blockwise, the bands are initialized while compositing them.
+    if init_values is not None and (blockwise == 0 or createonly != 0):
+        for i in range(t_fh.RasterCount):
+            t_fh.GetRasterBand(i + 1).Fill(init_values[i])
 
     # Copy data from source files into output file.
     t_band = 1
@@ -579,29 +1322,43 @@ def main(argv=None):
         progress(0.0)
     fi_processed = 0
 
-    for fi in file_infos:
-        if createonly != 0:
-            continue
+    if blockwise != 0 and createonly == 0:
+        band_sources = [[] for i in range(t_fh.RasterCount)]
+        for fi in file_infos:
+            if separate == 0:
+                for band in range(1, bands + 1):
+                    band_sources[band - 1].append((fi, band))
+            else:
+                for band in range(1, fi.bands + 1):
+                    band_sources[t_band - 1].append((fi, band))
+                    t_band = t_band + 1
 
-        if verbose != 0:
-            print("")
-            print("Processing file %5d of %5d, %6.3f%% completed in %d minutes."
-                  % (fi_processed + 1, len(file_infos),
-                     fi_processed * 100.0 / len(file_infos),
-                     int(round((time.time() - start_time) / 60.0))))
-            fi.report()
-
-        if separate == 0:
-            for band in range(1, bands + 1):
-                fi.copy_into(t_fh, band, band, nodata)
-        else:
-            for band in range(1, fi.bands + 1):
-                fi.copy_into(t_fh, band, t_band, nodata)
-                t_band = t_band + 1
+        merge_by_blocks(t_fh, band_sources, nodata, init_values, threads, blend)
+
+    else:
+        for fi in file_infos:
+            if createonly != 0:
+                continue
+
+            if verbose != 0:
+                print("")
+                print("Processing file %5d of %5d, %6.3f%% completed in %d minutes."
+                      % (fi_processed + 1, len(file_infos),
+                         fi_processed * 100.0 / len(file_infos),
+                         int(round((time.time() - start_time) / 60.0))))
+                fi.report()
+
+            if separate == 0:
+                for band in range(1, bands + 1):
+                    fi.copy_into(t_fh, band, band, nodata)
+            else:
+                for band in range(1, fi.bands + 1):
+                    fi.copy_into(t_fh, band, t_band, nodata)
+                    t_band = t_band + 1
 
-        fi_processed = fi_processed + 1
-        if quiet == 0 and verbose == 0:
-            progress(fi_processed / float(len(file_infos)))
+            fi_processed = fi_processed + 1
+            if quiet == 0 and verbose == 0:
+                progress(fi_processed / float(len(file_infos)))
 
     # Force file to be closed.
     t_fh = None